@@ -0,0 +1,138 @@
+"""
+Load test of the classify view under ASGI (uvicorn) and WSGI (gunicorn).
+
+Starts each server with the fake Gemini backend (no API quota is spent)
+and the caches disabled, so every request waits on two model calls of
+FAKE_LATENCY_MS each. Then posts images at increasing concurrency and
+prints throughput and latency. A single uvicorn worker keeps serving
+other scans while requests wait on inference; a WSGI worker is capped by
+its thread count.
+
+Requires uvicorn and gunicorn to be installed.
+
+Usage: python3 -m app.benchmarks.asgi_load [latency_ms] [wsgi_threads]
+"""
+import io
+import os
+import socket
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+import requests
+from PIL import Image
+
+
+CONCURRENCY = [1, 8, 32, 64]
+REQUESTS_PER_CLIENT = 4
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def sample_image() -> bytes:
+    buffer = io.BytesIO()
+    Image.new("RGB", (320, 240), (200, 30, 40)).save(buffer, "JPEG")
+    return buffer.getvalue()
+
+
+def start_server(command: List[str], port: int, latency_ms: float,
+                 extra_env: Optional[Dict[str, str]] = None
+                 ) -> subprocess.Popen:
+    """
+    Starts a server process and waits until it answers.
+    """
+    env = dict(os.environ,
+               GEMINI_BACKEND="fake",
+               FAKE_LATENCY_MS=str(latency_ms),
+               CACHE_ENABLED="0",
+               PHASH_ENABLED="0",
+               LOCAL_RESOLVE_ENABLED="0")
+    env.update(extra_env or {})
+    process = subprocess.Popen(command, env=env, stdout=subprocess.DEVNULL,
+                               stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            requests.get(f"http://127.0.0.1:{port}/", timeout=1)
+            return process
+        except requests.RequestException:
+            time.sleep(0.2)
+    process.kill()
+    raise RuntimeError(f"Server did not start: {' '.join(command)}")
+
+
+def post_scans(base_url: str, image: bytes, count: int) -> List[float]:
+    """
+    Posts count scans over one session and returns their latencies.
+    """
+    session = requests.Session()
+    session.get(f"{base_url}/")
+    token = session.cookies["csrftoken"]
+    latencies = []
+    for _ in range(count):
+        start = time.perf_counter()
+        response = session.post(
+            f"{base_url}/classify/",
+            files={"image": ("scan.jpg", image, "image/jpeg")},
+            headers={"X-CSRFToken": token, "Referer": base_url},
+        )
+        response.raise_for_status()
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def run(label: str, command: List[str], port: int,
+        latency_ms: float) -> None:
+    image = sample_image()
+    base_url = f"http://127.0.0.1:{port}"
+    process = start_server(command, port, latency_ms)
+    try:
+        for clients in CONCURRENCY:
+            start = time.perf_counter()
+            with ThreadPoolExecutor(clients) as pool:
+                results = list(pool.map(
+                    lambda _: post_scans(base_url, image,
+                                         REQUESTS_PER_CLIENT),
+                    range(clients)))
+            elapsed = time.perf_counter() - start
+            latencies = sorted(x for r in results for x in r)
+            p95 = latencies[int(len(latencies) * 0.95) - 1]
+            print(f"{label:<22} {clients:>8} "
+                  f"{len(latencies) / elapsed:>10.1f} "
+                  f"{sum(latencies) / len(latencies) * 1e3:>10.0f} "
+                  f"{p95 * 1e3:>10.0f}")
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def main() -> None:
+    latency_ms = float(sys.argv[1]) if len(sys.argv) > 1 else 500.0
+    threads = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+
+    print(f"Fake model latency: {latency_ms:.0f} ms per call, "
+          f"2 calls per scan")
+    print(f"{'server':<22} {'clients':>8} {'req/s':>10} {'mean ms':>10} "
+          f"{'p95 ms':>10}")
+
+    port = free_port()
+    run("uvicorn (1 worker)",
+        [sys.executable, "-m", "uvicorn", "smart_scale.asgi:application",
+         "--port", str(port), "--workers", "1", "--log-level", "warning"],
+        port, latency_ms)
+
+    port = free_port()
+    run(f"gunicorn (1x{threads} thr)",
+        [sys.executable, "-m", "gunicorn", "smart_scale.wsgi:application",
+         "--bind", f"127.0.0.1:{port}", "--workers", "1",
+         "--threads", str(threads)],
+        port, latency_ms)
+
+
+if __name__ == "__main__":
+    main()
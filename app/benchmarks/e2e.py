@@ -0,0 +1,379 @@
+"""
+End-to-end latency and load benchmark against the fake Gemini backend.
+
+Runs every scan through the real code paths with FakeGenAIClient in place
+of the API, so no quota is spent:
+
+- test_client: posts to scale_ui.views.classify through Django's test
+  client, from concurrent threads, in this process;
+- http: posts to a uvicorn server over real HTTP from concurrent clients;
+- pipeline: classifies a directory of images with the batch mode of
+  app/main.py (BatchService).
+
+The fake's latency distribution, error rate and answers are configurable.
+Caches are disabled unless --caches is given, so every scan calls the
+fake. Each scenario reports p50/p95/p99 latency, throughput, error rate
+and memory per request. The results are written as JSON so runs can be
+compared with --compare.
+
+Usage: python3 -m app.benchmarks.e2e [--requests N] [--concurrency N]
+           [--latency-ms MS] [--dist lognormal] [--error-rate 0.02]
+           [--scenarios test_client,http,pipeline] [--compare old.json]
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Tuple
+import requests
+from PIL import Image
+from app.benchmarks.asgi_load import free_port, start_server
+
+
+SCENARIOS = ("test_client", "http", "pipeline")
+RESULTS_DIR = os.path.join("app", "benchmarks", "results")
+ERROR_MARKER = "Could not identify item"
+# Requests traced for allocations after the timed run (tracing is slow)
+MEMORY_SAMPLE = 20
+
+
+def percentile(samples: List[float], fraction: float) -> float:
+    """
+    Nearest-rank percentile of a non-empty list.
+    """
+    ordered = sorted(samples)
+    index = max(0, min(len(ordered) - 1,
+                       int(round(fraction * len(ordered))) - 1))
+    return ordered[index]
+
+
+def make_images(count: int) -> List[bytes]:
+    """
+    Returns count distinct camera-like JPEGs, so no two scans share a key.
+    """
+    images = []
+    for i in range(count):
+        frame = Image.effect_noise((640, 480), 30 + i % 50).convert("RGB")
+        frame.putpixel((i % 640, i // 640 % 480), (i % 256, 0, 0))
+        buffer = io.BytesIO()
+        frame.save(buffer, "JPEG", quality=85)
+        images.append(buffer.getvalue())
+    return images
+
+
+def rss_kib(pid: str = "self") -> int:
+    """
+    Resident set size of a process in KiB (Linux only, 0 elsewhere).
+    """
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+
+def fake_env(args: argparse.Namespace) -> Dict[str, str]:
+    """
+    Settings pointing AIService at the configured fake backend.
+    """
+    env = {
+        "GEMINI_BACKEND": "fake",
+        "FAKE_LATENCY_MS": str(args.latency_ms),
+        "FAKE_LATENCY_DIST": args.dist,
+        "FAKE_LATENCY_SIGMA": str(args.sigma),
+        "FAKE_ERROR_RATE": str(args.error_rate),
+        "FAKE_RESPONSES_PATH": args.responses,
+    }
+    if not args.caches:
+        env.update(CACHE_ENABLED="0", PHASH_ENABLED="0",
+                   LOCAL_RESOLVE_ENABLED="0")
+    return env
+
+
+def summarize(latencies: List[float], errors: int, elapsed: float,
+              memory: Dict[str, float]) -> Dict[str, Any]:
+    """
+    Builds the machine-readable summary of one scenario.
+    """
+    total = len(latencies)
+    return {
+        "requests": total,
+        "errors": errors,
+        "error_rate": errors / total if total else 0.0,
+        "throughput_rps": total / elapsed if elapsed else 0.0,
+        "latency_ms": {
+            "p50": percentile(latencies, 0.50) * 1000,
+            "p95": percentile(latencies, 0.95) * 1000,
+            "p99": percentile(latencies, 0.99) * 1000,
+            "mean": sum(latencies) / total * 1000,
+            "max": max(latencies) * 1000,
+        },
+        **memory,
+    }
+
+
+def load(send: Callable[[bytes], bool], images: List[bytes],
+         concurrency: int) -> Tuple[List[float], int, float]:
+    """
+    Sends every image from concurrency threads.
+
+    Args:
+        send: Classifies one image and returns whether it succeeded.
+
+    Returns:
+        The latencies in seconds, the error count and the elapsed time.
+    """
+    latencies: List[float] = []
+    errors = 0
+    lock = threading.Lock()
+
+    def timed_send(image: bytes) -> None:
+        nonlocal errors
+        start = time.perf_counter()
+        ok = send(image)
+        elapsed = time.perf_counter() - start
+        with lock:
+            latencies.append(elapsed)
+            errors += not ok
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        list(pool.map(timed_send, images))
+    return latencies, errors, time.perf_counter() - start
+
+
+def traced_allocations(send: Callable[[bytes], bool],
+                       images: List[bytes]) -> float:
+    """
+    Mean peak of Python allocations per request, in KiB, sent one by one.
+    """
+    peaks = []
+    tracemalloc.start()
+    for image in images:
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        send(image)
+        peaks.append(tracemalloc.get_traced_memory()[1] - before)
+    tracemalloc.stop()
+    return sum(peaks) / len(peaks) / 1024
+
+
+async def read_stream(response) -> bytes:
+    """
+    Reads the body of a streamed response of an async view.
+    """
+    return b"".join([chunk async for chunk in response.streaming_content])
+
+
+def run_test_client(args: argparse.Namespace,
+                    images: List[bytes]) -> Dict[str, Any]:
+    import django
+    from django.core.files.uploadedfile import SimpleUploadedFile
+    from django.test import Client
+    from django.test.utils import setup_test_environment
+
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "smart_scale.settings")
+    django.setup()
+    setup_test_environment()
+    local = threading.local()
+
+    def send(image: bytes) -> bool:
+        if not hasattr(local, "client"):
+            local.client = Client()
+        response = local.client.post("/classify/", {
+            "image": SimpleUploadedFile("scan.jpg", image, "image/jpeg")})
+        # Streamed result pages carry the outcome in their last chunks
+        body = (asyncio.run(read_stream(response)) if response.streaming
+                else response.content)
+        return (response.status_code == 200
+                and ERROR_MARKER not in body.decode())
+
+    send(images[0])  # Warm up the service container
+    rss_before = rss_kib()
+    latencies, errors, elapsed = load(send, images, args.concurrency)
+    memory = {
+        "rss_growth_kib_per_request":
+            (rss_kib() - rss_before) / len(images),
+        "alloc_peak_kib_per_request":
+            traced_allocations(send, images[:MEMORY_SAMPLE]),
+    }
+    return summarize(latencies, errors, elapsed, memory)
+
+
+def run_http(args: argparse.Namespace,
+             images: List[bytes]) -> Dict[str, Any]:
+    port = free_port()
+    base_url = f"http://127.0.0.1:{port}"
+    command = [sys.executable, "-m", "uvicorn",
+               "smart_scale.asgi:application", "--port", str(port),
+               "--workers", "1", "--log-level", "warning"]
+    process = start_server(command, port, args.latency_ms, fake_env(args))
+    local = threading.local()
+
+    def send(image: bytes) -> bool:
+        if not hasattr(local, "session"):
+            local.session = requests.Session()
+            local.session.get(f"{base_url}/")
+        token = local.session.cookies["csrftoken"]
+        try:
+            response = local.session.post(
+                f"{base_url}/classify/",
+                files={"image": ("scan.jpg", image, "image/jpeg")},
+                headers={"X-CSRFToken": token, "Referer": base_url},
+                timeout=60)
+        except requests.RequestException:
+            return False
+        return response.ok and ERROR_MARKER not in response.text
+
+    try:
+        send(images[0])
+        rss_before = rss_kib(str(process.pid))
+        latencies, errors, elapsed = load(send, images, args.concurrency)
+        memory = {
+            "server_rss_growth_kib_per_request":
+                (rss_kib(str(process.pid)) - rss_before) / len(images),
+        }
+    finally:
+        process.terminate()
+        process.wait()
+    return summarize(latencies, errors, elapsed, memory)
+
+
+def run_pipeline(args: argparse.Namespace,
+                 images: List[bytes]) -> Dict[str, Any]:
+    from app.src.services.batch_service import BatchService
+    from app.src.services.service_container import get_container
+
+    container = get_container()
+    with tempfile.TemporaryDirectory() as directory:
+        for i, image in enumerate(images):
+            with open(os.path.join(directory, f"scan_{i:05d}.jpg"),
+                      "wb") as f:
+                f.write(image)
+        output_path = os.path.join(directory, ".results.jsonl")
+        batch_service = BatchService(container.build_scan_service,
+                                     output_path, args.concurrency)
+
+        rss_before = rss_kib()
+        report = batch_service.run(batch_service.collect(directory))
+        with open(output_path, encoding="utf-8") as f:
+            records = [json.loads(line) for line in f]
+        memory = {
+            "rss_growth_kib_per_request":
+                (rss_kib() - rss_before) / len(images),
+        }
+
+    scan_service = container.build_scan_service()
+    memory["alloc_peak_kib_per_request"] = traced_allocations(
+        lambda image: scan_service.scan(image).error is None,
+        images[:MEMORY_SAMPLE])
+    latencies = [r["timings_ms"]["total"] / 1000 for r in records]
+    return summarize(latencies, report.failed, report.elapsed, memory)
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"],
+                              capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+def print_table(results: Dict[str, Dict[str, Any]],
+                baseline: Dict[str, Dict[str, Any]]) -> None:
+    print(f"{'scenario':<12} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} "
+          f"{'p99 ms':>8} {'errors':>7}")
+    for name, result in results.items():
+        latency = result["latency_ms"]
+        print(f"{name:<12} {result['throughput_rps']:>8.1f} "
+              f"{latency['p50']:>8.0f} {latency['p95']:>8.0f} "
+              f"{latency['p99']:>8.0f} {result['error_rate']:>7.1%}")
+        old = baseline.get(name)
+        if old:
+            print(f"{'  vs base':<12} "
+                  f"{change(old['throughput_rps'], result['throughput_rps'])}"
+                  + "".join(f" {change(old['latency_ms'][p], latency[p])}"
+                            for p in ("p50", "p95", "p99")))
+        for key, value in result.items():
+            if key.endswith("_kib_per_request"):
+                print(f"{'':<12} {key}: {value:.1f}")
+
+
+def change(old: float, new: float) -> str:
+    return f"{(new - old) / old:>+8.0%}" if old else f"{'n/a':>8}"
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(prog="python3 -m app.benchmarks.e2e")
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--latency-ms", type=float, default=100.0)
+    parser.add_argument("--dist", default="lognormal",
+                        choices=("fixed", "uniform", "exponential",
+                                 "lognormal"))
+    parser.add_argument("--sigma", type=float, default=0.5)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--responses", default="",
+                        help="JSON file of fake answers per prompt kind")
+    parser.add_argument("--caches", action="store_true",
+                        help="keep the caches and local resolution on")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS))
+    parser.add_argument("--output", default="",
+                        help="results file (default: a timestamped file "
+                             f"in {RESULTS_DIR})")
+    parser.add_argument("--compare", default="",
+                        help="previous results file to compare against")
+    args = parser.parse_args()
+
+    # Settings are read when the app modules are first imported, so the
+    # in-process scenarios import them only after this
+    os.environ.update(fake_env(args))
+    runners = {"test_client": run_test_client, "http": run_http,
+               "pipeline": run_pipeline}
+    images = make_images(args.requests)
+
+    results = {}
+    for name in args.scenarios.split(","):
+        print(f"Running {name} ({args.requests} requests, "
+              f"concurrency {args.concurrency})...")
+        # The services print a line per scan; keep the report readable
+        with open(os.devnull, "w") as devnull:
+            with contextlib.redirect_stdout(devnull):
+                results[name] = runners[name](args, images)
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)["scenarios"]
+    print_table(results, baseline)
+
+    output_path = args.output or os.path.join(
+        RESULTS_DIR, f"e2e-{datetime.now():%Y%m%d-%H%M%S}.json")
+    os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+    with open(output_path, "w", encoding="utf-8") as f:
+        json.dump({
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "commit": git_commit(),
+            "config": {key: value for key, value in vars(args).items()
+                       if key not in ("output", "compare")},
+            "scenarios": results,
+        }, f, indent=2)
+    print(f"Results written to {output_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+"""
+Tail latency of the analyze call with and without hedged requests.
+
+Runs rounds of concurrent analyze calls against the fake Gemini backend
+with lognormal latency (a long tail, as the real one has) and reports
+the p50/p95/p99 latency and the extra calls spent, for several
+percentiles of the hedging delay. The first round warms up the latency
+window and is left out.
+
+Usage: python3 -m app.benchmarks.hedging [calls] [median_ms] [sigma]
+       [budget]
+"""
+import asyncio
+import os
+import statistics
+import sys
+import time
+
+os.environ.setdefault("GEMINI_API_KEY", "benchmark-key")
+
+from app.src.models.inference_session import InferenceSession  # noqa: E402
+from app.src.services.ai_service import AIService  # noqa: E402
+from app.src.services.fake_genai_client import FakeGenAIClient  # noqa: E402
+from app.src.services.hedging import HedgingPolicy  # noqa: E402
+
+CONCURRENCY = 20
+
+
+async def run(label: str, calls: int, median_ms: float, sigma: float,
+              hedging: HedgingPolicy = None) -> None:
+    """
+    Makes the calls in rounds and prints the latency percentiles.
+    """
+    client = FakeGenAIClient(latency=median_ms / 1000,
+                             distribution="lognormal", sigma=sigma, seed=1)
+    ai_service = AIService(client=client, hedging=hedging)
+    latencies = []
+
+    async def analyze() -> None:
+        start = time.perf_counter()
+        await ai_service.analyze_image_async(InferenceSession(b"kiwi"))
+        latencies.append((time.perf_counter() - start) * 1000)
+
+    for _ in range(calls // CONCURRENCY + 1):
+        await asyncio.gather(*(analyze() for _ in range(CONCURRENCY)))
+
+    measured = latencies[CONCURRENCY:]
+    quantiles = statistics.quantiles(measured, n=100)
+    # Cancelled backups never reach the fake, so count them on the policy
+    extra = hedging.stats()["hedge_rate"] if hedging else 0.0
+    print(f"{label:<12} {quantiles[49]:>8.1f} {quantiles[94]:>8.1f} "
+          f"{quantiles[98]:>8.1f} {extra:>11.1%}")
+
+
+async def main() -> None:
+    args = sys.argv[1:]
+    calls = int(args[0]) if len(args) > 0 else 2000
+    median_ms = float(args[1]) if len(args) > 1 else 20.0
+    sigma = float(args[2]) if len(args) > 2 else 1.2
+    budget = float(args[3]) if len(args) > 3 else 0.1
+
+    print(f"{calls} calls, lognormal latency (median {median_ms:.0f} ms, "
+          f"sigma {sigma}), hedge budget {budget:.0%}")
+    print(f"{'mode':<12} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} "
+          f"{'extra calls':>11}")
+    await run("no hedging", calls, median_ms, sigma)
+    for percentile in (80, 90, 95):
+        await run(f"hedge p{percentile}", calls, median_ms, sigma,
+                  HedgingPolicy(percentile=percentile, budget=budget,
+                                min_samples=50, initial_delay=10.0,
+                                min_delay=0.001))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
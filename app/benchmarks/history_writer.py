@@ -0,0 +1,82 @@
+"""
+Cost of keeping a scan history on the response path.
+
+Records scans one after another and reports the p50/p99 time each
+record takes: with no history, with a synchronous insert and commit per
+scan, and with the write-behind HistoryWriter. The image digest comes
+with the result, hashed once by the scan service. The databases are
+temporary files.
+
+Usage: python3 -m app.benchmarks.history_writer [scans]
+"""
+import hashlib
+import os
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+from typing import Callable
+
+os.environ.setdefault("GEMINI_API_KEY", "benchmark-key")
+
+from app.src.models.product import Product  # noqa: E402
+from app.src.models.scan_result import ScanResult  # noqa: E402
+from app.src.services.history_writer import (  # noqa: E402
+    HistoryWriter, INSERT, SCHEMA, history_row)
+
+IMAGE = b"\x89PNG" + os.urandom(200_000)
+RESULT = ScanResult(
+    agent_output='{"fruit": "Kiwi"}',
+    matches=[Product(fruit="Kiwi", plu=4030, price=3.99)],
+    timings={"total": 812.5, "agent": 790.1, "match": 0.4},
+    image_digest=hashlib.sha256(IMAGE).hexdigest(),
+)
+
+
+def run(label: str, scans: int, record: Callable[[], None]) -> None:
+    """
+    Times each record call and prints the percentiles.
+    """
+    latencies = []
+    for _ in range(scans):
+        start = time.perf_counter()
+        record()
+        latencies.append((time.perf_counter() - start) * 1_000_000)
+    quantiles = statistics.quantiles(latencies, n=100)
+    print(f"{label:<14} {quantiles[49]:>9.1f} {quantiles[98]:>9.1f}")
+
+
+def main() -> None:
+    args = sys.argv[1:]
+    scans = int(args[0]) if len(args) > 0 else 5000
+
+    print(f"{scans} scans, {len(IMAGE) // 1000} KB images")
+    print(f"{'mode':<14} {'p50 us':>9} {'p99 us':>9}")
+    run("no history", scans, lambda: None)
+
+    with tempfile.TemporaryDirectory() as directory:
+        connection = sqlite3.connect(os.path.join(directory, "sync.sqlite3"))
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.executescript(SCHEMA)
+
+        def insert() -> None:
+            row = history_row(time.time(), "web", RESULT.image_digest,
+                              RESULT)
+            with connection:
+                connection.execute(INSERT, row)
+
+        run("sync insert", scans, insert)
+        connection.close()
+
+        writer = HistoryWriter(os.path.join(directory, "behind.sqlite3"))
+        run("write-behind", scans,
+            lambda: writer.record(RESULT, "web"))
+        writer.close()
+        stats = writer.stats()
+        print(f"write-behind: {stats['written']} written in "
+              f"{stats['batches']} batches, {stats['dropped']} dropped")
+
+
+if __name__ == "__main__":
+    main()
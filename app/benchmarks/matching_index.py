@@ -0,0 +1,86 @@
+"""
+Micro-benchmark of picklist matching: linear scan versus inverted index.
+
+The linear scan is the previous MatchingService.find_matches loop (a
+lowercase substring test against every product). "cold" queries always
+go through the n-gram index; "warm" ones are answered by its memo,
+which is the common case since the model keeps returning the same few
+names. Catalogues of the
+requested sizes are synthesized from fruit names, varieties and store
+codes.
+
+Usage: python3 -m app.benchmarks.matching_index [size ...]
+"""
+import random
+import sys
+import time
+from typing import List
+from app.src.models.product import Product
+from app.src.services.product_index import ProductIndex
+
+
+FRUITS = ["Abacate", "Ameixa", "Ananas", "Banana", "Cereja", "Clementina",
+          "Figo", "Framboesa", "Kiwi", "Laranja", "Lima", "Limao", "Manga",
+          "Maçã", "Melancia", "Melao", "Morango", "Nectarina", "Pera",
+          "Pessego", "Romã", "Tangerina", "Toranja", "Uva"]
+VARIETIES = ["Gala", "Golden", "Pink Lady", "Reineta", "Madeira", "Hass",
+             "Bio", "Rocha", "Vermelha", "Branca", "Preta", "Algarve",
+             "Cacho", "Extra", "Calibre Grande", "Importada"]
+QUERIES = ["Maca", "banana", "Pera Rocha", "uva", "Kiwi", "Romã", "Toranja"]
+
+
+def build_catalogue(size: int) -> List[Product]:
+    """
+    Returns a synthetic catalogue of the given size.
+    """
+    random.seed(size)
+    products = []
+    for plu in range(size):
+        name = f"{random.choice(FRUITS)} {random.choice(VARIETIES)}"
+        if size > 100:
+            name += f" L{plu % 997:03d}"
+        products.append(Product(name, 10000 + plu, 1.0))
+    return products
+
+
+def linear_scan(products: List[Product], query: str) -> List[Product]:
+    target = query.lower()
+    return [p for p in products if target in p.fruit.lower()]
+
+
+def time_per_query(func, repeat: int) -> float:
+    """
+    Returns the mean time of one query in microseconds.
+    """
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for query in QUERIES:
+            func(query)
+    return (time.perf_counter() - start) / (repeat * len(QUERIES)) * 1e6
+
+
+def main() -> None:
+    sizes = [int(arg) for arg in sys.argv[1:]] or [60, 10_000, 100_000]
+
+    print(f"{'products':>10} {'build ms':>10} {'scan us':>10} "
+          f"{'cold us':>10} {'warm us':>10} {'cold x':>8} {'warm x':>8}")
+    for size in sizes:
+        products = build_catalogue(size)
+        start = time.perf_counter()
+        index = ProductIndex(products)
+        build_ms = (time.perf_counter() - start) * 1e3
+        unmemoized = ProductIndex(products, memo_size=0)
+
+        repeat = max(1, 200_000 // size)
+        scan_us = time_per_query(lambda q: linear_scan(products, q), repeat)
+        cold_us = time_per_query(unmemoized.search, repeat)
+        for query in QUERIES:
+            index.search(query)
+        warm_us = time_per_query(index.search, repeat)
+        print(f"{size:>10} {build_ms:>10.1f} {scan_us:>10.1f} "
+              f"{cold_us:>10.1f} {warm_us:>10.1f} "
+              f"{scan_us / cold_us:>7.1f}x {scan_us / warm_us:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+"""
+Throughput of the analyze calls with and without micro-batching.
+
+Many scales scan at once against a fake Gemini backend that allows a
+limited number of requests in flight (as a per-key quota would) and
+whose latency grows with the number of images per call. Every scale
+thread scans back to back; each run reports the scans per second, the
+upstream calls, the mean batch size and the p50/p95 scan latency.
+
+Usage: python3 -m app.benchmarks.micro_batch [scales] [seconds]
+       [base_ms] [ms_per_image] [max_in_flight] [max_batch]
+"""
+import os
+import statistics
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+os.environ.setdefault("GEMINI_API_KEY", "benchmark-key")
+
+from app.src.repositories.picklist_repository import PicklistRepository  # noqa: E402,E501
+from app.src.services.ai_service import AIService  # noqa: E402
+from app.src.services.fake_genai_client import FakeModels  # noqa: E402
+from app.src.services.matching_service import MatchingService  # noqa: E402
+from app.src.services.micro_batcher import MicroBatcher  # noqa: E402
+from app.src.services.scan_service import ScanService  # noqa: E402
+
+
+class QuotaModels(FakeModels):
+    """
+    Fake backend serving at most max_in_flight calls at once, each taking
+    base_ms plus ms_per_image for every image after the first.
+    """
+
+    def __init__(self, base_ms: float, ms_per_image: float,
+                 max_in_flight: int):
+        super().__init__(latency=0, responses={
+            "analyze": ['{"fruit": "Kiwi"}'],
+            "refine": ['{"fruit": "Kiwi", "PLU": 50719, "Price": 2.1}'],
+            "single_call": ['{"fruit": "Kiwi", "PLU": 50719}'],
+        })
+        self.base_ms = base_ms
+        self.ms_per_image = ms_per_image
+        self._slots = threading.Semaphore(max_in_flight)
+        self._lock = threading.Lock()
+
+    def generate_content(self, model, contents, config=None):
+        images = sum(1 for part in contents if not isinstance(part, str))
+        with self._slots:
+            time.sleep((self.base_ms + self.ms_per_image * (images - 1))
+                       / 1000)
+        with self._lock:
+            return self._answer(contents)
+
+
+def run(label: str, scales: int, seconds: float, models: QuotaModels,
+        window_ms: float = 0.0, max_batch: int = 8) -> None:
+    """
+    Lets every scale scan for the given time and prints the results.
+    """
+    products = PicklistRepository().load()
+    ai_service = AIService(client=SimpleNamespace(models=models))
+    batcher = (MicroBatcher(ai_service, window=window_ms / 1000,
+                            max_size=max_batch, workers=scales)
+               if window_ms else None)
+    scan_service = ScanService(ai_service, MatchingService(products),
+                               micro_batcher=batcher)
+
+    latencies = []
+    stop_at = time.perf_counter() + seconds
+
+    def scale(number: int) -> None:
+        scan = 0
+        while time.perf_counter() < stop_at:
+            start = time.perf_counter()
+            scan_service.scan(f"scale {number} image {scan}".encode())
+            latencies.append((time.perf_counter() - start) * 1000)
+            scan += 1
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(scales) as executor:
+        list(executor.map(scale, range(scales)))
+    elapsed = time.perf_counter() - started
+    if batcher is not None:
+        batcher.close()
+
+    quantiles = statistics.quantiles(latencies, n=20)
+    print(f"{label:<16} {len(latencies) / elapsed:>9.1f} "
+          f"{models.calls:>7} {len(latencies) / models.calls:>11.1f} "
+          f"{quantiles[9]:>8.0f} {quantiles[18]:>8.0f}")
+
+
+def main() -> None:
+    args = sys.argv[1:]
+    scales = int(args[0]) if len(args) > 0 else 32
+    seconds = float(args[1]) if len(args) > 1 else 5.0
+    base_ms = float(args[2]) if len(args) > 2 else 400.0
+    ms_per_image = float(args[3]) if len(args) > 3 else 40.0
+    max_in_flight = int(args[4]) if len(args) > 4 else 4
+    max_batch = int(args[5]) if len(args) > 5 else 8
+
+    print(f"{scales} scales for {seconds:.0f} s; fake call {base_ms:.0f} ms "
+          f"+ {ms_per_image:.0f} ms per extra image, at most "
+          f"{max_in_flight} calls in flight, {max_batch} images per batch")
+    print(f"{'mode':<16} {'scans/s':>9} {'calls':>7} {'images/call':>11} "
+          f"{'p50 ms':>8} {'p95 ms':>8}")
+    run("unbatched", scales, seconds,
+        QuotaModels(base_ms, ms_per_image, max_in_flight))
+    for window_ms in (20, 50, 100):
+        run(f"batched {window_ms} ms", scales, seconds,
+            QuotaModels(base_ms, ms_per_image, max_in_flight), window_ms,
+            max_batch)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+"""
+Benchmark of near-duplicate lookups in the perceptual-hash index.
+
+Fills a PerceptualIndex with random 64-bit hashes and times lookups of
+near-duplicates (a few flipped bits) and of unseen hashes. Also times the
+dHash computation itself on a synthetic camera-sized JPEG.
+
+Usage: python3 -m app.benchmarks.perceptual_lookup [entries] [queries]
+"""
+import io
+import random
+import sys
+import time
+from PIL import Image
+from app.src.services.perceptual_index import HASH_BITS, PerceptualIndex, dhash
+
+
+def flip_bits(value: int, count: int) -> int:
+    """
+    Returns value with count distinct random bits flipped.
+    """
+    for bit in random.sample(range(HASH_BITS), count):
+        value ^= 1 << bit
+    return value
+
+
+def percentile(samples, fraction: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def time_lookups(index: PerceptualIndex, hashes) -> list:
+    """
+    Returns the duration of each lookup in microseconds.
+    """
+    durations = []
+    for value in hashes:
+        start = time.perf_counter()
+        index.lookup(value, "bench")
+        durations.append((time.perf_counter() - start) * 1e6)
+    return durations
+
+
+def main() -> None:
+    entries = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    queries = int(sys.argv[2]) if len(sys.argv) > 2 else 5_000
+    random.seed(42)
+
+    index = PerceptualIndex(ttl=0, max_entries=entries)
+    stored = [random.getrandbits(HASH_BITS) for _ in range(entries)]
+    start = time.perf_counter()
+    for value in stored:
+        index.add(value, "bench", '{"fruit": "Banana"}')
+    print(f"Indexed {entries} hashes in {time.perf_counter() - start:.2f}s "
+          f"(max distance {index.max_distance})")
+
+    near = [flip_bits(random.choice(stored), index.max_distance)
+            for _ in range(queries)]
+    unseen = [random.getrandbits(HASH_BITS) for _ in range(queries)]
+
+    for label, hashes in (("near-duplicate", near), ("unseen", unseen)):
+        hits_before = index.hits
+        durations = time_lookups(index, hashes)
+        print(f"{label:<16} mean {sum(durations) / len(durations):7.1f} us"
+              f"   p99 {percentile(durations, 0.99):7.1f} us"
+              f"   hit rate {(index.hits - hits_before) / len(hashes):.1%}")
+
+    frame = Image.effect_noise((1920, 1080), 40).convert("RGB")
+    buffer = io.BytesIO()
+    frame.save(buffer, "JPEG", quality=90)
+    image_bytes = buffer.getvalue()
+    start = time.perf_counter()
+    for _ in range(20):
+        dhash(image_bytes)
+    print(f"dHash of a 1920x1080 JPEG: "
+          f"{(time.perf_counter() - start) / 20 * 1e3:.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+"""
+Benchmark of picklist startup time and memory: JSON loader vs. snapshot.
+
+Generates a synthetic national catalogue and builds a worker's
+MatchingService from it, each time in a fresh process, with:
+
+- json: the previous loader (json.load into one dict-backed Product
+  dataclass per row), with the PLU dict and the n-gram ProductIndex
+  MatchingService builds over a list;
+- snapshot (cold): PicklistRepository with no snapshot yet, which parses
+  the JSON and writes the binary snapshot, n-gram index included;
+- snapshot (warm): PicklistRepository memory-mapping the snapshot, as
+  every worker does after the first; MatchingService searches it
+  directly.
+
+Reports the startup time (loading plus MatchingService construction),
+the private (anonymous) memory they add to the process and the
+file-backed memory, which worker processes share through the page
+cache, then the time of PLU lookups and of first-time name searches.
+
+Usage: python3 -m app.benchmarks.picklist_store [products]
+"""
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from dataclasses import dataclass
+
+
+VARIETIES = ["Gala", "Fuji", "Reineta", "Golden", "Bio", "Extra",
+             "Calibre 1", "Calibre 2", "Nacional", "Importada"]
+FRUITS = ["Maçã", "Pêra", "Banana", "Laranja", "Tangerina", "Kiwi",
+          "Manga", "Ananás", "Melão", "Uva", "Tomate", "Batata"]
+
+
+@dataclass
+class LegacyProduct:
+    """
+    The Product model as the previous loader built it (no __slots__).
+    """
+    fruit: str
+    plu: int
+    price: float
+
+
+def memory_kib() -> dict:
+    """
+    Anonymous and file-backed resident memory of this process (Linux).
+    """
+    values = {"RssAnon": 0, "RssFile": 0}
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                key = line.split(":")[0]
+                if key in values:
+                    values[key] = int(line.split()[1])
+    except OSError:
+        pass
+    return values
+
+
+def measure(mode: str, path: str) -> None:
+    """
+    Builds a MatchingService once and prints the measurements as JSON.
+    """
+    from app.src.repositories.picklist_repository import PicklistRepository
+    from app.src.services.matching_service import MatchingService
+
+    before = memory_kib()
+    start = time.perf_counter()
+    if mode == "json":
+        with open(path) as f:
+            data = json.load(f)
+        products = [LegacyProduct(item["fruit"], int(item["PLU"]),
+                                  float(item["Price"])) for item in data]
+    else:
+        products = PicklistRepository(path).load()
+    matching_service = MatchingService(products)
+    elapsed = time.perf_counter() - start
+    after = memory_kib()
+
+    plus = [random.randrange(10_000, 10_000 + 2 * len(products))
+            for _ in range(100_000)]
+    start = time.perf_counter()
+    for plu in plus:
+        matching_service.get_by_plu(plu)
+    lookup_us = (time.perf_counter() - start) / len(plus) * 1e6
+
+    # Distinct queries, so none is answered by the memo
+    queries = [f"{fruit} {variety}" for fruit in FRUITS
+               for variety in VARIETIES]
+    start = time.perf_counter()
+    for query in queries:
+        matching_service.index.search(query)
+    search_us = (time.perf_counter() - start) / len(queries) * 1e6
+
+    print(json.dumps({
+        "load_ms": elapsed * 1000,
+        "anon_kib": after["RssAnon"] - before["RssAnon"],
+        "file_kib": after["RssFile"] - before["RssFile"],
+        "lookup_us": lookup_us,
+        "search_us": search_us,
+    }))
+
+
+def run(mode: str, path: str) -> dict:
+    output = subprocess.run(
+        [sys.executable, "-m", "app.benchmarks.picklist_store",
+         "--measure", mode, path],
+        capture_output=True, text=True, check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main() -> None:
+    if len(sys.argv) > 1 and sys.argv[1] == "--measure":
+        measure(sys.argv[2], sys.argv[3])
+        return
+
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200_000
+    random.seed(42)
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "picklist.json")
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump([{"fruit": f"{random.choice(FRUITS)} "
+                                 f"{random.choice(VARIETIES)} {i}",
+                        "PLU": 10_000 + i,
+                        "Price": round(random.uniform(0.3, 9.9), 2)}
+                       for i in range(count)], f, ensure_ascii=False)
+        print(f"{count} products, JSON {os.path.getsize(path) / 1e6:.1f} MB")
+        print(f"{'loader':<18} {'startup ms':>10} {'private MiB':>12} "
+              f"{'shared MiB':>11} {'PLU lookup us':>14} "
+              f"{'search us':>10}")
+
+        for label, mode in (("json", "json"),
+                            ("snapshot (cold)", "snapshot"),
+                            ("snapshot (warm)", "snapshot")):
+            result = run(mode, path)
+            print(f"{label:<18} {result['load_ms']:>10.0f} "
+                  f"{result['anon_kib'] / 1024:>12.1f} "
+                  f"{result['file_kib'] / 1024:>11.1f} "
+                  f"{result['lookup_us']:>14.2f} "
+                  f"{result['search_us']:>10.1f}")
+        print(f"Snapshot {os.path.getsize(path + '.snapshot') / 1e6:.1f} MB")
+
+
+if __name__ == "__main__":
+    main()
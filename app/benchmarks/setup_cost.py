@@ -0,0 +1,80 @@
+"""
+Benchmark of the per-request setup cost of the classify flow.
+
+Compares building every service on each request (the previous behaviour
+of ``scale_ui.views.classify``) with fetching them from the process-wide
+``ServiceContainer``. No request is sent to Gemini.
+
+Usage: python3 -m app.benchmarks.setup_cost [iterations]
+"""
+import os
+import sys
+import time
+
+# The Gemini client refuses to build without a key; no call is made.
+os.environ.setdefault("GEMINI_API_KEY", "benchmark-key")
+
+from google import genai  # noqa: E402
+from app.src.config.settings import settings  # noqa: E402
+from app.src.repositories.picklist_repository import PicklistRepository  # noqa: E402,E501
+from app.src.services.ai_service import AIService  # noqa: E402
+from app.src.services.matching_service import MatchingService  # noqa: E402
+from app.src.services.service_container import ServiceContainer  # noqa: E402
+
+
+def per_request_setup() -> None:
+    """
+    Builds everything the way the view did before the container existed.
+    """
+    products = PicklistRepository().load()
+    AIService()
+    MatchingService(products)
+    # analyze_image and refine_analysis each built their own client
+    genai.Client(api_key=settings.GEMINI_API_KEY)
+    genai.Client(api_key=settings.GEMINI_API_KEY)
+
+
+def container_setup(container: ServiceContainer) -> None:
+    """
+    Fetches the shared services the way the view does now.
+    """
+    ai_service = container.ai_service
+    container.matching_service
+    ai_service.client
+
+
+def main() -> None:
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+
+    # Silence the services' progress prints while measuring
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, "w")
+    try:
+        container = ServiceContainer()
+        container_setup(container)  # build the pooled client once
+        before = measure_silently(per_request_setup, iterations)
+        after = measure_silently(lambda: container_setup(container),
+                                 iterations)
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+    print(f"Iterations: {iterations}")
+    print(f"{'per-request setup (before)':<28} {before:>12.1f} us/request")
+    print(f"{'service container (after)':<28} {after:>12.1f} us/request")
+    if after > 0:
+        print(f"Speed-up: {before / after:.0f}x")
+
+
+def measure_silently(func, iterations: int) -> float:
+    """
+    Returns the mean cost of func in microseconds without printing.
+    """
+    start = time.perf_counter()
+    for _ in range(iterations):
+        func()
+    return (time.perf_counter() - start) / iterations * 1e6
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+"""
+Latency comparison of the two-call flow and the single-call mode.
+
+Scans an ambiguous item ("Maca" has three varieties) against a fake
+Gemini client whose latency grows with the prompt size, once with
+few_shot.txt (generic name, then a refine call) and once with
+shortlist.txt (PLU chosen from the compiled picklist in one call).
+
+Usage: python3 -m app.benchmarks.single_call [scans] [base_ms] [ms_per_kchar]
+"""
+import os
+import sys
+import time
+from types import SimpleNamespace
+
+os.environ.setdefault("GEMINI_API_KEY", "benchmark-key")
+
+from app.src.repositories.picklist_repository import PicklistRepository  # noqa: E402,E501
+from app.src.services.ai_service import AIService  # noqa: E402
+from app.src.services.matching_service import MatchingService  # noqa: E402
+from app.src.services.scan_service import ScanService  # noqa: E402
+
+
+class FakeModels:
+    """
+    Stands in for client.models, answering like the real model would.
+    """
+
+    def __init__(self, base_ms: float, ms_per_kchar: float):
+        self.base_ms = base_ms
+        self.ms_per_kchar = ms_per_kchar
+        self.calls = 0
+
+    def generate_content(self, model, contents, config=None):
+        prompt = contents[-1]
+        self.calls += 1
+        time.sleep((self.base_ms + self.ms_per_kchar * len(prompt) / 1000)
+                   / 1000)
+        if "Re-examine" in prompt or "PICKLIST" in prompt:
+            return SimpleNamespace(
+                text='{"fruit": "Maca Gala", "PLU": 51146, "Price": 0.85}')
+        return SimpleNamespace(text='{"fruit": "Maca"}')
+
+
+def run(prompt_path: str, scans: int, base_ms: float,
+        ms_per_kchar: float) -> None:
+    """
+    Scans with the given prompt and prints calls and latency per scan.
+    """
+    products = PicklistRepository().load()
+    models = FakeModels(base_ms, ms_per_kchar)
+    ai_service = AIService(prompt_path=prompt_path,
+                           client=SimpleNamespace(models=models))
+    ai_service.bind_picklist(products, "bench")
+    scan_service = ScanService(ai_service, MatchingService(products))
+
+    start = time.perf_counter()
+    for i in range(scans):
+        scan_service.scan(f"image {i}".encode())
+    mean_ms = (time.perf_counter() - start) / scans * 1e3
+    print(f"{os.path.basename(prompt_path):<18} {len(ai_service.prompt):>8} "
+          f"{models.calls / scans:>12.1f} {mean_ms:>12.1f}")
+
+
+def main() -> None:
+    scans = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    base_ms = float(sys.argv[2]) if len(sys.argv) > 2 else 800.0
+    ms_per_kchar = float(sys.argv[3]) if len(sys.argv) > 3 else 20.0
+
+    print(f"Fake latency: {base_ms:.0f} ms + {ms_per_kchar:.0f} ms per "
+          f"1000 prompt characters")
+    print(f"{'prompt':<18} {'chars':>8} {'calls/scan':>12} "
+          f"{'ms/scan':>12}")
+    run("app/prompts/few_shot.txt", scans, base_ms, ms_per_kchar)
+    run("app/prompts/shortlist.txt", scans, base_ms, ms_per_kchar)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+"""
+Benchmark of drop-folder watcher latency.
+
+Writes images into a temporary directory (slowly, in chunks, as a scale
+copying a file would) and measures the time between the writer closing
+each file and the watcher emitting it, for the previous 1 s listdir
+poller, the stable-size poller and inotify. The directory is pre-filled
+with files to show the per-tick cost of polling large folders.
+
+Usage: python3 -m app.benchmarks.watcher_latency [files] [existing]
+"""
+import os
+import sys
+import tempfile
+import threading
+import time
+from app.benchmarks.perceptual_lookup import percentile
+from app.src.services.file_service import FileService
+
+
+def legacy_watch(directory: str):
+    """
+    The previous FileService.watch_for_new_file loop, as a generator.
+    """
+    previous_files = set(os.listdir(directory))
+    while True:
+        time.sleep(1)
+        current_files = set(os.listdir(directory))
+        for file_name in current_files - previous_files:
+            full_path = os.path.abspath(os.path.join(directory, file_name))
+            if os.path.isfile(full_path):
+                yield full_path
+        previous_files = current_files
+
+
+def write_files(directory: str, count: int, closed_at: dict) -> None:
+    """
+    Writes count 64 KiB files in 4 chunks each, recording close times.
+    """
+    chunk = os.urandom(16 * 1024)
+    for i in range(count):
+        time.sleep(0.3)
+        path = os.path.abspath(os.path.join(directory, f"scan_{i}.jpg"))
+        with open(path, "wb") as f:
+            for _ in range(4):
+                f.write(chunk)
+                f.flush()
+                time.sleep(0.01)
+        closed_at[path] = time.perf_counter()
+
+
+def measure(label: str, watcher, directory: str, count: int) -> None:
+    """
+    Prints the close-to-emit latency of a watcher over count new files.
+    """
+    closed_at: dict = {}
+    writer = threading.Thread(target=write_files,
+                              args=(directory, count, closed_at))
+    writer.start()
+
+    latencies = []
+    incomplete = 0
+    for path in watcher:
+        emitted_at = time.perf_counter()
+        if path in closed_at:
+            latencies.append((emitted_at - closed_at[path]) * 1000)
+        else:
+            # Emitted while the writer was still writing it
+            incomplete += 1
+        if len(latencies) + incomplete == count:
+            break
+    watcher.close()
+    writer.join()
+
+    mean = sum(latencies) / len(latencies) if latencies else 0.0
+    p95 = percentile(latencies, 0.95) if latencies else 0.0
+    print(f"{label:<16} mean {mean:7.1f} ms   p95 {p95:7.1f} ms"
+          f"   emitted before complete {incomplete}/{count}")
+
+
+def main() -> None:
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    existing = int(sys.argv[2]) if len(sys.argv) > 2 else 10_000
+
+    runs = [("legacy listdir", legacy_watch),
+            ("poll", lambda d: FileService(d, backend="poll").watch())]
+    if FileService(tempfile.gettempdir(), backend="auto").backend == "inotify":
+        runs.append(("inotify",
+                     lambda d: FileService(d, backend="inotify").watch()))
+    else:
+        print("inotify is not available on this system")
+
+    for label, make_watcher in runs:
+        with tempfile.TemporaryDirectory() as directory:
+            for i in range(existing):
+                open(os.path.join(directory, f"old_{i}.jpg"), "wb").close()
+            if label == "poll":
+                start = time.perf_counter()
+                FileService(directory, backend="poll")._scan()
+                print(f"One polling tick over {existing} files: "
+                      f"{(time.perf_counter() - start) * 1000:.1f} ms")
+            measure(label, make_watcher(directory), directory, count)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,90 +1,76 @@
-import sys
+import argparse
+import os
 import time
+from typing import Optional
+from app.src.config.settings import settings
+from app.src.services.batch_service import BatchService
 from app.src.services.file_service import FileService
-from app.src.services.ai_service import AIService
-from app.src.services.matching_service import MatchingService
-from app.src.repositories.picklist_repository import PicklistRepository
+from app.src.services.history_writer import HistoryWriter
+from app.src.services.rate_limiter import BATCH
+from app.src.services.scan_service import ScanService
+from app.src.services.service_container import get_container
 
 
-def main() -> None:
-    """
-    Main function to orchestrate the fresh produce recognition agent.
-    Refactored to use Clean Architecture principles.
+def process_image(scan_service: ScanService, image_path: str,
+                  history: Optional[HistoryWriter] = None) -> None:
     """
+    Classifies one image dropped in the watched directory and prints the
+    suggested products.
 
-    # 1. Validate Arguments
-    try:
-        path_to_watch = sys.argv[1]
-        print("Path received [✅]")
-    except IndexError:
-        print("Error: Missing argument.",
-              "\nUsage: python3 -m app.main <relative/dir/>")
-        return
-
-    # 2. Initialize Components
-
-    # Repository & Data
-    picklist_repo = PicklistRepository()
-    picklist_products = picklist_repo.load()
-    if picklist_products:
-        print("Picklist found [✅]")
-    else:
-        print("Warning: Picklist could not be loaded or is empty.")
-
-    # Services
-    ai_service = AIService()
-    matching_service = MatchingService(picklist_products)
-    file_service = FileService(path_to_watch)
-
-    # 3. Watch Directory
-    print(f"Began watching {path_to_watch} [✅]")
-    new_image_path = file_service.watch_for_new_file()
-
-    if new_image_path is None:
-        print("Error at Watching File")
-        return
-
-    # 4. Processing
+    Args:
+        scan_service: The scan orchestrator.
+        image_path: Full path of the new image.
+        history: Optional scan history the result is queued to.
+    """
+    detected_at = time.time()
     latency_start = time.perf_counter()
 
     try:
-        with open(new_image_path, "rb") as file:
+        with open(image_path, "rb") as file:
+            print(f"New image {os.path.basename(image_path)} [✅]")
+            # Time from the last write to the watcher noticing the file
+            watch_latency = max(0.0, detected_at - os.fstat(file.fileno())
+                                .st_mtime)
             print("Asked Agent for classification [✅]")
             image_bytes = file.read()
-
-            # Retry logic
-            while True:
-                agent_output = ai_service.analyze_image(image_bytes)
-                if "Error" in agent_output and "Exception" in agent_output:
-                    print("Error during analysis. Trying again...")
-                    time.sleep(1)
-                    continue
-                break
-
     except Exception as e:
         print(f"Error reading image: {e}")
         return
 
-    if not agent_output or "Error" in agent_output:
+    result = scan_service.scan(image_bytes)
+    if history is not None:
+        history.record(result, "watch")
+    agent_output = result.agent_output
+    if result.near_duplicate:
+        print("Reused classification of a near-identical image [✅]")
+    elif result.from_cache:
+        print("Classification served from cache [✅]")
+    elif result.classified_locally:
+        print("Classified locally without calling the agent [✅]")
+
+    if result.error:
         # Fallback/Error output
         print('{"fruit": "NA", "PLU": "NA", "Price": "NA"}')
-        if "Error" in agent_output:
-            print(f"Debug: {agent_output}")
+        print(f"Debug: {result.error}")
         return
 
-    # 5. Matching logic
+    # Matching logic
     print("Analysing our Picklist for suggestion [✅]")
 
-    matches = matching_service.find_matches(agent_output)
+    matches = result.matches
 
     if len(matches) > 1:
-        print("Recalling to improve output [✅]")
-        refined_output = matching_service.refine_match(ai_service, matches)
+        if result.resolved_locally:
+            print("Resolved locally without recalling [✅]")
+        else:
+            print("Recalling to improve output [✅]")
+        refined_output = result.refined_output
         print("List retrieved [✅]")
-        # Try to parse the refined output to ensure it's a list or dict
-        print(refined_output)
-        if not refined_output:
-            print("Item not found")
+        if refined_output:
+            print(refined_output)
+        else:
+            # Refinement failed: best ranked candidate
+            print(matches[0].to_dict())
 
     elif not matches:
         print("Item not found")
@@ -94,7 +80,95 @@ def main() -> None:
         # Output format matching original expectation (list of dicts)
         print([p.to_dict() for p in matches])
 
-    print(f"Latency: {time.perf_counter() - latency_start:.2f} seconds")
+    print(f"Latency: {time.perf_counter() - latency_start:.2f} seconds "
+          f"(+{watch_latency * 1000:.0f} ms watcher)")
+    print("Stages: " + ", ".join(f"{stage} {ms:.0f} ms"
+                                 for stage, ms in result.timings.items()))
+
+
+def run_batch(source: str, output_path: str, workers: int) -> None:
+    """
+    Classifies a backlog of images concurrently into a JSONL file.
+
+    Args:
+        source: Directory or glob pattern of the images.
+        output_path: JSONL file of the results; an existing file is
+            resumed.
+        workers: Maximum number of images classified at once.
+    """
+    container = get_container()
+    # Backlog work yields the shared quota to live scans
+    batch_service = BatchService(
+        lambda: container.build_scan_service(priority=BATCH), output_path,
+        workers, history=container.history)
+    paths = batch_service.collect(source)
+    if not paths:
+        print(f"Error: No images found in {source}")
+        return
+
+    print(f"Classifying {len(paths)} images with {batch_service.workers} "
+          f"workers into {output_path} [✅]")
+    report = batch_service.run(paths)
+    print(f"Done: {report.succeeded} classified, {report.failed} failed, "
+          f"{report.skipped} already done [✅]")
+    print(f"Throughput: {report.throughput:.2f} images/second "
+          f"({report.processed} in {report.elapsed:.1f} seconds)")
+
+
+def main() -> None:
+    """
+    Main function to orchestrate the fresh produce recognition agent.
+    Refactored to use Clean Architecture principles.
+
+    Runs as a daemon: every image dropped in the directory is classified
+    until the process is interrupted. With --batch, classifies the images
+    already in a directory (or matching a glob) and exits.
+    """
+
+    # 1. Validate Arguments
+    parser = argparse.ArgumentParser(
+        prog="python3 -m app.main",
+        description="Fresh produce recognition agent.")
+    parser.add_argument("path", help="directory to watch, or with --batch "
+                                     "a directory or glob of images")
+    parser.add_argument("--batch", action="store_true",
+                        help="classify the existing images and exit")
+    parser.add_argument("--output", default="batch_results.jsonl",
+                        help="JSONL file of the batch results (resumed if "
+                             "it exists)")
+    parser.add_argument("--workers", type=int,
+                        default=settings.BATCH_WORKERS,
+                        help="images classified at once in batch mode")
+    args = parser.parse_args()
+    path_to_watch = args.path
+    print("Path received [✅]")
+
+    # 2. Initialize Components
+
+    # Repository, Data & Services
+    container = get_container()
+    if container.products:
+        print("Picklist found [✅]")
+    else:
+        print("Warning: Picklist could not be loaded or is empty.")
+
+    if args.batch:
+        run_batch(path_to_watch, args.output, args.workers)
+        return
+
+    file_service = FileService(path_to_watch)
+
+    # 3. Watch Directory and process every new image
+    print(f"Began watching {path_to_watch} "
+          f"({file_service.backend}) [✅]")
+    try:
+        for image_path in file_service.watch():
+            # Picks up picklist and prompt edits between scans. Retries
+            # back off and give up at the scan deadline (RETRY_DEADLINE)
+            scan_service = container.build_scan_service()
+            process_image(scan_service, image_path, container.history)
+    except KeyboardInterrupt:
+        print("Stopped watching [✅]")
 
 
 if __name__ == "__main__":
@@ -1,14 +1,174 @@
 import os
+from pathlib import Path
 from dotenv import load_dotenv
 
 load_dotenv()
 
+# The project root, where Django keeps db.sqlite3; relative paths of files
+# shared between processes are resolved against it, so every entry point
+# uses the same ones whatever its working directory
+BASE_DIR = Path(__file__).resolve().parents[3]
+
+
+def project_path(path: str) -> str:
+    """
+    Resolves a relative path against BASE_DIR; empty stays empty.
+    """
+    return str(BASE_DIR / path) if path else ""
+
 
 class Settings:
     GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
     PROMPT_PATH = os.getenv("PROMPT", "app/prompts/few_shot.txt")
     PICKLIST_PATH = os.getenv("PICKLIST_PATH", "app/data/picklist.json")
+    # Memory-mapped binary copy of the picklist (empty path: next to it)
+    PICKLIST_SNAPSHOT_ENABLED = os.getenv("PICKLIST_SNAPSHOT_ENABLED",
+                                          "1") == "1"
+    PICKLIST_SNAPSHOT_PATH = os.getenv("PICKLIST_SNAPSHOT_PATH", "")
+    # "sqlite" reads the picklist live from PICKLIST_DB_PATH (the Django
+    # database by default), filled with `manage.py import_picklist`
+    PICKLIST_BACKEND = os.getenv("PICKLIST_BACKEND", "json")
+    PICKLIST_DB_PATH = project_path(os.getenv("PICKLIST_DB_PATH",
+                                              "db.sqlite3"))
     AGENT_MODEL = "gemini-3-flash-preview"
+    # JSON response schema of model calls (PLUs enum-constrained to the
+    # shortlist or to the refine candidates)
+    RESPONSE_SCHEMA_ENABLED = os.getenv("RESPONSE_SCHEMA_ENABLED",
+                                        "1") == "1"
+
+    # "fake" answers locally without spending API quota (benchmarks, tests).
+    # FAKE_LATENCY_DIST: fixed, uniform, exponential or lognormal (median
+    # FAKE_LATENCY_MS, shape FAKE_LATENCY_SIGMA); FAKE_RESPONSES_PATH: JSON
+    # file of answers per prompt kind (see fake_genai_client.py)
+    GEMINI_BACKEND = os.getenv("GEMINI_BACKEND", "gemini")
+    FAKE_LATENCY_MS = float(os.getenv("FAKE_LATENCY_MS", "500"))
+    FAKE_LATENCY_DIST = os.getenv("FAKE_LATENCY_DIST", "fixed")
+    FAKE_LATENCY_SIGMA = float(os.getenv("FAKE_LATENCY_SIGMA", "0.5"))
+    FAKE_ERROR_RATE = float(os.getenv("FAKE_ERROR_RATE", "0.0"))
+    FAKE_RESPONSES_PATH = os.getenv("FAKE_RESPONSES_PATH", "")
+    # Appends every answered model call (answer, tokens, latency) to this
+    # JSONL corpus, replayed offline by `manage.py replay_prompts`
+    RECORD_CALLS_PATH = os.getenv("RECORD_CALLS_PATH", "")
+
+    # Retries of model calls and circuit breaker (RETRY_DEADLINE is the
+    # overall budget of one scan, in seconds)
+    RETRY_MAX_ATTEMPTS = int(os.getenv("RETRY_MAX_ATTEMPTS", "4"))
+    RETRY_BASE_DELAY = float(os.getenv("RETRY_BASE_DELAY", "0.5"))
+    RETRY_MAX_DELAY = float(os.getenv("RETRY_MAX_DELAY", "8"))
+    RETRY_DEADLINE = float(os.getenv("RETRY_DEADLINE", "20"))
+    BREAKER_FAILURE_THRESHOLD = int(os.getenv("BREAKER_FAILURE_THRESHOLD",
+                                              "5"))
+    BREAKER_RESET_TIMEOUT = float(os.getenv("BREAKER_RESET_TIMEOUT", "30"))
+
+    # The classify view sends the result page at once and fills it in as
+    # the scan progresses: fruit and candidates after the first model call,
+    # the product once refined (0: one response when the scan is done)
+    STREAM_RESULTS_ENABLED = os.getenv("STREAM_RESULTS_ENABLED", "1") == "1"
+
+    # Stage histograms exposed at /metrics/ and in Server-Timing headers
+    METRICS_ENABLED = os.getenv("METRICS_ENABLED", "1") == "1"
+
+    # Seconds between mtime checks of the picklist and prompt files
+    RELOAD_CHECK_INTERVAL = float(os.getenv("RELOAD_CHECK_INTERVAL", "1.0"))
+
+    # Drop-folder watcher of app/main.py ("auto" uses inotify when available
+    # and falls back to polling); files are emitted once fully written
+    WATCH_BACKEND = os.getenv("WATCH_BACKEND", "auto")
+    WATCH_POLL_INTERVAL = float(os.getenv("WATCH_POLL_INTERVAL", "0.1"))
+    WATCH_SETTLE_TIME = float(os.getenv("WATCH_SETTLE_TIME", "0.2"))
+
+    # Token bucket on model calls shared by every process through a SQLite
+    # file (RATE_LIMIT_PER_MINUTE=0 disables it). Interactive scans are
+    # admitted before batch ones; a call waiting longer than its class's
+    # maximum wait, or finding RATE_LIMIT_MAX_QUEUE calls queued, is shed
+    RATE_LIMIT_PER_MINUTE = float(os.getenv("RATE_LIMIT_PER_MINUTE", "0"))
+    RATE_LIMIT_BURST = int(os.getenv("RATE_LIMIT_BURST", "10"))
+    RATE_LIMIT_DB_PATH = project_path(os.getenv("RATE_LIMIT_DB_PATH",
+                                                "rate_limit.sqlite3"))
+    RATE_LIMIT_INTERACTIVE_WAIT = float(os.getenv(
+        "RATE_LIMIT_INTERACTIVE_WAIT", "5"))
+    RATE_LIMIT_BATCH_WAIT = float(os.getenv("RATE_LIMIT_BATCH_WAIT", "60"))
+    RATE_LIMIT_MAX_QUEUE = int(os.getenv("RATE_LIMIT_MAX_QUEUE", "256"))
+
+    # Backup analyze call when the first one is slower than HEDGE_PERCENTILE
+    # of the last HEDGE_WINDOW calls (HEDGE_INITIAL_DELAY_MS until
+    # HEDGE_MIN_SAMPLES were seen), for at most HEDGE_BUDGET of the calls
+    HEDGE_ENABLED = os.getenv("HEDGE_ENABLED", "0") == "1"
+    HEDGE_PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", "95"))
+    HEDGE_BUDGET = float(os.getenv("HEDGE_BUDGET", "0.05"))
+    HEDGE_WINDOW = int(os.getenv("HEDGE_WINDOW", "1000"))
+    HEDGE_MIN_SAMPLES = int(os.getenv("HEDGE_MIN_SAMPLES", "50"))
+    HEDGE_INITIAL_DELAY_MS = float(os.getenv("HEDGE_INITIAL_DELAY_MS",
+                                             "2000"))
+    HEDGE_MIN_DELAY_MS = float(os.getenv("HEDGE_MIN_DELAY_MS", "50"))
+    HEDGE_WORKERS = int(os.getenv("HEDGE_WORKERS", "32"))
+
+    # Concurrent scans of the batch mode of app/main.py
+    BATCH_WORKERS = int(os.getenv("BATCH_WORKERS", "8"))
+
+    # History of every scan, written behind the response by a background
+    # thread in batches into the project's database. Live scans never wait:
+    # with HISTORY_MAX_QUEUE records pending, theirs are dropped and
+    # counted; batch runs wait up to HISTORY_BATCH_WAIT seconds instead.
+    # The thread lingers HISTORY_LINGER_MS after a scan for others to join
+    # its transaction
+    HISTORY_ENABLED = os.getenv("HISTORY_ENABLED", "1") == "1"
+    HISTORY_DB_PATH = project_path(os.getenv("HISTORY_DB_PATH",
+                                             "db.sqlite3"))
+    HISTORY_MAX_QUEUE = int(os.getenv("HISTORY_MAX_QUEUE", "10000"))
+    HISTORY_BATCH_SIZE = int(os.getenv("HISTORY_BATCH_SIZE", "500"))
+    HISTORY_LINGER_MS = float(os.getenv("HISTORY_LINGER_MS", "50"))
+    HISTORY_BATCH_WAIT = float(os.getenv("HISTORY_BATCH_WAIT", "5"))
+
+    # Classification cache (empty CACHE_DB_PATH keeps it in memory only)
+    CACHE_ENABLED = os.getenv("CACHE_ENABLED", "1") == "1"
+    CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", "1024"))
+    CACHE_TTL = float(os.getenv("CACHE_TTL", "3600"))
+    CACHE_DB_PATH = project_path(os.getenv("CACHE_DB_PATH", ""))
+
+    # Analyze calls of concurrent scans arriving within the window are sent
+    # together as one multi-image call of at most MICRO_BATCH_MAX_SIZE
+    MICRO_BATCH_ENABLED = os.getenv("MICRO_BATCH_ENABLED", "0") == "1"
+    MICRO_BATCH_WINDOW_MS = float(os.getenv("MICRO_BATCH_WINDOW_MS", "50"))
+    MICRO_BATCH_MAX_SIZE = int(os.getenv("MICRO_BATCH_MAX_SIZE", "8"))
+    MICRO_BATCH_WORKERS = int(os.getenv("MICRO_BATCH_WORKERS", "4"))
+
+    # Concurrent scans of the same image share one classification (a
+    # SINGLE_FLIGHT_LOCK_DIR also serializes them across worker processes,
+    # which then share the answer through CACHE_DB_PATH)
+    SINGLE_FLIGHT_ENABLED = os.getenv("SINGLE_FLIGHT_ENABLED", "1") == "1"
+    SINGLE_FLIGHT_LOCK_DIR = project_path(
+        os.getenv("SINGLE_FLIGHT_LOCK_DIR", ""))
+
+    # Near-duplicate reuse of recent scans by perceptual hash
+    PHASH_ENABLED = os.getenv("PHASH_ENABLED", "1") == "1"
+    PHASH_MAX_DISTANCE = int(os.getenv("PHASH_MAX_DISTANCE", "4"))
+    PHASH_TTL = float(os.getenv("PHASH_TTL", "300"))
+    PHASH_MAX_ENTRIES = int(os.getenv("PHASH_MAX_ENTRIES", "100000"))
+    # Fraction of near-duplicate hits re-checked against the model
+    PHASH_AUDIT_RATE = float(os.getenv("PHASH_AUDIT_RATE", "0.0"))
+
+    # Local disambiguation between candidates before the refine call
+    LOCAL_RESOLVE_ENABLED = os.getenv("LOCAL_RESOLVE_ENABLED", "1") == "1"
+    LOCAL_RESOLVE_MARGIN = float(os.getenv("LOCAL_RESOLVE_MARGIN", "0.25"))
+    LOCAL_PRIOR_WEIGHT = float(os.getenv("LOCAL_PRIOR_WEIGHT", "0.2"))
+    LOCAL_PRIORS_PATH = os.getenv("LOCAL_PRIORS_PATH", "")
+
+    # CPU colour/texture kNN answering confident scans without the model,
+    # trained with `manage.py train_classifier` (empty path disables it)
+    LOCAL_CLASSIFIER_PATH = os.getenv("LOCAL_CLASSIFIER_PATH", "")
+    LOCAL_CLASSIFIER_THRESHOLD = float(os.getenv(
+        "LOCAL_CLASSIFIER_THRESHOLD", "0.9"))
+
+    # Entries listed in single-call prompts (app/prompts/shortlist.txt)
+    SHORTLIST_MAX_ENTRIES = int(os.getenv("SHORTLIST_MAX_ENTRIES", "150"))
+
+    # Image preprocessing before upload (PREPROCESS_CROP=1.0 keeps it all)
+    PREPROCESS_ENABLED = os.getenv("PREPROCESS_ENABLED", "1") == "1"
+    PREPROCESS_MAX_SIDE = int(os.getenv("PREPROCESS_MAX_SIDE", "1024"))
+    PREPROCESS_FORMAT = os.getenv("PREPROCESS_FORMAT", "JPEG")
+    PREPROCESS_QUALITY = int(os.getenv("PREPROCESS_QUALITY", "85"))
+    PREPROCESS_CROP = float(os.getenv("PREPROCESS_CROP", "1.0"))
 
 
-settings = Settings()
\ No newline at end of file
+settings = Settings()
@@ -0,0 +1,42 @@
+from dataclasses import dataclass
+from typing import Optional
+
+
+@dataclass
+class AnalysisResult:
+    """
+    Outcome of one model call.
+
+    Either text holds the model's answer, or error describes why the call
+    failed and retryable says whether trying again may succeed.
+    parse_error marks answers that were not the JSON asked for. sent is
+    False for calls refused before reaching the backend.
+    """
+    text: str = ""
+    error: Optional[str] = None
+    retryable: bool = False
+    parse_error: bool = False
+    sent: bool = True
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+    @classmethod
+    def failure(cls, error: str, retryable: bool = False,
+                parse_error: bool = False,
+                sent: bool = True) -> 'AnalysisResult':
+        """
+        Creates a failed result.
+
+        Args:
+            error: Description of the failure.
+            retryable: Whether trying again may succeed.
+            parse_error: Whether the model answered with invalid output.
+            sent: Whether the call reached the backend.
+
+        Returns:
+            A new AnalysisResult without text.
+        """
+        return cls(error=error, retryable=retryable,
+                   parse_error=parse_error, sent=sent)
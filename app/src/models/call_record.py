@@ -0,0 +1,51 @@
+from dataclasses import asdict, dataclass, field
+from typing import Any, Dict, List, Optional
+
+
+@dataclass
+class CallRecord:
+    """
+    One recorded model call: what was asked, and what came back.
+
+    key identifies the request (model, images and prompt text), so a
+    replay answers the same request with the same answer. The images and
+    the prompt are kept as hashes only.
+    """
+    key: str
+    model: str
+    text: str
+    images: List[str] = field(default_factory=list)
+    prompt_hash: str = ""
+    prompt_tokens: Optional[int] = None
+    response_tokens: Optional[int] = None
+    latency_ms: float = 0.0
+    recorded_at: float = 0.0
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> 'CallRecord':
+        """
+        Creates a CallRecord from a line of a corpus.
+
+        Args:
+            data: A dictionary with at least 'key', 'model' and 'text'.
+
+        Returns:
+            A new CallRecord instance.
+        """
+        return cls(
+            key=data["key"],
+            model=data["model"],
+            text=data["text"],
+            images=list(data.get("images", [])),
+            prompt_hash=data.get("prompt_hash", ""),
+            prompt_tokens=data.get("prompt_tokens"),
+            response_tokens=data.get("response_tokens"),
+            latency_ms=float(data.get("latency_ms", 0.0)),
+            recorded_at=float(data.get("recorded_at", 0.0)),
+        )
+
+    def to_dict(self) -> Dict[str, Any]:
+        """
+        Converts the record to a line of a corpus.
+        """
+        return asdict(self)
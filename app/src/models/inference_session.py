@@ -0,0 +1,39 @@
+from dataclasses import dataclass, field
+from typing import List, Optional
+from app.src.models.product import Product
+from app.src.services.rate_limiter import INTERACTIVE
+
+
+@dataclass
+class InferenceSession:
+    """
+    State of one scan through the model calls.
+
+    Carries the image and the intermediate results from analyze_image()
+    to find_matches() and refine_match(), so the services themselves keep
+    no per-request state and can be shared by concurrent scans. Closing
+    the session releases the image as soon as the scan completes. The
+    priority class of the scan orders its calls in the rate limiter.
+    """
+    image_bytes: bytes
+    mime_type: str = 'image/png'
+    priority: str = INTERACTIVE
+    agent_output: Optional[str] = None
+    matches: List[Product] = field(default_factory=list)
+    refined_output: Optional[str] = None
+
+    @property
+    def closed(self) -> bool:
+        return not self.image_bytes
+
+    def close(self) -> None:
+        """
+        Drops the image; the results stay readable.
+        """
+        self.image_bytes = b""
+
+    def __enter__(self) -> "InferenceSession":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
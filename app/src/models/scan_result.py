@@ -0,0 +1,83 @@
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional
+from app.src.models.product import Product
+from app.src.services.output_parser import ParseError, parse_answer
+
+
+@dataclass
+class ScanResult:
+    """
+    Outcome of classifying one image against the picklist.
+
+    timings maps each stage the scan went through (cache, preprocess,
+    hash, local, analyze, match, refine) to its duration in milliseconds,
+    and "scan" to the duration of the whole scan. image_digest is the
+    SHA-256 of the uploaded image, set by the scan service.
+    """
+    agent_output: str = ""
+    matches: List[Product] = field(default_factory=list)
+    refined_output: Optional[str] = None
+    from_cache: bool = False
+    near_duplicate: bool = False
+    resolved_locally: bool = False
+    classified_locally: bool = False
+    coalesced: bool = False
+    error: Optional[str] = None
+    timings: Dict[str, float] = field(default_factory=dict)
+    image_digest: Optional[str] = None
+
+    @property
+    def outcome(self) -> str:
+        """
+        How the scan was answered, as counted in the metrics.
+        """
+        if self.error:
+            return "error"
+        if self.coalesced:
+            return "coalesced"
+        if self.near_duplicate:
+            return "near_duplicate"
+        if self.from_cache:
+            return "cache_hit"
+        if self.classified_locally:
+            return "local_classifier"
+        if self.resolved_locally:
+            return "resolved_locally"
+        return "model"
+
+    @property
+    def confirmed(self) -> bool:
+        """
+        Whether the model itself gave the answer in this scan: a single
+        match, or the candidate its refine call picked. Fallbacks after a
+        failed refinement, local guesses and reused answers are not.
+        """
+        if self.outcome != "model" or not self.matches:
+            return False
+        if len(self.matches) == 1:
+            return True
+        try:
+            plu = str(parse_answer(self.refined_output or "").get("PLU"))
+        except ParseError:
+            return False
+        return any(str(product.plu) == plu for product in self.matches)
+
+    def best_match(self) -> Optional[Dict[str, Any]]:
+        """
+        Returns the product to suggest, as a picklist entry.
+
+        The candidate the refined output picked when there were several,
+        with its picklist price; otherwise (or if the refined output names
+        no candidate) the best ranked candidate. None when nothing matched.
+        """
+        if len(self.matches) > 1 and self.refined_output:
+            try:
+                plu = str(parse_answer(self.refined_output).get("PLU"))
+            except ParseError:
+                plu = None
+            for product in self.matches:
+                if str(product.plu) == plu:
+                    return product.to_dict()
+        if self.matches:
+            return self.matches[0].to_dict()
+        return None
@@ -1,28 +1,88 @@
 import json
 import os
-from typing import List
+from typing import List, Optional, Tuple
 from app.src.models.product import Product
+from app.src.repositories.picklist_store import (
+    PicklistStore,
+    build_snapshot,
+    open_snapshot,
+    write_snapshot,
+)
 from app.src.config.settings import settings
 
 
 class PicklistRepository:
     """
     Handles loading and accessing the product picklist from a JSON file.
+
+    The JSON file is the source of truth. It is compiled into a binary
+    snapshot next to it, which later loads (and every worker process)
+    memory-map instead of parsing the JSON again. The snapshot is rebuilt
+    whenever the JSON file's mtime or size changes.
     """
 
-    def __init__(self, file_path: str = settings.PICKLIST_PATH):
+    def __init__(self, file_path: str = settings.PICKLIST_PATH,
+                 snapshot_path: Optional[str] = None):
         """
         Initializes the repository with a file path.
 
         Args:
             file_path: Path to the JSON picklist file.
+            snapshot_path: Path of the binary snapshot. Defaults to
+                PICKLIST_SNAPSHOT_PATH, or the JSON path + ".snapshot".
+                An empty string disables the snapshot file.
         """
         self.file_path = file_path
+        if snapshot_path is None:
+            snapshot_path = (settings.PICKLIST_SNAPSHOT_PATH
+                             or f"{file_path}.snapshot")
+            if not settings.PICKLIST_SNAPSHOT_ENABLED:
+                snapshot_path = ""
+        self.snapshot_path = snapshot_path
+
+    def _stamp(self) -> Optional[Tuple[int, int]]:
+        try:
+            stat = os.stat(self.file_path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
 
-    def load(self) -> List[Product]:
+    def load(self) -> PicklistStore:
         """
         Loads the picklist from the configured file path.
 
+        Returns:
+            The picklist as a read-only sequence of Product objects, empty
+            if the file is missing or invalid.
+        """
+        stamp = self._stamp()
+        if stamp is None:
+            print(f"Error: Picklist file not found at {self.file_path}")
+            return PicklistStore.from_products([])
+
+        if self.snapshot_path:
+            store = open_snapshot(self.snapshot_path)
+            if store is not None and store.source_stamp == stamp:
+                return store
+
+        products = self.load_products()
+        data = build_snapshot(products, stamp)
+        if self.snapshot_path and products:
+            try:
+                write_snapshot(self.snapshot_path, data)
+                store = open_snapshot(self.snapshot_path)
+                if store is not None:
+                    print(f"Picklist snapshot written to "
+                          f"{self.snapshot_path}")
+                    return store
+            except OSError as e:
+                print(f"Error writing picklist snapshot: {e}")
+        return PicklistStore(data)
+
+    def load_products(self) -> List[Product]:
+        """
+        Parses the JSON file into Product objects, bypassing the snapshot.
+
         Returns:
             A list of Product objects.
         """
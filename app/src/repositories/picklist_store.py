@@ -0,0 +1,372 @@
+import hashlib
+import json
+from bisect import bisect_left
+import mmap
+import os
+import struct
+import zlib
+from array import array
+from collections.abc import Sequence
+from typing import Dict, List, Optional, Set, Tuple, Union
+from app.src.models.product import Product
+from app.src.services.product_index import (
+    MEMO_SIZE,
+    ngrams,
+    normalize,
+    rank_candidates,
+    tie_break_order,
+)
+
+
+# Snapshot layout (little-endian, every section 8-byte aligned):
+#   header: magic, format version, reserved, product count, PLU table
+#           size, source mtime (ns), source size, content fingerprint,
+#           n-gram count, n-gram table size
+#   plus int64[count] | prices float64[count] | name offsets uint32[count+1]
+#   normalized name offsets uint32[count+1] | tie-break order int32[count]
+#   PLU table int32[table] | n-gram table int32[gram table]
+#   n-gram offsets uint32[grams+1] | posting offsets uint32[grams+1]
+#   postings int32[...] | UTF-8 names | normalized names | n-grams
+MAGIC = b"PLST"
+FORMAT_VERSION = 2
+HEADER = struct.Struct("<4sHHIIqq16sII")
+EMPTY_SLOT = -1
+# Multiplier of the Fibonacci hash of PLU codes
+PLU_HASH = 0x9E3779B1
+# Posting lists this many times longer than the candidates left are
+# searched by bisection rather than read whole
+BISECT_RATIO = 16
+
+
+def _aligned(size: int) -> int:
+    return (size + 7) & ~7
+
+
+def _table_size(count: int) -> int:
+    """
+    Returns the power-of-two size of an open-addressing table that stays
+    at most half full.
+    """
+    size = 8
+    while size < 2 * count:
+        size *= 2
+    return size
+
+
+def _plu_slot(plu: int, mask: int) -> int:
+    return (plu * PLU_HASH) & 0xFFFFFFFF & mask
+
+
+def _intersect(postings: List[memoryview]) -> Set[int]:
+    """
+    Returns the product ids present in every sorted posting list.
+
+    Once few candidates are left, they are looked up in the remaining
+    long lists by bisection instead of reading those lists whole.
+    """
+    postings = sorted(postings, key=len)
+    candidates = set(postings[0])
+    for posting in postings[1:]:
+        if not candidates:
+            break
+        size = len(posting)
+        if len(candidates) * BISECT_RATIO < size:
+            candidates = {i for i in candidates
+                          if (j := bisect_left(posting, i)) < size
+                          and posting[j] == i}
+        else:
+            candidates.intersection_update(posting)
+    return candidates
+
+
+def _offsets(strings: List[bytes]) -> array:
+    """
+    Returns the start of each string in their concatenation, and its end.
+    """
+    offsets = array("I", [0])
+    for string in strings:
+        offsets.append(offsets[-1] + len(string))
+    return offsets
+
+
+def _name_slot(name: str, mask: int) -> int:
+    # crc32 rather than hash(): the slot must not change between processes
+    return zlib.crc32(name.encode("utf-8")) & mask
+
+
+def fingerprint(products: List[Product]) -> str:
+    """
+    Returns a short hash identifying the content of a picklist.
+    """
+    data = json.dumps([p.to_dict() for p in products], sort_keys=True)
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()[:16]
+
+
+def build_snapshot(products: List[Product],
+                   source_stamp: Tuple[int, int] = (0, 0)) -> bytes:
+    """
+    Serializes a picklist into the binary snapshot format.
+
+    Args:
+        products: The picklist.
+        source_stamp: (mtime in ns, size) of the JSON file it came from.
+
+    Returns:
+        The snapshot bytes.
+    """
+    count = len(products)
+    table_size = _table_size(count)
+    mask = table_size - 1
+
+    plus = array("q", (p.plu for p in products))
+    prices = array("d", (p.price for p in products))
+    encoded = [p.fruit.encode("utf-8") for p in products]
+    names = [normalize(p.fruit) for p in products]
+    encoded_names = [name.encode("utf-8") for name in names]
+
+    plu_table = array("i", [EMPTY_SLOT]) * table_size
+    postings: Dict[str, array] = {}
+    for product_id, product in enumerate(products):
+        slot = _plu_slot(product.plu, mask)
+        while plu_table[slot] != EMPTY_SLOT:
+            if plus[plu_table[slot]] == product.plu:
+                break  # Duplicate PLU: the first row wins
+            slot = (slot + 1) & mask
+        else:
+            plu_table[slot] = product_id
+        for gram in ngrams(names[product_id]):
+            postings.setdefault(gram, array("i")).append(product_id)
+
+    # The n-gram index ProductIndex would build, stored flat: a hash
+    # table from each n-gram to its posting list
+    grams = list(postings)
+    gram_table_size = _table_size(len(grams))
+    gram_mask = gram_table_size - 1
+    gram_table = array("i", [EMPTY_SLOT]) * gram_table_size
+    encoded_grams = [gram.encode("utf-8") for gram in grams]
+    all_postings = array("i")
+    posting_offsets = array("I", [0])
+    for gram_id, gram in enumerate(grams):
+        slot = _name_slot(gram, gram_mask)
+        while gram_table[slot] != EMPTY_SLOT:
+            slot = (slot + 1) & gram_mask
+        gram_table[slot] = gram_id
+        all_postings.extend(postings[gram])
+        posting_offsets.append(len(all_postings))
+
+    header = HEADER.pack(MAGIC, FORMAT_VERSION, 0, count, table_size,
+                         source_stamp[0], source_stamp[1],
+                         fingerprint(products).encode("ascii"),
+                         len(grams), gram_table_size)
+    sections = [header]
+    for section in (plus, prices, _offsets(encoded), _offsets(encoded_names),
+                    array("i", tie_break_order(names)), plu_table,
+                    gram_table, _offsets(encoded_grams), posting_offsets,
+                    all_postings):
+        data = section.tobytes()
+        sections.append(data + b"\0" * (_aligned(len(data)) - len(data)))
+    for strings in (encoded, encoded_names):
+        data = b"".join(strings)
+        sections.append(data + b"\0" * (_aligned(len(data)) - len(data)))
+    sections.append(b"".join(encoded_grams))
+    return b"".join(sections)
+
+
+class PicklistStore(Sequence):
+    """
+    Read-only, columnar picklist over a binary snapshot.
+
+    PLU codes, prices and names live in flat arrays of the snapshot
+    rather than in one object per product, and Products are only built
+    when accessed. The snapshot embeds an open-addressing hash table of
+    the PLU codes and the n-gram index of the normalized names, so
+    get_by_plu() and search() work without building any per-process
+    index. When the snapshot is memory-mapped from a file, every worker
+    process shares the same pages.
+    """
+
+    def __init__(self, buffer: Union[bytes, mmap.mmap]):
+        """
+        Opens a snapshot.
+
+        Args:
+            buffer: The snapshot bytes, or a memory map of its file.
+
+        Raises:
+            ValueError: If the buffer is not a snapshot of this version.
+        """
+        if len(buffer) < HEADER.size:
+            raise ValueError("Truncated picklist snapshot")
+        (magic, version, _, count, table_size, mtime_ns, size,
+         content_hash, gram_count, gram_table_size) = HEADER.unpack_from(
+            buffer)
+        if magic != MAGIC or version != FORMAT_VERSION:
+            raise ValueError("Not a picklist snapshot of version "
+                             f"{FORMAT_VERSION}")
+
+        self._buffer = buffer
+        self.source_stamp = (mtime_ns, size)
+        self.fingerprint = content_hash.decode("ascii")
+        self._count = count
+        self._mask = table_size - 1
+        self._gram_mask = gram_table_size - 1
+        # The picklist never changes under a snapshot, so results of the
+        # handful of names the model keeps returning are memoized
+        self._memo: Dict[str, List[Product]] = {}
+
+        view = memoryview(buffer)
+        self._offset = HEADER.size
+        self._plus = self._section(view, "q", count)
+        self._prices = self._section(view, "d", count)
+        self._offsets = self._section(view, "I", count + 1)
+        self._name_offsets = self._section(view, "I", count + 1)
+        self._order = self._section(view, "i", count)
+        self._plu_table = self._section(view, "i", table_size)
+        self._gram_table = self._section(view, "i", gram_table_size)
+        self._gram_offsets = self._section(view, "I", gram_count + 1)
+        self._posting_offsets = self._section(view, "I", gram_count + 1)
+        self._postings = self._section(view, "i",
+                                       self._posting_offsets[gram_count])
+        self._names = self._section(view, "B", self._offsets[count])
+        self._normalized = self._section(view, "B",
+                                         self._name_offsets[count])
+        self._grams = self._section(view, "B", self._gram_offsets[gram_count])
+
+    def _section(self, view: memoryview, fmt: str,
+                 length: int) -> memoryview:
+        """
+        Returns the next section of the snapshot as a typed view.
+        """
+        start = self._offset
+        end = start + length * struct.calcsize(fmt)
+        if end > len(view):
+            raise ValueError("Truncated picklist snapshot")
+        self._offset = _aligned(end)
+        return view[start:end].cast(fmt)
+
+    @classmethod
+    def from_products(cls, products: List[Product]) -> "PicklistStore":
+        """
+        Builds an in-memory store, without a snapshot file.
+        """
+        return cls(build_snapshot(products))
+
+    def __len__(self) -> int:
+        return self._count
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(self._count))]
+        if index < 0:
+            index += self._count
+        if not 0 <= index < self._count:
+            raise IndexError("picklist index out of range")
+        return Product(fruit=self.name(index), plu=self._plus[index],
+                       price=self._prices[index])
+
+    def name(self, index: int) -> str:
+        """
+        Returns the name of a product without building it.
+        """
+        start, end = self._offsets[index], self._offsets[index + 1]
+        return str(self._names[start:end], "utf-8")
+
+    def get_by_plu(self, plu: int) -> Optional[Product]:
+        """
+        Returns the product with a PLU code, or None.
+        """
+        slot = _plu_slot(plu, self._mask)
+        while True:
+            product_id = self._plu_table[slot]
+            if product_id == EMPTY_SLOT:
+                return None
+            if self._plus[product_id] == plu:
+                return self[product_id]
+            slot = (slot + 1) & self._mask
+
+    def _padded_name(self, index: int) -> str:
+        start, end = self._name_offsets[index], self._name_offsets[index + 1]
+        return f" {str(self._normalized[start:end], 'utf-8')} "
+
+    def _posting(self, gram: str) -> Optional[memoryview]:
+        """
+        Returns the ids of the products whose name has an n-gram, or None.
+        """
+        key = gram.encode("utf-8")
+        slot = _name_slot(gram, self._gram_mask)
+        while True:
+            gram_id = self._gram_table[slot]
+            if gram_id == EMPTY_SLOT:
+                return None
+            start = self._gram_offsets[gram_id]
+            if self._grams[start:self._gram_offsets[gram_id + 1]] == key:
+                return self._postings[self._posting_offsets[gram_id]:
+                                      self._posting_offsets[gram_id + 1]]
+            slot = (slot + 1) & self._gram_mask
+
+    def search(self, text: str) -> List[Product]:
+        """
+        Finds the products whose name contains the text, ignoring case and
+        accents, ranked like ProductIndex.search().
+
+        Args:
+            text: The name returned by the model.
+
+        Returns:
+            The matching products, best match first.
+        """
+        query = normalize(text)
+        if not query:
+            return []
+
+        cached = self._memo.get(query)
+        if cached is not None:
+            return list(cached)
+
+        grams = ngrams(query)
+        if grams:
+            postings = [self._posting(gram) for gram in grams]
+            candidates = (_intersect(postings) if None not in postings
+                          else set())
+        else:
+            # Too short for an n-gram lookup: every name is a candidate
+            candidates = range(self._count)
+        matches = [self[i] for i in rank_candidates(
+            query, candidates, self._padded_name, self._order.__getitem__)]
+        if len(self._memo) < MEMO_SIZE:
+            self._memo[query] = matches
+        return list(matches)
+
+    @property
+    def memory_mapped(self) -> bool:
+        return isinstance(self._buffer, mmap.mmap)
+
+
+def open_snapshot(path: str) -> Optional[PicklistStore]:
+    """
+    Memory-maps a snapshot file.
+
+    Returns:
+        The store, or None if the file is missing, empty or invalid.
+    """
+    try:
+        with open(path, "rb") as f:
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return None
+    try:
+        return PicklistStore(buffer)
+    except (ValueError, struct.error):
+        buffer.close()
+        return None
+
+
+def write_snapshot(path: str, data: bytes) -> None:
+    """
+    Writes a snapshot atomically, so concurrent workers never map a
+    half-written file.
+    """
+    temporary = f"{path}.{os.getpid()}.tmp"
+    with open(temporary, "wb") as f:
+        f.write(data)
+    os.replace(temporary, path)
@@ -0,0 +1,283 @@
+import secrets
+import sqlite3
+import threading
+from typing import Iterable, Iterator, List, Optional, Tuple
+from app.src.models.product import Product
+from app.src.services.product_index import match_rank, normalize
+from app.src.config.settings import settings
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS picklist_product (
+    id INTEGER PRIMARY KEY,
+    plu INTEGER NOT NULL UNIQUE,
+    fruit TEXT NOT NULL,
+    price REAL NOT NULL,
+    normalized TEXT NOT NULL
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS picklist_fts USING fts5(
+    normalized, content='picklist_product', content_rowid='id',
+    tokenize='trigram'
+);
+CREATE TABLE IF NOT EXISTS picklist_meta (
+    id INTEGER PRIMARY KEY CHECK (id = 0),
+    uid TEXT NOT NULL,
+    version INTEGER NOT NULL
+);
+CREATE TRIGGER IF NOT EXISTS picklist_product_ai
+AFTER INSERT ON picklist_product BEGIN
+    INSERT INTO picklist_fts (rowid, normalized)
+    VALUES (new.id, new.normalized);
+    UPDATE picklist_meta SET version = version + 1;
+END;
+CREATE TRIGGER IF NOT EXISTS picklist_product_ad
+AFTER DELETE ON picklist_product BEGIN
+    INSERT INTO picklist_fts (picklist_fts, rowid, normalized)
+    VALUES ('delete', old.id, old.normalized);
+    UPDATE picklist_meta SET version = version + 1;
+END;
+CREATE TRIGGER IF NOT EXISTS picklist_product_au
+AFTER UPDATE ON picklist_product BEGIN
+    INSERT INTO picklist_fts (picklist_fts, rowid, normalized)
+    VALUES ('delete', old.id, old.normalized);
+    INSERT INTO picklist_fts (rowid, normalized)
+    VALUES (new.id, new.normalized);
+    UPDATE picklist_meta SET version = version + 1;
+END;
+"""
+
+# The trigram tokenizer cannot match queries shorter than this
+MIN_FTS_QUERY = 3
+
+
+def _connect(db_path: str) -> sqlite3.Connection:
+    connection = sqlite3.connect(db_path, timeout=30)
+    connection.execute("PRAGMA journal_mode=WAL")
+    return connection
+
+
+class SqlitePicklist:
+    """
+    Live, read-only view of the picklist stored in SQLite.
+
+    Every lookup queries the database, so price and assortment changes
+    committed by any process are visible to the next scan without
+    reloading anything. Searches go through the FTS5 trigram index on
+    the normalized names and are ranked like ProductIndex.search().
+    """
+
+    def __init__(self, db_path: str):
+        """
+        Args:
+            db_path: Path to the SQLite database.
+        """
+        self.db_path = db_path
+        self._local = threading.local()
+
+    @property
+    def _connection(self) -> sqlite3.Connection:
+        # sqlite3 connections must stay in the thread that opened them
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = self._local.connection = _connect(self.db_path)
+        return connection
+
+    def _version(self) -> Tuple[str, int]:
+        row = self._connection.execute(
+            "SELECT uid, version FROM picklist_meta").fetchone()
+        return (row[0], row[1]) if row else ("", 0)
+
+    @property
+    def version(self) -> int:
+        """
+        Counter bumped by every committed change to the products.
+        """
+        return self._version()[1]
+
+    @property
+    def fingerprint(self) -> str:
+        """
+        Identifies the current content of the picklist in cache keys.
+        """
+        uid, version = self._version()
+        return f"db-{uid}-{version}"
+
+    def __len__(self) -> int:
+        return self._connection.execute(
+            "SELECT COUNT(*) FROM picklist_product").fetchone()[0]
+
+    def __iter__(self) -> Iterator[Product]:
+        rows = self._connection.execute(
+            "SELECT fruit, plu, price FROM picklist_product ORDER BY id")
+        for fruit, plu, price in rows:
+            yield Product(fruit, plu, price)
+
+    def get_by_plu(self, plu: int) -> Optional[Product]:
+        """
+        Returns the product with a PLU code, or None.
+        """
+        row = self._connection.execute(
+            "SELECT fruit, plu, price FROM picklist_product WHERE plu = ?",
+            (plu,)).fetchone()
+        return Product(*row) if row else None
+
+    def search(self, text: str) -> List[Product]:
+        """
+        Finds the products whose name contains the text, ignoring case and
+        accents.
+
+        Args:
+            text: The name returned by the model.
+
+        Returns:
+            The matching products, best match first.
+        """
+        query = normalize(text)
+        if not query:
+            return []
+
+        if len(query) >= MIN_FTS_QUERY:
+            phrase = '"' + query.replace('"', '""') + '"'
+            rows = self._connection.execute(
+                "SELECT p.id, p.fruit, p.plu, p.price, p.normalized "
+                "FROM picklist_fts JOIN picklist_product p "
+                "ON p.id = picklist_fts.rowid "
+                "WHERE picklist_fts MATCH ?", (phrase,))
+        else:
+            # Too short for the trigram index: a plain substring scan,
+            # like ProductIndex
+            pattern = (query.replace("\\", "\\\\").replace("%", "\\%")
+                       .replace("_", "\\_"))
+            rows = self._connection.execute(
+                "SELECT id, fruit, plu, price, normalized "
+                "FROM picklist_product WHERE normalized LIKE ? ESCAPE '\\'",
+                (f"%{pattern}%",))
+
+        ranked = []
+        for product_id, fruit, plu, price, name in rows:
+            rank = match_rank(query, f" {name} ")
+            if rank is not None:
+                # Same tie-break as ProductIndex: shorter names, then order
+                ranked.append(((rank, len(name), product_id),
+                               Product(fruit, plu, price)))
+        ranked.sort(key=lambda item: item[0])
+        return [product for _, product in ranked]
+
+
+class SqlitePicklistRepository:
+    """
+    Stores the picklist in SQLite, with an FTS5 index on the normalized
+    names kept in sync by triggers.
+
+    Changes are applied in place, row by row, and bump a version counter
+    that running workers poll to invalidate what they cached.
+
+    The tables are not Django models: the FTS5 index and its triggers
+    have no ORM equivalent, and the watcher and batch modes open the
+    picklist without Django set up. The repository owns the schema and
+    `migrate` leaves it alone.
+    """
+
+    def __init__(self, db_path: str = settings.PICKLIST_DB_PATH):
+        """
+        Initializes the repository and creates the schema if needed.
+
+        Args:
+            db_path: Path to the SQLite database.
+        """
+        self.db_path = db_path
+        connection = _connect(db_path)
+        try:
+            with connection:
+                connection.executescript(SCHEMA)
+                connection.execute(
+                    "INSERT OR IGNORE INTO picklist_meta (id, uid, version) "
+                    "VALUES (0, ?, 0)", (secrets.token_hex(4),))
+        finally:
+            connection.close()
+
+    def load(self) -> SqlitePicklist:
+        """
+        Returns the live view of the picklist.
+        """
+        return SqlitePicklist(self.db_path)
+
+    def upsert(self, products: Iterable[Product],
+               replace: bool = False) -> Tuple[int, int]:
+        """
+        Inserts new products and updates changed ones, in one transaction.
+
+        Unchanged rows are not touched, so re-importing the same file does
+        not invalidate any cache.
+
+        Args:
+            products: The products to store.
+            replace: Also delete the products that are not in products.
+
+        Returns:
+            The number of rows written and of rows deleted.
+        """
+        products = list(products)
+        connection = _connect(self.db_path)
+        try:
+            with connection:
+                version = "SELECT version FROM picklist_meta"
+                before = connection.execute(version).fetchone()[0]
+                connection.executemany(
+                    "INSERT INTO picklist_product "
+                    "(plu, fruit, price, normalized) VALUES (?, ?, ?, ?) "
+                    "ON CONFLICT (plu) DO UPDATE SET fruit = excluded.fruit, "
+                    "price = excluded.price, normalized = excluded.normalized "
+                    "WHERE fruit IS NOT excluded.fruit "
+                    "OR price IS NOT excluded.price",
+                    [(p.plu, p.fruit, p.price, normalize(p.fruit))
+                     for p in products])
+                # The triggers bump the version once per row written
+                written = connection.execute(version).fetchone()[0] - before
+
+                deleted = 0
+                if replace:
+                    connection.execute(
+                        "CREATE TEMP TABLE keep (plu INTEGER PRIMARY KEY)")
+                    connection.executemany("INSERT OR IGNORE INTO keep "
+                                           "VALUES (?)",
+                                           [(p.plu,) for p in products])
+                    deleted = connection.execute(
+                        "DELETE FROM picklist_product "
+                        "WHERE plu NOT IN (SELECT plu FROM keep)").rowcount
+                    connection.execute("DROP TABLE keep")
+        finally:
+            connection.close()
+        return written, deleted
+
+    def set_price(self, plu: int, price: float) -> bool:
+        """
+        Changes the price of a product.
+
+        Returns:
+            Whether the product exists.
+        """
+        connection = _connect(self.db_path)
+        try:
+            with connection:
+                return connection.execute(
+                    "UPDATE picklist_product SET price = ? WHERE plu = ?",
+                    (price, plu)).rowcount > 0
+        finally:
+            connection.close()
+
+    def delete(self, plu: int) -> bool:
+        """
+        Removes a product from the picklist.
+
+        Returns:
+            Whether the product existed.
+        """
+        connection = _connect(self.db_path)
+        try:
+            with connection:
+                return connection.execute(
+                    "DELETE FROM picklist_product WHERE plu = ?",
+                    (plu,)).rowcount > 0
+        finally:
+            connection.close()
@@ -1,8 +1,94 @@
+import functools
+import json
+import threading
+from typing import Any, Callable, Dict, List, Optional, Sequence
+import httpx
 from google import genai
-from google.genai import types
+from google.genai import errors, types
+from app.src.models.analysis_result import AnalysisResult
+from app.src.models.inference_session import InferenceSession
+from app.src.models.product import Product
+from app.src.services.call_recorder import CallRecorder, RecordingClient
+from app.src.services.fake_genai_client import FakeGenAIClient
+from app.src.services.hedging import HedgingPolicy
+from app.src.services.output_parser import (
+    ParseError,
+    parse_answer,
+    parse_model_output,
+)
+from app.src.services.rate_limiter import RateLimiter, rank
 from app.src.config.settings import settings
 
 
+# Prompts containing this placeholder run in single-call mode: the
+# picklist shortlist is compiled into them and the model answers with the
+# PLU directly, so no refine call is needed.
+CANDIDATES_PLACEHOLDER = "{candidates}"
+
+# Put before the prompt when several images are classified in one call
+BATCH_INSTRUCTIONS = (
+    "The {count} images above are numbered from 0 to {last}. Classify "
+    "each one independently, following the instructions below. Return "
+    "ONLY a JSON array with one object per image, each with an \"index\" "
+    "field holding the image number and the fields requested below.\n\n"
+)
+
+# PLU value of single-call answers naming a fruit outside the shortlist
+NO_PLU = "N/A"
+
+# HTTP status codes worth trying again: rate limiting and server errors
+RETRYABLE_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+
+
+def is_retryable(error: Exception) -> bool:
+    """
+    Tells transient failures of a model call from permanent ones.
+
+    Args:
+        error: The exception raised by the call.
+
+    Returns:
+        True for rate limiting, server errors, timeouts and connection
+        failures; False for bad requests, authentication errors and bugs.
+    """
+    if isinstance(error, errors.APIError):
+        return error.code in RETRYABLE_STATUS_CODES
+    return isinstance(error, (httpx.TransportError, TimeoutError,
+                              ConnectionError))
+
+
+def split_batch_answer(text: str, count: int) -> List[Optional[str]]:
+    """
+    Splits the answer of a multi-image call into one answer per image.
+
+    Args:
+        text: The model's answer, a JSON array of indexed objects.
+        count: Number of images sent.
+
+    Returns:
+        The JSON answer of each image, or None for the images the answer
+        does not cover (all of them if it is not a valid array).
+    """
+    answers: List[Optional[str]] = [None] * count
+    try:
+        items = parse_model_output(text)
+    except ParseError:
+        return answers
+    if not isinstance(items, list):
+        return answers
+
+    for item in items:
+        # Items cut short by a truncated answer lack the fruit
+        if not isinstance(item, dict) or "fruit" not in item:
+            continue
+        fields: Dict[str, Any] = dict(item)
+        index = fields.pop("index", None)
+        if (isinstance(index, int) and 0 <= index < count
+                and answers[index] is None):
+            answers[index] = json.dumps(fields, ensure_ascii=False)
+    return answers
+
+
 class AIService:
     """
     Service for interacting with the Google Gemini AI model.
@@ -10,22 +96,48 @@ class AIService:
 
     def __init__(self,
                  model_name: str = settings.AGENT_MODEL,
-                 prompt_path: str = settings.PROMPT_PATH):
+                 prompt_path: str = settings.PROMPT_PATH,
+                 client: Optional[genai.Client] = None,
+                 rate_limiter: Optional[RateLimiter] = None,
+                 hedging: Optional[HedgingPolicy] = None):
         """
         Initializes the AI Service.
 
         Args:
             model_name: The name of the Gemini model to use.
             prompt_path: Path to the text file containing the prompt.
+            client: Optional pre-built Gemini client. When omitted, one is
+                created on first use and reused for every call.
+            rate_limiter: Optional limiter every model call must get a
+                token from, in the priority class of its session.
+            hedging: Optional policy sending a backup analyze call when
+                the first one is slower than usual.
         """
         self.model_name = model_name
         self.api_key = settings.GEMINI_API_KEY
-        self.prompt = self._load_prompt(prompt_path)
-        self.last_image_bytes = None
+        self.prompt_path = prompt_path
+        self.prompt_template = self._load_prompt(prompt_path)
+        self.prompt = self.prompt_template
+        self.picklist_version: Optional[str] = None
+        self._bound_picklist: Optional[tuple] = None
+        # PLUs a single-call answer may contain, as in the prompt
+        self._shortlist_plus: List[str] = []
+        self.response_schema = settings.RESPONSE_SCHEMA_ENABLED
+        self._client = client
+        self._client_lock = threading.Lock()
+        self.rate_limiter = rate_limiter
+        self.hedging = hedging
 
-        if not self.api_key:
+        if self._missing_key():
             print("Error: Gemini API key missing.")
 
+    def _missing_key(self) -> bool:
+        """
+        Whether calls would go to Gemini without an API key.
+        """
+        return (not self.api_key and self._client is None
+                and settings.GEMINI_BACKEND != "fake")
+
     def _load_prompt(self, path: str) -> str:
         """
         Loads the prompt text from a file.
@@ -45,72 +157,422 @@ class AIService:
             print(f"Error loading prompt from {path}: {e}")
             return ""
 
-    def analyze_image(self, image_bytes: bytes) -> str:
+    def reload_prompt(self) -> None:
         """
-        Analyzes an image to extract inventory data.
+        Re-reads the prompt file, keeping the current prompt if it fails.
+        """
+        prompt = self._load_prompt(self.prompt_path)
+        if prompt:
+            self.prompt_template = prompt
+            self.prompt = prompt
+            self.picklist_version = None
+            if self._bound_picklist is not None:
+                self.bind_picklist(*self._bound_picklist)
+
+    @property
+    def single_call(self) -> bool:
+        """
+        Whether the prompt asks for the PLU directly from a shortlist.
+        """
+        return CANDIDATES_PLACEHOLDER in self.prompt_template
+
+    def bind_picklist(self, products: List[Product], version: str,
+                      priority: Optional[Callable[[Product], float]] = None
+                      ) -> None:
+        """
+        Compiles the picklist shortlist into a single-call prompt.
+
+        The prompt is compiled once per picklist version, never per
+        request. Other prompts are left untouched.
 
         Args:
-            image_bytes: The image data in bytes.
+            products: The current picklist.
+            version: Fingerprint of the picklist.
+            priority: Optional popularity of a product, used to choose the
+                entries listed when the picklist is too large to list.
+        """
+        self._bound_picklist = (products, version, priority)
+        if not self.single_call or version == self.picklist_version:
+            return
+
+        listed = self._shortlisted(products, priority)
+        self.prompt = self.prompt_template.replace(
+            CANDIDATES_PLACEHOLDER, self._shortlist(products, listed))
+        self._shortlist_plus = [str(p.plu) for p in listed]
+        self.picklist_version = version
+
+    @staticmethod
+    def _shortlisted(products: List[Product],
+                     priority: Optional[Callable[[Product], float]]
+                     ) -> List[Product]:
+        """
+        Chooses the picklist entries offered to the model.
+
+        Small picklists are listed in full. Larger ones are cut down to
+        their most popular entries.
+        """
+        limit = settings.SHORTLIST_MAX_ENTRIES
+        if len(products) <= limit:
+            return list(products)
+        ranked = sorted(products,
+                        key=lambda p: -priority(p) if priority else 0)
+        return ranked[:limit]
+
+    @staticmethod
+    def _shortlist(products: List[Product], listed: List[Product]) -> str:
+        """
+        Lists the shortlisted entries, plus the general fruit names when
+        the picklist was cut down, so the model can still answer with a
+        category that is then matched and refined as usual.
+        """
+        lines = [f"{p.fruit} | {p.plu}" for p in listed]
+        if len(listed) < len(products):
+            categories = sorted({p.fruit.split()[0] for p in products
+                                 if p.fruit.split()})
+            lines.append(f"Other fruit (no PLU): {', '.join(categories)}")
+        return "\n".join(lines)
+
+    @property
+    def client(self) -> genai.Client:
+        """
+        Returns the pooled Gemini client, creating it on first use.
+
+        With RECORD_CALLS_PATH set, its calls are also appended to that
+        corpus.
+        """
+        if self._client is None:
+            with self._client_lock:
+                if self._client is None:
+                    if settings.GEMINI_BACKEND == "fake":
+                        client = FakeGenAIClient()
+                    else:
+                        # Calls abandoned at the scan deadline end too
+                        client = genai.Client(
+                            api_key=self.api_key,
+                            http_options=types.HttpOptions(
+                                timeout=int(settings.RETRY_DEADLINE * 1000)))
+                    if settings.RECORD_CALLS_PATH:
+                        client = RecordingClient(
+                            client, CallRecorder(settings.RECORD_CALLS_PATH))
+                    self._client = client
+        return self._client
+
+    @staticmethod
+    def _contents(image_bytes: bytes, mime_type: str,
+                  prompt: str) -> List[Any]:
+        return [
+            types.Part.from_bytes(
+                data=image_bytes,
+                mime_type=mime_type,
+            ),
+            prompt
+        ]
+
+    def _batch_contents(self, sessions: List[InferenceSession]) -> List[Any]:
+        contents: List[Any] = []
+        for index, session in enumerate(sessions):
+            contents.append(f"Image {index}:")
+            contents.append(types.Part.from_bytes(
+                data=session.image_bytes, mime_type=session.mime_type))
+        contents.append(BATCH_INSTRUCTIONS.format(count=len(sessions),
+                                                  last=len(sessions) - 1)
+                        + self.prompt)
+        return contents
+
+    @staticmethod
+    def _answer_schema(plus: Optional[Sequence[str]] = None,
+                       indexed: bool = False) -> types.Schema:
+        """
+        Builds the JSON schema of an answer.
+
+        Args:
+            plus: The PLUs the answer may pick from, as strings (any PLU
+                if empty); None for an answer with the fruit name only.
+            indexed: Add the image number of multi-image answers.
+        """
+        properties = {"fruit": types.Schema(type=types.Type.STRING)}
+        if plus is not None:
+            properties["PLU"] = types.Schema(type=types.Type.STRING,
+                                             enum=list(plus) or None)
+        if indexed:
+            properties = {"index": types.Schema(type=types.Type.INTEGER),
+                          **properties}
+        return types.Schema(type=types.Type.OBJECT, properties=properties,
+                            required=list(properties),
+                            property_ordering=list(properties))
+
+    def _analysis_schema(self, indexed: bool = False) -> types.Schema:
+        """
+        Schema of the answer to the analysis prompt: the fruit name, and
+        in single-call mode a PLU of the shortlist.
+        """
+        plus = ([*self._shortlist_plus, NO_PLU] if self.single_call
+                else None)
+        return self._answer_schema(plus, indexed)
+
+    def _refine_schema(self, candidates: List[Product]) -> types.Schema:
+        """
+        Schema of the answer to a refinement: one of the candidates.
+        """
+        return self._answer_schema([str(p.plu) for p in candidates])
+
+    def _config(self, schema: types.Schema
+                ) -> Optional[types.GenerateContentConfig]:
+        """
+        Asks for a JSON answer following schema, unless disabled.
+        """
+        if not self.response_schema:
+            return None
+        return types.GenerateContentConfig(
+            response_mime_type="application/json", response_schema=schema)
+
+    @staticmethod
+    def _response_result(response: Any,
+                         required: Sequence[str]) -> AnalysisResult:
+        """
+        Parses an answer into canonical JSON.
+
+        An answer that cannot be parsed is a failed call worth retrying:
+        model output varies from one call to the next.
+        """
+        if response.text is None:
+            return AnalysisResult.failure("Model Failed to run correctly")
+        try:
+            answer = parse_answer(response.text, required)
+        except ParseError as e:
+            print(f"Unparsable model answer: {e}")
+            return AnalysisResult.failure(f"Unparsable answer: {e}",
+                                          retryable=True, parse_error=True)
+        return AnalysisResult(text=json.dumps(answer, ensure_ascii=False))
+
+    @staticmethod
+    def _error_result(stage: str, error: Exception) -> AnalysisResult:
+        print(f"Error in {stage}: {error}")
+        return AnalysisResult.failure(f"Exception during {stage}: {error}",
+                                      retryable=is_retryable(error))
+
+    def analyze_images(self, sessions: List[InferenceSession]
+                       ) -> List[Optional[AnalysisResult]]:
+        """
+        Analyzes the images of several sessions in one model call.
+
+        Args:
+            sessions: The sessions of the scans.
 
         Returns:
-            The model's response as a JSON string.
+            One result per session, in order: the failure of the call for
+            every session if it failed, and None for the images its answer
+            does not cover, which callers should analyse one by one.
+        """
+        if self._missing_key():
+            return [AnalysisResult.failure("API Key missing",
+                                           sent=False)] * len(sessions)
+        # The batch is as urgent as its most urgent scan
+        priority = min((s.priority for s in sessions), key=rank)
+        if not self._admit(priority):
+            return [self._shed_result()] * len(sessions)
+
+        try:
+            response = self.client.models.generate_content(
+                model=self.model_name,
+                contents=self._batch_contents(sessions),
+                config=self._config(types.Schema(
+                    type=types.Type.ARRAY,
+                    items=self._analysis_schema(indexed=True)))
+            )
+        except Exception as e:
+            return [self._error_result("batch analysis", e)] * len(sessions)
+
+        if response.text is None:
+            return [None] * len(sessions)
+        results: List[Optional[AnalysisResult]] = []
+        for session, answer in zip(sessions, split_batch_answer(
+                response.text, len(sessions))):
+            if answer is not None:
+                session.agent_output = answer
+            results.append(AnalysisResult(text=answer)
+                           if answer is not None else None)
+        return results
+
+    def _admit(self, priority: str) -> bool:
+        """
+        Waits for the rate limiter to let a call through.
+        """
+        return (self.rate_limiter is None
+                or self.rate_limiter.acquire(priority))
+
+    async def _admit_async(self, priority: str) -> bool:
+        if self.rate_limiter is None:
+            return True
+        return await self.rate_limiter.acquire_async(priority)
+
+    def _allow_hedge(self, priority: str) -> bool:
+        """
+        Whether a backup call may be sent: only on spare quota.
+        """
+        return (self.rate_limiter is None
+                or self.rate_limiter.try_acquire(priority))
+
+    @staticmethod
+    def _shed_result() -> AnalysisResult:
+        # Not retryable: the wait already used up the time a retry needs
+        return AnalysisResult.failure("Rate limited: no model quota within "
+                                      "the maximum wait", sent=False)
+
+    @staticmethod
+    def _closed_result(session: InferenceSession) -> Optional[AnalysisResult]:
+        if session.closed:
+            return AnalysisResult.failure("Inference session closed",
+                                          sent=False)
+        return None
+
+    def analyze_image(self, session: InferenceSession) -> AnalysisResult:
         """
-        self.last_image_bytes = image_bytes
+        Analyzes the image of a session to extract inventory data.
 
-        if not self.api_key:
-            return '{"Error": "API Key missing"}'
+        Args:
+            session: The scan's session; its agent_output is set on
+                success.
+
+        Returns:
+            The model's JSON answer, or the reason the call failed.
+        """
+        if self._missing_key():
+            return AnalysisResult.failure("API Key missing", sent=False)
+        closed = self._closed_result(session)
+        if closed is not None:
+            return closed
+        if not self._admit(session.priority):
+            return self._shed_result()
 
         try:
-            client = genai.Client(api_key=self.api_key)
-            response = client.models.generate_content(
+            call = functools.partial(
+                self.client.models.generate_content,
                 model=self.model_name,
-                contents=[
-                    types.Part.from_bytes(
-                        data=image_bytes,
-                        mime_type='image/png',
-                    ),
-                    self.prompt
-                ]
+                contents=self._contents(session.image_bytes,
+                                        session.mime_type, self.prompt),
+                config=self._config(self._analysis_schema())
             )
+            if self.hedging is None:
+                response = call()
+            else:
+                response = self.hedging.run(
+                    call, functools.partial(self._allow_hedge,
+                                            session.priority))
+            result = self._response_result(response, ("fruit",))
+        except Exception as e:
+            return self._error_result("analysis", e)
+        if result.ok:
+            session.agent_output = result.text
+        return result
 
-            if response.text is None:
-                return '{"Error": "Model Failed to run correctly"}'
+    async def analyze_image_async(self, session: InferenceSession
+                                  ) -> AnalysisResult:
+        """
+        Analyzes the image of a session without blocking the event loop.
+
+        Args:
+            session: The scan's session; its agent_output is set on
+                success.
 
-            return response.text.replace("'", '"')
+        Returns:
+            The model's JSON answer, or the reason the call failed.
+        """
+        if self._missing_key():
+            return AnalysisResult.failure("API Key missing", sent=False)
+        closed = self._closed_result(session)
+        if closed is not None:
+            return closed
+        if not await self._admit_async(session.priority):
+            return self._shed_result()
+
+        try:
+            call = functools.partial(
+                self.client.aio.models.generate_content,
+                model=self.model_name,
+                contents=self._contents(session.image_bytes,
+                                        session.mime_type, self.prompt),
+                config=self._config(self._analysis_schema())
+            )
+            if self.hedging is None:
+                response = await call()
+            else:
+                response = await self.hedging.run_async(
+                    call, functools.partial(self._allow_hedge,
+                                            session.priority))
+            result = self._response_result(response, ("fruit",))
         except Exception as e:
-            print(f"Error in analyze_image: {e}")
-            return '{"Error": "Exception during analysis"}'
+            return self._error_result("analysis", e)
+        if result.ok:
+            session.agent_output = result.text
+        return result
 
-    def refine_analysis(self, refinement_prompt: str) -> str:
+    def refine_analysis(self, session: InferenceSession,
+                        refinement_prompt: str) -> AnalysisResult:
         """
-        Refines the previous analysis with a new prompt.
+        Asks again about the image of a session, with a new prompt.
 
         Args:
+            session: The scan's session. The answer's PLU is constrained
+                to those of its matches, and its refined_output is set on
+                success.
             refinement_prompt: The prompt to send for refinement.
 
         Returns:
-            The model's refined response.
+            The model's refined answer, or the reason the call failed.
         """
-        if self.last_image_bytes is None:
-            return '{"Error": "No image to refine analysis for"}'
+        closed = self._closed_result(session)
+        if closed is not None:
+            return closed
+        if not self._admit(session.priority):
+            return self._shed_result()
 
         try:
-            client = genai.Client(api_key=self.api_key)
-            response = client.models.generate_content(
+            response = self.client.models.generate_content(
                 model=self.model_name,
-                contents=[
-                    types.Part.from_bytes(
-                        data=self.last_image_bytes,
-                        mime_type='image/png',
-                    ),
-                    refinement_prompt
-                ]
+                contents=self._contents(session.image_bytes,
+                                        session.mime_type, refinement_prompt),
+                config=self._config(self._refine_schema(session.matches))
             )
+            result = self._response_result(response, ("PLU",))
+        except Exception as e:
+            return self._error_result("refinement", e)
+        if result.ok:
+            session.refined_output = result.text
+        return result
 
-            if response.text is None:
-                return '{"Error": "Model Failed to run correctly"}'
+    async def refine_analysis_async(self, session: InferenceSession,
+                                    refinement_prompt: str
+                                    ) -> AnalysisResult:
+        """
+        Asks again about the image of a session without blocking the
+        event loop.
+
+        Args:
+            session: The scan's session. The answer's PLU is constrained
+                to those of its matches, and its refined_output is set on
+                success.
+            refinement_prompt: The prompt to send for refinement.
 
-            return response.text.replace("'", '"')
+        Returns:
+            The model's refined answer, or the reason the call failed.
+        """
+        closed = self._closed_result(session)
+        if closed is not None:
+            return closed
+        if not await self._admit_async(session.priority):
+            return self._shed_result()
+
+        try:
+            response = await self.client.aio.models.generate_content(
+                model=self.model_name,
+                contents=self._contents(session.image_bytes,
+                                        session.mime_type, refinement_prompt),
+                config=self._config(self._refine_schema(session.matches))
+            )
+            result = self._response_result(response, ("PLU",))
         except Exception as e:
-            print(f"Error in refine_analysis: {e}")
-            return '{"Error": "Exception during refinement"}'
+            return self._error_result("refinement", e)
+        if result.ok:
+            session.refined_output = result.text
+        return result
@@ -0,0 +1,205 @@
+import glob
+import json
+import os
+import time
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    Future,
+    ThreadPoolExecutor,
+    wait,
+)
+from dataclasses import dataclass
+from typing import IO, Any, Callable, Dict, List, Optional, Set
+from app.src.config.settings import settings
+from app.src.models.scan_result import ScanResult
+from app.src.services.file_service import is_pending
+from app.src.services.history_writer import HistoryWriter
+from app.src.services.scan_service import ScanService
+
+
+@dataclass
+class BatchReport:
+    """
+    Summary of one batch run.
+    """
+    total: int = 0
+    skipped: int = 0
+    succeeded: int = 0
+    failed: int = 0
+    elapsed: float = 0.0
+
+    @property
+    def processed(self) -> int:
+        return self.succeeded + self.failed
+
+    @property
+    def throughput(self) -> float:
+        """
+        Images processed per second.
+        """
+        return self.processed / self.elapsed if self.elapsed else 0.0
+
+
+class BatchService:
+    """
+    Classifies a backlog of images over a bounded pool of workers.
+
+    Every image gets one JSON line in the output file, written as soon as
+    it is done. A run over an existing output file skips the images that
+    already have a successful record, so a crashed run can be resumed;
+    failed images are tried again.
+    """
+
+    def __init__(self, scan_service_factory: Callable[[], ScanService],
+                 output_path: str, workers: int = settings.BATCH_WORKERS,
+                 history: Optional[HistoryWriter] = None):
+        """
+        Initializes the service.
+
+        Args:
+            scan_service_factory: Returns the scan service for each image
+                (so picklist edits are picked up during long runs).
+            output_path: JSONL file the records are appended to.
+            workers: Maximum number of images classified at once.
+            history: Optional scan history. The workers wait for room
+                in its queue, up to HISTORY_BATCH_WAIT, rather than drop
+                records.
+        """
+        self.scan_service_factory = scan_service_factory
+        self.output_path = output_path
+        self.workers = max(1, workers)
+        self.history = history
+
+    @staticmethod
+    def collect(source: str) -> List[str]:
+        """
+        Lists the images of a directory or glob pattern.
+
+        Args:
+            source: A directory (its files, not recursively) or a glob
+                pattern such as "captures/**/*.jpg".
+
+        Returns:
+            The absolute paths of the files, sorted.
+        """
+        if os.path.isdir(source):
+            paths = [os.path.join(source, name) for name in os.listdir(source)]
+        else:
+            paths = glob.glob(source, recursive=True)
+        return sorted(os.path.abspath(path) for path in paths
+                      if os.path.isfile(path)
+                      and not is_pending(os.path.basename(path)))
+
+    def completed(self) -> Set[str]:
+        """
+        Returns the paths that already have a successful record.
+        """
+        done: Set[str] = set()
+        if not os.path.exists(self.output_path):
+            return done
+        with open(self.output_path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # Last line cut short by a crash
+                    continue
+                if record.get("error") is None:
+                    done.add(record["path"])
+                else:
+                    done.discard(record["path"])
+        return done
+
+    def run(self, paths: List[str]) -> BatchReport:
+        """
+        Classifies every image not processed by a previous run.
+
+        Args:
+            paths: The images, as returned by collect().
+
+        Returns:
+            The report of the run.
+        """
+        done = self.completed()
+        todo = [path for path in paths if path not in done]
+        report = BatchReport(total=len(paths), skipped=len(paths) - len(todo))
+
+        start = time.perf_counter()
+        with open(self.output_path, "a", encoding="utf-8") as output:
+            if output.tell() and not self._ends_with_newline():
+                # Terminate the record a crash cut short
+                output.write("\n")
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                # Only a couple of images per worker are queued at a time,
+                # so huge backlogs are not all submitted up front
+                in_flight: Set[Future] = set()
+                for path in todo:
+                    if len(in_flight) >= 2 * self.workers:
+                        finished, in_flight = wait(
+                            in_flight, return_when=FIRST_COMPLETED)
+                        self._write(output, finished, report)
+                    in_flight.add(executor.submit(self._process, path))
+                self._write(output, wait(in_flight).done, report)
+        report.elapsed = time.perf_counter() - start
+        return report
+
+    def _ends_with_newline(self) -> bool:
+        with open(self.output_path, "rb") as f:
+            f.seek(-1, os.SEEK_END)
+            return f.read(1) == b"\n"
+
+    @staticmethod
+    def _write(output: IO[str], finished: Set[Future],
+               report: BatchReport) -> None:
+        """
+        Appends the records of finished images and counts them.
+        """
+        for future in finished:
+            record = future.result()
+            output.write(json.dumps(record, ensure_ascii=False) + "\n")
+            if record["error"] is None:
+                report.succeeded += 1
+            else:
+                report.failed += 1
+        # A crash loses at most the images still being classified
+        output.flush()
+
+    def _process(self, path: str) -> Dict[str, Any]:
+        """
+        Classifies one image and builds its record.
+        """
+        start = time.perf_counter()
+        read_ms = 0.0
+        try:
+            with open(path, "rb") as f:
+                image_bytes = f.read()
+            read_ms = (time.perf_counter() - start) * 1000
+            result = self.scan_service_factory().scan(image_bytes)
+        except Exception as e:
+            result = ScanResult(error=f"{type(e).__name__}: {e}")
+        else:
+            if self.history is not None:
+                self.history.record(result, "batch",
+                                    timeout=settings.HISTORY_BATCH_WAIT)
+
+        best_match = result.best_match() if not result.error else None
+        timings = {"read": read_ms, **result.timings,
+                   "total": (time.perf_counter() - start) * 1000}
+        return {
+            "path": path,
+            "agent_output": result.agent_output,
+            "PLU": best_match.get("PLU") if best_match else None,
+            "fruit": best_match.get("fruit") if best_match else None,
+            "Price": best_match.get("Price") if best_match else None,
+            "candidates": len(result.matches),
+            "from_cache": result.from_cache,
+            "near_duplicate": result.near_duplicate,
+            "resolved_locally": result.resolved_locally,
+            "classified_locally": result.classified_locally,
+            "coalesced": result.coalesced,
+            # Answered by the model itself, so usable as a training label
+            "confirmed": result.confirmed,
+            "timings_ms": {stage: round(ms, 2)
+                           for stage, ms in timings.items()},
+            "error": result.error,
+        }
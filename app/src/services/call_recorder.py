@@ -0,0 +1,245 @@
+import hashlib
+import json
+import threading
+import time
+from types import SimpleNamespace
+from typing import Any, Dict, List, Optional, Tuple
+from app.src.models.call_record import CallRecord
+
+
+# Start of the error of a replayed call the corpus has no answer to
+UNRECORDED = "No recorded answer"
+
+
+class UnrecordedCall(LookupError):
+    """
+    Raised by a replay for a request the corpus has no answer to.
+    """
+
+
+def request_key(model: str, contents: List[Any]) -> Tuple[str, List[str],
+                                                          str]:
+    """
+    Identifies a generate_content request.
+
+    Args:
+        model: The model name.
+        contents: The parts sent: images (SDK parts with inline data) and
+            prompt text.
+
+    Returns:
+        The request key, the SHA-256 of each image and the SHA-256 of the
+        prompt text.
+    """
+    images: List[str] = []
+    texts: List[str] = []
+    for part in contents:
+        if isinstance(part, str):
+            texts.append(part)
+            continue
+        inline = getattr(part, "inline_data", None)
+        data = getattr(inline, "data", None) or b""
+        images.append(hashlib.sha256(data).hexdigest())
+    prompt_hash = hashlib.sha256(
+        "\x00".join(texts).encode("utf-8")).hexdigest()
+    key = hashlib.sha256(
+        "\x00".join([model, *images, prompt_hash]).encode("utf-8")
+    ).hexdigest()
+    return key, images, prompt_hash
+
+
+def token_counts(response: Any) -> Tuple[Optional[int], Optional[int]]:
+    """
+    Returns the prompt and response token counts of an answer, if given.
+    """
+    usage = getattr(response, "usage_metadata", None)
+    return (getattr(usage, "prompt_token_count", None),
+            getattr(usage, "candidates_token_count", None))
+
+
+def load_corpus(path: str) -> Dict[str, CallRecord]:
+    """
+    Reads a corpus written by a CallRecorder.
+
+    Args:
+        path: The JSONL file, one call per line.
+
+    Returns:
+        The recorded calls by request key. A request recorded several
+        times keeps its latest answer: the one a retry ended with.
+    """
+    corpus: Dict[str, CallRecord] = {}
+    with open(path, 'r', encoding='utf-8') as f:
+        for number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                record = CallRecord.from_dict(json.loads(line))
+            except (ValueError, TypeError, KeyError) as e:
+                print(f"Skipping line {number} of {path}: {e}")
+                continue
+            corpus[record.key] = record
+    return corpus
+
+
+class CallRecorder:
+    """
+    Appends the model calls of a client to a JSONL corpus.
+
+    Each line is a CallRecord: the request key, the answer, its token
+    usage and its latency. Calls that raise are not recorded.
+    """
+
+    def __init__(self, path: str):
+        """
+        Args:
+            path: The corpus file, appended to.
+        """
+        self.path = path
+        self.recorded = 0
+        self._lock = threading.Lock()
+        self._file = open(path, 'a', encoding='utf-8')
+
+    def record(self, model: str, contents: List[Any], response: Any,
+               latency: float) -> None:
+        """
+        Writes one answered call.
+
+        Args:
+            model: The model name.
+            contents: The parts sent.
+            response: The SDK response.
+            latency: Seconds the call took.
+        """
+        if getattr(response, "text", None) is None:
+            return
+        key, images, prompt_hash = request_key(model, contents)
+        prompt_tokens, response_tokens = token_counts(response)
+        line = json.dumps(CallRecord(
+            key=key, model=model, text=response.text, images=images,
+            prompt_hash=prompt_hash, prompt_tokens=prompt_tokens,
+            response_tokens=response_tokens,
+            latency_ms=round(latency * 1000, 3), recorded_at=time.time(),
+        ).to_dict(), ensure_ascii=False)
+        with self._lock:
+            if self._file.closed:
+                return
+            self._file.write(line + "\n")
+            self._file.flush()
+            self.recorded += 1
+
+    def close(self) -> None:
+        with self._lock:
+            self._file.close()
+
+
+class RecordingModels:
+    """
+    Wraps ``client.models`` to record every answered call.
+    """
+
+    def __init__(self, models: Any, recorder: CallRecorder):
+        self._models = models
+        self._recorder = recorder
+
+    def generate_content(self, model: str, contents: List[Any],
+                         config: Any = None) -> Any:
+        start = time.perf_counter()
+        response = self._models.generate_content(model=model,
+                                                 contents=contents,
+                                                 config=config)
+        self._recorder.record(model, contents, response,
+                              time.perf_counter() - start)
+        return response
+
+
+class RecordingAsyncModels(RecordingModels):
+    """
+    Wraps ``client.aio.models`` to record every answered call.
+    """
+
+    async def generate_content(self, model: str, contents: List[Any],
+                               config: Any = None) -> Any:
+        start = time.perf_counter()
+        response = await self._models.generate_content(model=model,
+                                                       contents=contents,
+                                                       config=config)
+        self._recorder.record(model, contents, response,
+                              time.perf_counter() - start)
+        return response
+
+
+class RecordingClient:
+    """
+    Wraps a Gemini client (or the fake) and records its calls.
+    """
+
+    def __init__(self, client: Any, recorder: CallRecorder):
+        """
+        Args:
+            client: The client making the calls.
+            recorder: Where the calls are written.
+        """
+        self.recorder = recorder
+        self.models = RecordingModels(client.models, recorder)
+        self.aio = SimpleNamespace(
+            models=RecordingAsyncModels(client.aio.models, recorder))
+
+
+class ReplayModels:
+    """
+    Local stand-in for ``client.models`` answering from a corpus.
+
+    Answers come back at once: the recorded latency is not slept but
+    kept with the served records, for reports to add up.
+    """
+
+    def __init__(self, corpus: Dict[str, CallRecord],
+                 served: List[CallRecord]):
+        self.corpus = corpus
+        self.served = served
+
+    def _answer(self, model: str, contents: List[Any]) -> SimpleNamespace:
+        key, _, _ = request_key(model, contents)
+        record = self.corpus.get(key)
+        if record is None:
+            raise UnrecordedCall(f"{UNRECORDED} for request {key[:12]}")
+        self.served.append(record)
+        return SimpleNamespace(
+            text=record.text,
+            usage_metadata=SimpleNamespace(
+                prompt_token_count=record.prompt_tokens,
+                candidates_token_count=record.response_tokens))
+
+    def generate_content(self, model: str, contents: List[Any],
+                         config: Any = None) -> SimpleNamespace:
+        return self._answer(model, contents)
+
+
+class ReplayAsyncModels(ReplayModels):
+    """
+    Local stand-in for ``client.aio.models`` answering from a corpus.
+    """
+
+    async def generate_content(self, model: str, contents: List[Any],
+                               config: Any = None) -> SimpleNamespace:
+        return self._answer(model, contents)
+
+
+class ReplayClient:
+    """
+    Local stand-in for ``genai.Client`` answering recorded requests.
+
+    served lists the records answered so far; callers clear it between
+    scans to attribute calls to each scan.
+    """
+
+    def __init__(self, corpus: Dict[str, CallRecord]):
+        """
+        Args:
+            corpus: Recorded calls by request key (see load_corpus).
+        """
+        self.served: List[CallRecord] = []
+        self.models = ReplayModels(corpus, self.served)
+        self.aio = SimpleNamespace(
+            models=ReplayAsyncModels(corpus, self.served))
@@ -0,0 +1,209 @@
+import hashlib
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, Optional
+from app.src.config.settings import settings
+
+
+@dataclass
+class CacheEntry:
+    """
+    A cached classification: the agent output and, if a refine call was
+    needed, its refined output.
+    """
+    agent_output: str
+    refined_output: Optional[str] = None
+    created_at: float = 0.0
+
+
+class ClassificationCache:
+    """
+    Content-addressed cache of classifications.
+
+    Entries live in an in-memory LRU bounded by size and age. An optional
+    SQLite tier keeps them across worker restarts.
+    """
+
+    def __init__(self,
+                 max_entries: int = settings.CACHE_MAX_ENTRIES,
+                 ttl: float = settings.CACHE_TTL,
+                 db_path: str = settings.CACHE_DB_PATH):
+        """
+        Initializes the cache.
+
+        Args:
+            max_entries: Maximum number of entries kept in memory.
+            ttl: Seconds an entry stays valid. 0 disables expiry.
+            db_path: Path to the SQLite file of the persistent tier, or an
+                empty string to keep the cache in memory only.
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.disk_hits = 0
+        self._entries: "OrderedDict[str, CacheEntry]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._db: Optional[sqlite3.Connection] = None
+
+        if db_path:
+            try:
+                self._db = sqlite3.connect(db_path, check_same_thread=False)
+                self._db.execute(
+                    "CREATE TABLE IF NOT EXISTS classification_cache ("
+                    "key TEXT PRIMARY KEY, agent_output TEXT NOT NULL, "
+                    "refined_output TEXT, created_at REAL NOT NULL)"
+                )
+                self._db.commit()
+            except sqlite3.Error as e:
+                print(f"Error opening classification cache {db_path}: {e}")
+                self._db = None
+
+    @staticmethod
+    def digest(image_bytes: bytes) -> str:
+        """
+        Returns the SHA-256 of an uploaded image, as a hex digest.
+        """
+        return hashlib.sha256(image_bytes).hexdigest()
+
+    @staticmethod
+    def make_key(image_digest: str, model_name: str, prompt: str,
+                 picklist_version: str = "") -> str:
+        """
+        Builds the cache key of a scan.
+
+        Args:
+            image_digest: The image's digest (see digest).
+            model_name: The name of the Gemini model.
+            prompt: The prompt sent with the image.
+            picklist_version: Fingerprint of the picklist, so a price or
+                assortment change never serves a stale refined result.
+
+        Returns:
+            A hex digest identifying the scan.
+        """
+        prompt_hash = hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+        return hashlib.sha256(
+            f"{image_digest}:{model_name}:{prompt_hash}:{picklist_version}"
+            .encode("utf-8")
+        ).hexdigest()
+
+    def _expired(self, entry: CacheEntry, now: float) -> bool:
+        return self.ttl > 0 and now - entry.created_at > self.ttl
+
+    def get(self, key: str) -> Optional[CacheEntry]:
+        """
+        Looks up a classification.
+
+        Args:
+            key: The key built by make_key.
+
+        Returns:
+            The cached entry, or None on a miss.
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self._expired(entry, now):
+                del self._entries[key]
+                entry = None
+
+            if entry is None:
+                entry = self._load(key, now)
+                if entry is not None:
+                    self.disk_hits += 1
+                    self._store(key, entry)
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key: str, entry: CacheEntry) -> None:
+        """
+        Stores a classification.
+
+        Args:
+            key: The key built by make_key.
+            entry: The classification to cache.
+        """
+        if not entry.created_at:
+            entry.created_at = time.time()
+        with self._lock:
+            self._store(key, entry)
+            if self._db is not None:
+                try:
+                    self._db.execute(
+                        "INSERT OR REPLACE INTO classification_cache "
+                        "VALUES (?, ?, ?, ?)",
+                        (key, entry.agent_output, entry.refined_output,
+                         entry.created_at)
+                    )
+                    self._db.commit()
+                except sqlite3.Error as e:
+                    print(f"Error writing classification cache: {e}")
+
+    def clear(self) -> None:
+        """
+        Drops every entry from both tiers.
+        """
+        with self._lock:
+            self._entries.clear()
+            if self._db is not None:
+                try:
+                    self._db.execute("DELETE FROM classification_cache")
+                    self._db.commit()
+                except sqlite3.Error as e:
+                    print(f"Error clearing classification cache: {e}")
+
+    def stats(self) -> Dict[str, float]:
+        """
+        Returns the hit/miss counters of the cache.
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "disk_hits": self.disk_hits,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "entries": len(self._entries),
+            }
+
+    def _store(self, key: str, entry: CacheEntry) -> None:
+        """
+        Inserts into the in-memory LRU. Must be called with the lock held.
+        """
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _load(self, key: str, now: float) -> Optional[CacheEntry]:
+        """
+        Reads an entry from the SQLite tier. Must be called with the lock
+        held.
+        """
+        if self._db is None:
+            return None
+        try:
+            row = self._db.execute(
+                "SELECT agent_output, refined_output, created_at "
+                "FROM classification_cache WHERE key = ?", (key,)
+            ).fetchone()
+        except sqlite3.Error as e:
+            print(f"Error reading classification cache: {e}")
+            return None
+        if row is None:
+            return None
+
+        entry = CacheEntry(*row)
+        if self._expired(entry, now):
+            return None
+        return entry
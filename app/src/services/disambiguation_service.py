@@ -0,0 +1,160 @@
+import json
+import os
+import threading
+from difflib import SequenceMatcher
+from typing import Dict, List, Optional
+from app.src.models.product import Product
+from app.src.services.product_index import normalize
+from app.src.config.settings import settings
+
+
+class DisambiguationService:
+    """
+    Picks the best of several candidate products without calling the
+    model again, when the choice is clear enough.
+
+    A name that contains the words of exactly one candidate, e.g. the
+    full variety name "Banana Madeira", settles the choice locally. A
+    generic name such as "Banana" contains the words of several and is
+    left to the model: neither string similarity nor the priors say which
+    variety is on the scale.
+
+    A name that contains the words of no candidate, e.g. a misspelling, is
+    scored by the string similarity to each candidate name, blended with
+    a catalogue prior: how often the product was the final answer before.
+    It is settled locally only when the best score beats the runner-up by
+    the confidence margin. With a margin above the prior weight, the
+    priors alone never settle a choice.
+    """
+
+    def __init__(self,
+                 margin: float = settings.LOCAL_RESOLVE_MARGIN,
+                 prior_weight: float = settings.LOCAL_PRIOR_WEIGHT,
+                 priors: Optional[Dict[int, float]] = None):
+        """
+        Initializes the service.
+
+        Args:
+            margin: Minimum score gap between the two best candidates for
+                the choice to be made locally.
+            prior_weight: Share of the score given to the catalogue prior.
+            priors: Optional initial counts of confirmed scans per PLU.
+        """
+        self.margin = margin
+        self.prior_weight = prior_weight
+        self.resolved_locally = 0
+        self.resolved_remotely = 0
+        self._counts: Dict[int, float] = dict(priors or {})
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_file(cls, path: str = settings.LOCAL_PRIORS_PATH,
+                  **kwargs) -> "DisambiguationService":
+        """
+        Creates the service with priors read from a JSON file mapping PLU
+        codes to counts. A missing or invalid file means no priors.
+        """
+        priors: Dict[int, float] = {}
+        if path and os.path.exists(path):
+            try:
+                with open(path, 'r') as f:
+                    priors = {int(plu): float(count)
+                              for plu, count in json.load(f).items()}
+            except Exception as e:
+                print(f"Error loading priors from {path}: {e}")
+        return cls(priors=priors, **kwargs)
+
+    def score(self, fruit: str, candidates: List[Product]) -> List[float]:
+        """
+        Scores every candidate against the name returned by the model.
+
+        Args:
+            fruit: The fruit name returned by the model.
+            candidates: The products matching that name.
+
+        Returns:
+            One score between 0 and 1 per candidate.
+        """
+        query = normalize(fruit)
+        with self._lock:
+            counts = [self._counts.get(p.plu, 0.0) for p in candidates]
+        # Laplace smoothing keeps unseen products in the running
+        total = sum(counts) + len(candidates)
+
+        scores = []
+        for product, count in zip(candidates, counts):
+            similarity = SequenceMatcher(
+                None, query, normalize(product.fruit)).ratio()
+            prior = (count + 1) / total
+            scores.append((1 - self.prior_weight) * similarity
+                          + self.prior_weight * prior)
+        return scores
+
+    def resolve(self, fruit: str,
+                candidates: List[Product]) -> Optional[Product]:
+        """
+        Returns the candidate to use, or None if the model should decide.
+
+        Args:
+            fruit: The fruit name returned by the model.
+            candidates: The products matching that name.
+
+        Returns:
+            The clear winner, or None when the choice is ambiguous.
+        """
+        if not candidates:
+            return None
+        if len(candidates) == 1:
+            return candidates[0]
+
+        words = set(normalize(fruit).split())
+        named = [p for p in candidates
+                 if words <= set(normalize(p.fruit).split())]
+        if len(named) == 1:
+            best = named[0]
+        elif named:
+            best = None
+        else:
+            scores = self.score(fruit, candidates)
+            ranked = sorted(range(len(candidates)), key=lambda i: -scores[i])
+            first, runner_up = ranked[0], ranked[1]
+            best = (candidates[first]
+                    if scores[first] - scores[runner_up] >= self.margin
+                    else None)
+
+        with self._lock:
+            if best is not None:
+                self.resolved_locally += 1
+            else:
+                self.resolved_remotely += 1
+        return best
+
+    def observe(self, product: Product) -> None:
+        """
+        Records the final answer of a scan so it counts towards the priors.
+
+        Args:
+            product: The product the scan resolved to.
+        """
+        with self._lock:
+            self._counts[product.plu] = self._counts.get(product.plu, 0) + 1
+
+    def prior(self, product: Product) -> float:
+        """
+        Returns how many confirmed scans resolved to the product.
+        """
+        with self._lock:
+            return self._counts.get(product.plu, 0.0)
+
+    def stats(self) -> Dict[str, float]:
+        """
+        Returns how many ambiguous scans were resolved locally.
+        """
+        with self._lock:
+            total = self.resolved_locally + self.resolved_remotely
+            return {
+                "resolved_locally": self.resolved_locally,
+                "resolved_remotely": self.resolved_remotely,
+                "local_rate": (self.resolved_locally / total
+                               if total else 0.0),
+            }
@@ -0,0 +1,188 @@
+import asyncio
+import json
+import math
+import random
+import time
+from types import SimpleNamespace
+from typing import Any, Dict, List, Optional, Union
+from google.genai import errors
+from app.src.config.settings import settings
+
+
+# Answers of each kind of prompt unless a responses file overrides them
+DEFAULT_RESPONSES = {
+    "analyze": ['{"fruit": "Maca"}'],
+    "refine": ['{"fruit": "Maca Gala", "PLU": 51146, "Price": 0.85}'],
+    "single_call": ['{"fruit": "Maca Gala", "PLU": 51146, "Price": 0.85}'],
+}
+
+LATENCY_DISTRIBUTIONS = ("fixed", "uniform", "exponential", "lognormal")
+
+# Token usage reported by the fake: Gemini bills a fixed count per image
+# and roughly one token per four characters of text
+IMAGE_TOKENS = 258
+CHARS_PER_TOKEN = 4
+
+
+def load_responses(path: str) -> Dict[str, List[str]]:
+    """
+    Reads response payloads from a JSON file.
+
+    The file maps "analyze", "refine" and/or "single_call" to a list of
+    answers, one of which is picked at random per call. Missing kinds
+    keep their default answer.
+
+    Args:
+        path: Path to the file, or an empty string for the defaults.
+
+    Returns:
+        The answers of each kind of prompt.
+    """
+    responses = dict(DEFAULT_RESPONSES)
+    if path:
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                responses.update(json.load(f))
+        except Exception as e:
+            print(f"Error loading fake responses from {path}: {e}")
+    return responses
+
+
+class FakeModels:
+    """
+    Local stand-in for ``client.models`` of the Gemini SDK.
+
+    Answers like the real model without spending API quota: refine
+    prompts get a picklist entry, single-call prompts get a PLU and every
+    other prompt gets a generic fruit name; multi-image prompts get one
+    indexed answer per image. Latency follows a configurable
+    distribution and a share of calls fail with a retryable 503, as an
+    overloaded backend would. Tests can queue scripted answers or
+    exceptions in ``script``; they are consumed first.
+    """
+
+    def __init__(self, latency: float = settings.FAKE_LATENCY_MS / 1000,
+                 distribution: str = settings.FAKE_LATENCY_DIST,
+                 sigma: float = settings.FAKE_LATENCY_SIGMA,
+                 error_rate: float = settings.FAKE_ERROR_RATE,
+                 responses: Optional[Dict[str, List[str]]] = None,
+                 seed: Optional[int] = None):
+        """
+        Initializes the fake.
+
+        Args:
+            latency: Seconds each call takes: the exact value for "fixed",
+                the mean for "uniform" and "exponential", the median for
+                "lognormal".
+            distribution: One of LATENCY_DISTRIBUTIONS.
+            sigma: Shape of the lognormal distribution; larger values
+                give a heavier tail.
+            error_rate: Fraction of calls failing with a 503.
+            responses: Answers per kind of prompt (see load_responses).
+            seed: Seed of the latency and error draws, for reproducible
+                runs.
+        """
+        if distribution not in LATENCY_DISTRIBUTIONS:
+            raise ValueError(f"Unknown latency distribution: {distribution}")
+        self.latency = latency
+        self.distribution = distribution
+        self.sigma = sigma
+        self.error_rate = error_rate
+        self.responses = responses or load_responses(
+            settings.FAKE_RESPONSES_PATH)
+        self.calls = 0
+        self.errors = 0
+        self.script: List[Union[str, Exception]] = []
+        self._random = random.Random(seed)
+
+    def delay(self) -> float:
+        """
+        Draws the duration of one call, in seconds.
+        """
+        if self.latency <= 0 or self.distribution == "fixed":
+            return max(0.0, self.latency)
+        if self.distribution == "uniform":
+            return self._random.uniform(0, 2 * self.latency)
+        if self.distribution == "exponential":
+            return self._random.expovariate(1 / self.latency)
+        return self.latency * math.exp(self._random.gauss(0, self.sigma))
+
+    @staticmethod
+    def _response(contents: List[Any], text: str) -> SimpleNamespace:
+        """
+        Wraps an answer like the SDK does, with its token usage.
+        """
+        prompt_tokens = sum(
+            len(part) // CHARS_PER_TOKEN if isinstance(part, str)
+            else IMAGE_TOKENS for part in contents)
+        return SimpleNamespace(text=text, usage_metadata=SimpleNamespace(
+            prompt_token_count=prompt_tokens,
+            candidates_token_count=len(text or "") // CHARS_PER_TOKEN))
+
+    def _answer(self, contents: List[Any]) -> SimpleNamespace:
+        self.calls += 1
+        if self.script:
+            scripted = self.script.pop(0)
+            if isinstance(scripted, Exception):
+                raise scripted
+            return self._response(contents, scripted)
+        if self.error_rate and self._random.random() < self.error_rate:
+            self.errors += 1
+            raise errors.ServerError(503, {"error": {
+                "message": "The model is overloaded (fake).",
+                "status": "UNAVAILABLE"}})
+
+        prompt = contents[-1] if isinstance(contents[-1], str) else ""
+        if "are numbered from 0" in prompt:
+            return self._response(contents,
+                                  self._batch_answer(contents, prompt))
+        if "Re-examine" in prompt:
+            kind = "refine"
+        elif "PICKLIST" in prompt:
+            kind = "single_call"
+        else:
+            kind = "analyze"
+        return self._response(contents,
+                              self._random.choice(self.responses[kind]))
+
+    def _batch_answer(self, contents: List[Any], prompt: str) -> str:
+        """
+        Answers a multi-image prompt with an indexed JSON array.
+        """
+        kind = "single_call" if "PICKLIST" in prompt else "analyze"
+        count = sum(1 for part in contents if not isinstance(part, str))
+        answers = []
+        for index in range(count):
+            answer = json.loads(self._random.choice(self.responses[kind]))
+            answers.append({"index": index, **answer})
+        return json.dumps(answers, ensure_ascii=False)
+
+    def generate_content(self, model: str, contents: List[Any],
+                         config: Any = None) -> SimpleNamespace:
+        time.sleep(self.delay())
+        return self._answer(contents)
+
+
+class FakeAsyncModels(FakeModels):
+    """
+    Local stand-in for ``client.aio.models`` of the Gemini SDK.
+    """
+
+    async def generate_content(self, model: str, contents: List[Any],
+                               config: Any = None) -> SimpleNamespace:
+        await asyncio.sleep(self.delay())
+        return self._answer(contents)
+
+
+class FakeGenAIClient:
+    """
+    Local stand-in for ``genai.Client``, selected with GEMINI_BACKEND=fake.
+
+    Configured by the FAKE_* settings; keyword arguments override them
+    (see FakeModels).
+    """
+
+    def __init__(self, latency: float = settings.FAKE_LATENCY_MS / 1000,
+                 **options):
+        self.models = FakeModels(latency, **options)
+        self.aio = SimpleNamespace(models=FakeAsyncModels(latency, **options))
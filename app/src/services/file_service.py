@@ -1,24 +1,99 @@
+import ctypes
+import ctypes.util
 import os
+import select
+import struct
 import time
-from typing import Optional
+from typing import Dict, Iterator, Optional, Set, Tuple
+from app.src.config.settings import settings
+
+
+# inotify(7) constants
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_Q_OVERFLOW = 0x00004000
+IN_ISDIR = 0x40000000
+EVENT_HEADER = struct.Struct("iIII")
+
+
+def _load_inotify() -> Optional[ctypes.CDLL]:
+    """
+    Returns libc if it provides inotify, or None (non-Linux systems).
+    """
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6",
+                           use_errno=True)
+    except OSError:
+        return None
+    return libc if hasattr(libc, "inotify_init1") else None
+
+
+def is_pending(file_name: str) -> bool:
+    """
+    Returns whether a file name looks like an upload still being written
+    (hidden or temporary files, renamed into place when complete).
+    """
+    return file_name.startswith(".") or file_name.endswith((".tmp", ".part"))
 
 
 class FileService:
     """
     Service for monitoring file system events.
+
+    On Linux the directory is watched with inotify and a file is emitted
+    as soon as its writer closes it (or it is renamed into the folder).
+    If the kernel's event queue overflows, the events lost are recovered
+    by rescanning the directory; the files found are emitted once settled,
+    as when polling, since their writers may still be at work. Elsewhere,
+    or if inotify is unavailable, the directory is polled and a file is
+    emitted once its size and mtime have been stable for settle_time
+    seconds.
     """
 
-    def __init__(self, directory: str):
+    def __init__(self, directory: str,
+                 backend: str = settings.WATCH_BACKEND,
+                 poll_interval: float = settings.WATCH_POLL_INTERVAL,
+                 settle_time: float = settings.WATCH_SETTLE_TIME):
         """
         Initializes the service with a directory to watch.
 
         Args:
             directory: Path to the directory.
+            backend: "inotify", "poll" or "auto" (inotify if available).
+            poll_interval: Seconds between directory scans when polling.
+            settle_time: Seconds a polled file must stay unchanged before
+                it is considered fully written.
         """
         self.directory = directory
         if not os.path.exists(self.directory):
             os.makedirs(self.directory)
 
+        self.poll_interval = poll_interval
+        self.settle_time = settle_time
+        self._libc = _load_inotify() if backend != "poll" else None
+        if backend == "inotify" and self._libc is None:
+            print("Warning: inotify is not available, polling instead.")
+        self.backend = "inotify" if self._libc is not None else "poll"
+
+    def watch(self) -> Iterator[str]:
+        """
+        Yields every new file of the directory, once fully written.
+
+        Files already present when watching starts are ignored. The
+        generator runs until it is closed or interrupted.
+
+        Yields:
+            The full path of each new file.
+        """
+        if self.backend == "inotify":
+            try:
+                yield from self._watch_inotify()
+                return
+            except OSError as e:
+                print(f"Error watching with inotify ({e}), polling instead.")
+                self.backend = "poll"
+        yield from self._watch_poll()
+
     def watch_for_new_file(self) -> Optional[str]:
         """
         Blocks until a new file appears in the directory.
@@ -26,23 +101,169 @@ class FileService:
         Returns:
             The full path of the new file, or None if interrupted.
         """
-        previous_files = set()
+        watcher = self.watch()
         try:
-            if os.path.exists(self.directory):
-                previous_files = set(os.listdir(self.directory))
+            return next(watcher)
+        except (KeyboardInterrupt, StopIteration):
+            return None
+        finally:
+            watcher.close()
+
+    def _full_path(self, file_name: str) -> str:
+        return os.path.abspath(os.path.join(self.directory, file_name))
+
+    def _signature(self, file_name: str) -> Optional[Tuple[int, int]]:
+        try:
+            stat = os.stat(os.path.join(self.directory, file_name))
+        except OSError:
+            return None
+        return stat.st_size, stat.st_mtime_ns
+
+    def _rescan(self, known: Dict[str, Tuple[int, int]],
+                pending: Dict[str, Tuple[Tuple[int, int], float]]) -> None:
+        """
+        Queues the files added or changed since they were last seen.
+
+        Their writers may still be at work, so they only become pending:
+        _settle() emits them once unchanged for settle_time seconds.
+
+        Args:
+            known: (size, mtime) of the files present or emitted so far.
+            pending: Files waiting to settle, updated in place.
+        """
+        now = time.monotonic()
+        current = self._scan()
+        for file_name in known.keys() - current.keys():
+            del known[file_name]
+        for file_name, signature in current.items():
+            if (known.get(file_name) != signature
+                    and file_name not in pending):
+                pending[file_name] = (signature, now)
+
+    def _settle(self, known: Dict[str, Tuple[int, int]],
+                pending: Dict[str, Tuple[Tuple[int, int], float]]
+                ) -> Iterator[str]:
+        """
+        Yields the pending files whose size and mtime stopped changing.
+        """
+        now = time.monotonic()
+        for file_name, (previous, since) in list(pending.items()):
+            signature = self._signature(file_name)
+            if signature is None:
+                del pending[file_name]
+            elif signature != previous:
+                pending[file_name] = (signature, now)
+            elif now - since >= self.settle_time:
+                del pending[file_name]
+                known[file_name] = signature
+                yield self._full_path(file_name)
+
+    def _watch_inotify(self) -> Iterator[str]:
+        """
+        Yields files on IN_CLOSE_WRITE and IN_MOVED_TO events, and the
+        files whose events were lost when the event queue overflowed,
+        once settled.
+        """
+        libc = self._libc
+        fd = libc.inotify_init1(os.O_CLOEXEC)
+        if fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        try:
+            # What an overflow rescan compares against, taken before the
+            # watch starts so no event can precede it
+            known = self._scan()
+            # Files found by a rescan: name -> (signature, monotonic time
+            # it was first seen)
+            pending: Dict[str, Tuple[Tuple[int, int], float]] = {}
+            wd = libc.inotify_add_watch(fd, os.fsencode(self.directory),
+                                        IN_CLOSE_WRITE | IN_MOVED_TO)
+            if wd < 0:
+                raise OSError(ctypes.get_errno(), "inotify_add_watch failed")
 
             while True:
-                time.sleep(1)
-                current_files = set(os.listdir(self.directory))
-                new_files = current_files - previous_files
+                if pending:
+                    # Polls the rescanned files until they settle
+                    time.sleep(self.poll_interval)
+                    ready, _, _ = select.select([fd], [], [], 0)
+                else:
+                    ready, _, _ = select.select([fd], [], [])
+                buffer = os.read(fd, 64 * 1024) if ready else b""
+                offset = 0
+                while offset < len(buffer):
+                    _, mask, _, length = EVENT_HEADER.unpack_from(buffer,
+                                                                  offset)
+                    offset += EVENT_HEADER.size
+                    name = buffer[offset:offset + length].rstrip(b"\0")
+                    offset += length
 
-                for file_name in new_files:
-                    full_path = os.path.abspath(os.path.join(self.directory,
-                                                             file_name))
-                    if os.path.isfile(full_path):
-                        return full_path
+                    if mask & IN_Q_OVERFLOW:
+                        print("Warning: watcher queue overflowed, "
+                              "rescanning the directory.")
+                        self._rescan(known, pending)
+                        continue
+                    if mask & IN_ISDIR or not name:
+                        continue
+                    file_name = os.fsdecode(name)
+                    if is_pending(file_name):
+                        continue
+                    # Closed by its writer: no need to wait for it to settle
+                    pending.pop(file_name, None)
+                    signature = self._signature(file_name)
+                    if signature is not None and (
+                            known.get(file_name) == signature):
+                        # Already emitted once settled after a rescan
+                        continue
+                    known[file_name] = signature
+                    yield self._full_path(file_name)
+                yield from self._settle(known, pending)
+        finally:
+            os.close(fd)
 
-                previous_files = current_files
+    def _scan(self) -> Dict[str, Tuple[int, int]]:
+        """
+        Returns the (size, mtime) of every regular file of the directory.
+        """
+        files = {}
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                if is_pending(entry.name):
+                    continue
+                try:
+                    if entry.is_file():
+                        stat = entry.stat()
+                        files[entry.name] = (stat.st_size, stat.st_mtime_ns)
+                except OSError:
+                    # Removed between listing and stat
+                    continue
+        return files
 
-        except KeyboardInterrupt:
-            return None
+    def _watch_poll(self) -> Iterator[str]:
+        """
+        Yields files whose size and mtime stopped changing.
+        """
+        emitted: Set[str] = set(self._scan())
+        # name -> (signature, monotonic time it was first seen)
+        pending: Dict[str, Tuple[Tuple[int, int], float]] = {}
+
+        while True:
+            time.sleep(self.poll_interval)
+            now = time.monotonic()
+            current = self._scan()
+
+            emitted.intersection_update(current)
+            for file_name, signature in current.items():
+                if file_name in emitted:
+                    continue
+                previous = pending.get(file_name)
+                if previous is None or previous[0] != signature:
+                    pending[file_name] = (signature, now)
+                    if self.settle_time > 0:
+                        continue
+                elif now - previous[1] < self.settle_time:
+                    continue
+                del pending[file_name]
+                emitted.add(file_name)
+                yield self._full_path(file_name)
+
+            for file_name in pending.keys() - current.keys():
+                del pending[file_name]
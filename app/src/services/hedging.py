@@ -0,0 +1,286 @@
+import asyncio
+import math
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor
+from concurrent.futures import wait as wait_futures
+from typing import Awaitable, Callable, Deque, Dict, Optional, TypeVar
+from app.src.services.metrics import MetricsRegistry
+from app.src.config.settings import settings
+
+
+T = TypeVar("T")
+
+# New latencies between two computations of the percentile
+REFRESH_EVERY = 16
+
+
+class HedgingPolicy:
+    """
+    Sends a backup request when a model call is slower than usual.
+
+    If the call has not returned after the given percentile of the recent
+    call latencies, one identical backup request is sent and the first
+    successful answer wins; the loser is cancelled. Most calls finish
+    before the delay, so the backups mostly hit the slow tail. A budget
+    caps backups at a fraction of all calls, so a backend slowing down as
+    a whole is not hit with twice the traffic.
+
+    Asynchronous losers are cancelled outright. The synchronous SDK call
+    cannot be interrupted: a synchronous loser still runs to completion
+    in the pool and its answer is dropped. Synchronous calls are only
+    hedged once they started running, and only when a worker of the pool
+    is free for the backup, so a saturated pool gets no extra calls.
+    """
+
+    def __init__(self,
+                 percentile: float = settings.HEDGE_PERCENTILE,
+                 budget: float = settings.HEDGE_BUDGET,
+                 window: int = settings.HEDGE_WINDOW,
+                 min_samples: int = settings.HEDGE_MIN_SAMPLES,
+                 initial_delay: float = settings.HEDGE_INITIAL_DELAY_MS / 1000,
+                 min_delay: float = settings.HEDGE_MIN_DELAY_MS / 1000,
+                 workers: int = settings.HEDGE_WORKERS,
+                 metrics: Optional[MetricsRegistry] = None):
+        """
+        Initializes the policy.
+
+        Args:
+            percentile: Percentile of the recent latencies after which the
+                backup is sent, between 0 and 100.
+            budget: Maximum fraction of calls that get a backup.
+            window: Number of recent latencies the percentile is taken
+                over.
+            min_samples: Latencies needed before the percentile is used.
+            initial_delay: Delay in seconds until then.
+            min_delay: Lower bound of the delay in seconds.
+            workers: Threads running synchronous calls and their backups.
+            metrics: Optional registry counting the backups.
+        """
+        self.percentile = percentile
+        self.budget = budget
+        self.min_samples = min_samples
+        self.initial_delay = initial_delay
+        self.min_delay = min_delay
+        self.metrics = metrics
+        self.calls = 0
+        self.hedges = 0
+        self.backup_wins = 0
+        self._latencies: Deque[float] = deque(maxlen=window)
+        self._delay = initial_delay
+        self._unsorted = 0
+        self._lock = threading.Lock()
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._workers = workers
+        self._running = 0
+
+    def delay(self) -> float:
+        """
+        Returns the seconds to wait before sending a backup.
+        """
+        with self._lock:
+            return self._delay
+
+    def _record(self, latency: float) -> None:
+        """
+        Adds a latency to the window, refreshing the delay now and then
+        rather than sorting the window on every call.
+        """
+        self._latencies.append(latency)
+        self._unsorted += 1
+        if (len(self._latencies) < self.min_samples
+                or self._unsorted < REFRESH_EVERY):
+            return
+        self._unsorted = 0
+        ordered = sorted(self._latencies)
+        index = math.ceil(self.percentile / 100 * len(ordered)) - 1
+        self._delay = max(self.min_delay, ordered[max(0, index)])
+
+    def _start(self) -> None:
+        with self._lock:
+            self.calls += 1
+
+    def _spend(self) -> bool:
+        """
+        Takes a backup from the budget, if any is left.
+        """
+        with self._lock:
+            if self.hedges + 1 > self.budget * self.calls:
+                return False
+            self.hedges += 1
+            return True
+
+    def _refund(self) -> None:
+        with self._lock:
+            self.hedges -= 1
+
+    def _finish(self, started: float, backup_won: Optional[bool]) -> None:
+        """
+        Records the latency the caller saw and which request won.
+
+        A call answered by its backup is recorded with its elapsed time
+        when the answer came, a lower bound of its own latency, so the
+        tail stays in the window.
+        """
+        with self._lock:
+            self._record(time.monotonic() - started)
+            if backup_won:
+                self.backup_wins += 1
+        if self.metrics is not None and backup_won is not None:
+            self.metrics.inc("model_hedges_total",
+                             winner="backup" if backup_won else "primary")
+
+    def run(self, fn: Callable[[], T],
+            allow: Callable[[], bool] = lambda: True) -> T:
+        """
+        Calls fn, and calls it again if the first call is too slow.
+
+        Args:
+            fn: The model call; may raise.
+            allow: Asked before sending a backup, e.g. for a rate limit
+                token.
+
+        Returns:
+            The first successful result; if both calls raise, the last
+            exception is raised.
+        """
+        self._start()
+        executor = self._pool()
+        running = threading.Event()
+        primary = executor.submit(self._tracked(fn, running))
+        primary.add_done_callback(lambda _: running.set())
+        # The delay counts from when the call starts: time spent queued
+        # behind a saturated pool is not a slow backend, and a backup
+        # would only queue there too
+        running.wait()
+        started = time.monotonic()
+        done, _ = wait_futures([primary], timeout=self.delay())
+        hedge = not done and self._idle_worker() and self._spend()
+        if hedge and not allow():
+            self._refund()
+            hedge = False
+        if not hedge:
+            result = primary.result()
+            self._finish(started, None)
+            return result
+
+        backup = executor.submit(self._tracked(fn))
+        pending = {primary, backup}
+        error: Optional[BaseException] = None
+        while pending:
+            done, pending = wait_futures(pending,
+                                         return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    for loser in pending:
+                        loser.cancel()
+                    self._finish(started, future is backup)
+                    return future.result()
+                error = future.exception()
+        self._finish(started, False)
+        raise error
+
+    async def run_async(self, fn: Callable[[], Awaitable[T]],
+                        allow: Callable[[], bool] = lambda: True) -> T:
+        """
+        Awaits fn(), and awaits it again if the first call is too slow.
+
+        Args:
+            fn: Returns the awaitable model call; may raise.
+            allow: Asked before sending a backup, e.g. for a rate limit
+                token.
+
+        Returns:
+            The first successful result; if both calls raise, the last
+            exception is raised.
+        """
+        self._start()
+        started = time.monotonic()
+        primary = asyncio.ensure_future(fn())
+        pending = {primary}
+        try:
+            done, _ = await asyncio.wait(pending, timeout=self.delay())
+            hedge = not done and self._spend()
+            # allow may block (the rate limiter's SQLite transaction)
+            if hedge and not await asyncio.to_thread(allow):
+                self._refund()
+                hedge = False
+            if not hedge:
+                result = await primary
+                self._finish(started, None)
+                return result
+
+            backup = asyncio.ensure_future(fn())
+            pending.add(backup)
+            error: Optional[BaseException] = None
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        self._finish(started, task is backup)
+                        return task.result()
+                    error = task.exception()
+            self._finish(started, False)
+            raise error
+        finally:
+            # The loser, or both calls if the caller gave up
+            for task in pending:
+                task.cancel()
+
+    def _tracked(self, fn: Callable[[], T],
+                 running: Optional[threading.Event] = None
+                 ) -> Callable[[], T]:
+        """
+        Wraps a synchronous call to count the busy workers and tell when
+        it starts.
+        """
+        def tracked() -> T:
+            with self._lock:
+                self._running += 1
+            if running is not None:
+                running.set()
+            try:
+                return fn()
+            finally:
+                with self._lock:
+                    self._running -= 1
+        return tracked
+
+    def _idle_worker(self) -> bool:
+        """
+        Returns whether a backup would start at once rather than queue.
+        """
+        with self._lock:
+            return self._running < self._workers
+
+    def _pool(self) -> ThreadPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    self._workers, thread_name_prefix="hedged-call")
+            return self._executor
+
+    def close(self) -> None:
+        """
+        Stops the threads of synchronous calls.
+        """
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False)
+
+    def stats(self) -> Dict[str, float]:
+        """
+        Returns how many calls were hedged and how often it paid off.
+        """
+        delay = self.delay()
+        with self._lock:
+            return {
+                "calls": self.calls,
+                "hedges": self.hedges,
+                "hedge_rate": self.hedges / self.calls if self.calls else 0.0,
+                "backup_wins": self.backup_wins,
+                "delay_ms": delay * 1000,
+            }
@@ -0,0 +1,222 @@
+import atexit
+import json
+import queue
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+from app.src.models.scan_result import ScanResult
+from app.src.config.settings import settings
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS scan_history (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    created_at REAL NOT NULL,
+    source TEXT NOT NULL,
+    image_hash TEXT NOT NULL,
+    outcome TEXT NOT NULL,
+    fruit TEXT,
+    plu INTEGER,
+    price REAL,
+    agent_output TEXT,
+    refined_output TEXT,
+    error TEXT,
+    timings TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS scan_history_created_at
+    ON scan_history (created_at);
+CREATE INDEX IF NOT EXISTS scan_history_image_hash
+    ON scan_history (image_hash);
+"""
+
+INSERT = (
+    "INSERT INTO scan_history (created_at, source, image_hash, outcome, "
+    "fruit, plu, price, agent_output, refined_output, error, timings) "
+    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
+)
+
+# A queued scan: when, from where, the image hash and the result
+Pending = Tuple[float, str, str, ScanResult]
+
+
+def history_row(created_at: float, source: str, image_hash: str,
+                result: ScanResult) -> Tuple[Any, ...]:
+    """
+    Flattens a scan into a scan_history row.
+    """
+    best_match = result.best_match() if not result.error else None
+    best_match = best_match or {}
+    return (
+        created_at, source, image_hash, result.outcome,
+        best_match.get("fruit"), best_match.get("PLU"),
+        best_match.get("Price"), result.agent_output or None,
+        result.refined_output, result.error,
+        json.dumps({stage: round(ms, 3)
+                    for stage, ms in result.timings.items()}),
+    )
+
+
+class HistoryWriter:
+    """
+    Persists every scan to SQLite without making the scan wait.
+
+    record() only queues the result, identified by the image digest the
+    scan service already computed. A background
+    thread takes what is queued, up to batch_size scans at a time, and
+    inserts them in one transaction, so the write cost is shared by many
+    scans and never paid on the response path. The database runs in WAL
+    mode: readers (audits, exports) do not block the writer.
+
+    The queue is bounded. When it is full, live scans drop their record
+    (counted in the stats) rather than wait, while batch runs can wait a
+    little, which slows the backlog down to what the disk takes.
+    """
+
+    def __init__(self, db_path: str = settings.HISTORY_DB_PATH,
+                 max_queue: int = settings.HISTORY_MAX_QUEUE,
+                 batch_size: int = settings.HISTORY_BATCH_SIZE,
+                 linger: float = settings.HISTORY_LINGER_MS / 1000):
+        """
+        Initializes the writer and creates the table if needed.
+
+        Args:
+            db_path: The SQLite database, the Django one by default.
+                scan_history is not a Django model: the watcher and batch
+                runs write it without Django set up, so the writer owns
+                its schema and `migrate` leaves the table alone.
+            max_queue: Scans waiting to be written beyond which new ones
+                are dropped or wait.
+            batch_size: Maximum scans inserted per transaction.
+            linger: Seconds the thread waits after the first queued scan
+                for more to share its transaction.
+        """
+        self.db_path = db_path
+        self.batch_size = batch_size
+        self.linger = linger
+        self.written = 0
+        self.dropped = 0
+        self.batches = 0
+        self.errors = 0
+        self._queue: "queue.Queue[Optional[Pending]]" = queue.Queue(
+            max_queue)
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self._closed = False
+
+        connection = sqlite3.connect(db_path, timeout=30)
+        try:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.executescript(SCHEMA)
+        finally:
+            connection.close()
+        # Records still queued at exit are written, not lost
+        atexit.register(self.close)
+
+    def record(self, result: ScanResult, source: str,
+               timeout: float = 0.0) -> bool:
+        """
+        Queues a scan for writing.
+
+        Args:
+            result: The scan's result, with the digest of its image.
+            source: Where the scan came from ("web", "watch", "batch").
+            timeout: Seconds to wait for room in a full queue; 0 drops
+                the record at once.
+
+        Returns:
+            Whether the record was queued.
+        """
+        pending = (time.time(), source, result.image_digest or "", result)
+        with self._lock:
+            if self._closed:
+                return False
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="history-writer", daemon=True)
+                self._thread.start()
+        try:
+            if timeout > 0:
+                self._queue.put(pending, timeout=timeout)
+            else:
+                self._queue.put_nowait(pending)
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+            return False
+        return True
+
+    def _run(self) -> None:
+        """
+        Writes what is queued, batch after batch, until closed.
+        """
+        connection = sqlite3.connect(self.db_path, timeout=30)
+        connection.execute("PRAGMA journal_mode=WAL")
+        # WAL keeps the database consistent on a crash; NORMAL only risks
+        # the last transactions, i.e. a few history rows
+        connection.execute("PRAGMA synchronous=NORMAL")
+        try:
+            while True:
+                pending = self._queue.get()
+                if pending is None:
+                    return
+                # Let a batch build up rather than wake up for every scan
+                if self.linger > 0 and self._queue.qsize() < self.batch_size:
+                    time.sleep(self.linger)
+                batch = [pending]
+                while len(batch) < self.batch_size:
+                    try:
+                        pending = self._queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if pending is None:
+                        self._insert(connection, batch)
+                        return
+                    batch.append(pending)
+                self._insert(connection, batch)
+        finally:
+            connection.close()
+
+    def _insert(self, connection: sqlite3.Connection,
+                batch: List[Pending]) -> None:
+        try:
+            rows = [history_row(*pending) for pending in batch]
+            with connection:
+                connection.executemany(INSERT, rows)
+        except Exception as e:
+            print(f"Error writing scan history: {e}")
+            with self._lock:
+                self.errors += len(batch)
+            return
+        with self._lock:
+            self.written += len(batch)
+            self.batches += 1
+
+    def close(self) -> None:
+        """
+        Writes the scans still queued and stops the thread.
+        """
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            thread = self._thread
+        if thread is not None:
+            self._queue.put(None)
+            thread.join()
+        atexit.unregister(self.close)
+
+    def stats(self) -> Dict[str, float]:
+        """
+        Returns how many scans were written, are queued or were dropped.
+        """
+        with self._lock:
+            return {
+                "queued": self._queue.qsize(),
+                "written": self.written,
+                "dropped": self.dropped,
+                "errors": self.errors,
+                "batches": self.batches,
+                "mean_batch_size": (self.written / self.batches
+                                    if self.batches else 0.0),
+            }
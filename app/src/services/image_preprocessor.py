@@ -0,0 +1,172 @@
+import io
+import math
+from dataclasses import dataclass
+from typing import Optional
+from PIL import Image, ImageOps
+from app.src.config.settings import settings
+
+
+# Magic numbers of the formats scales and browsers send us
+SIGNATURES = (
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+    (b"BM", "image/bmp"),
+)
+
+MIME_TYPES = {
+    "JPEG": "image/jpeg",
+    "PNG": "image/png",
+    "WEBP": "image/webp",
+}
+
+
+def flatten(image: Image.Image) -> Image.Image:
+    """
+    Converts an image to RGB, compositing transparent areas over white.
+
+    A plain convert() would turn them black, which the model may read as
+    a dark tray or a bruise.
+    """
+    if image.mode in ("RGBA", "LA", "PA") or "transparency" in image.info:
+        image = image.convert("RGBA")
+        background = Image.new("RGBA", image.size, (255, 255, 255, 255))
+        return Image.alpha_composite(background, image).convert("RGB")
+    return image.convert("RGB")
+
+
+def sniff_mime_type(image_bytes: bytes) -> Optional[str]:
+    """
+    Detects the real format of an image from its first bytes.
+
+    Args:
+        image_bytes: The image data in bytes.
+
+    Returns:
+        The MIME type, or None if the format is not recognised.
+    """
+    for signature, mime_type in SIGNATURES:
+        if image_bytes.startswith(signature):
+            return mime_type
+    if image_bytes[:4] == b"RIFF" and image_bytes[8:12] == b"WEBP":
+        return "image/webp"
+    if image_bytes[4:12] in (b"ftypheic", b"ftypheix", b"ftypmif1"):
+        return "image/heic"
+    return None
+
+
+@dataclass
+class PreparedImage:
+    """
+    An image ready to be sent to the model.
+    """
+    data: bytes
+    mime_type: str
+    original_bytes: int
+
+    @property
+    def bytes_saved(self) -> int:
+        return self.original_bytes - len(self.data)
+
+
+class ImagePreprocessor:
+    """
+    Shrinks uploads before they are sent to the model.
+
+    Detects the real format, optionally centre-crops, downscales to a
+    maximum side and re-encodes to a compact format. Upload size drives
+    most of the network latency of a scan.
+    """
+
+    def __init__(self,
+                 max_side: int = settings.PREPROCESS_MAX_SIDE,
+                 output_format: str = settings.PREPROCESS_FORMAT,
+                 quality: int = settings.PREPROCESS_QUALITY,
+                 crop: float = settings.PREPROCESS_CROP):
+        """
+        Initializes the preprocessor.
+
+        Args:
+            max_side: Longest side, in pixels, of the image sent. 0 keeps
+                the original resolution.
+            output_format: Pillow format to re-encode to (JPEG or WEBP).
+            quality: Encoder quality, from 1 to 95.
+            crop: Fraction of each side kept around the centre. 1.0
+                disables cropping.
+        """
+        self.max_side = max_side
+        self.output_format = output_format.upper()
+        self.quality = quality
+        self.crop = crop
+
+    def prepare(self, image_bytes: bytes) -> PreparedImage:
+        """
+        Preprocesses an image.
+
+        Args:
+            image_bytes: The uploaded image data in bytes.
+
+        Returns:
+            The prepared image. Images that cannot be decoded, or that
+            would not get smaller, are passed through with their real
+            MIME type.
+        """
+        original = PreparedImage(
+            data=image_bytes,
+            mime_type=sniff_mime_type(image_bytes) or "image/png",
+            original_bytes=len(image_bytes),
+        )
+
+        try:
+            data = self._reencode(image_bytes)
+        except Exception as e:
+            print(f"Error preprocessing image: {e}")
+            return original
+
+        if len(data) >= len(image_bytes):
+            return original
+
+        prepared = PreparedImage(
+            data=data,
+            mime_type=MIME_TYPES.get(self.output_format, "image/jpeg"),
+            original_bytes=len(image_bytes),
+        )
+        print(f"Image preprocessed: {prepared.original_bytes} -> "
+              f"{len(prepared.data)} bytes "
+              f"({prepared.bytes_saved / prepared.original_bytes:.0%} saved)")
+        return prepared
+
+    def _reencode(self, image_bytes: bytes) -> bytes:
+        """
+        Crops, downscales and re-encodes an image.
+        """
+        cropping = 0 < self.crop < 1
+        with Image.open(io.BytesIO(image_bytes)) as image:
+            if self.max_side:
+                # Let the JPEG decoder downscale while decoding, keeping
+                # enough pixels for the cropped region to fill max_side
+                side = (math.ceil(self.max_side / self.crop) if cropping
+                        else self.max_side)
+                image.draft("RGB", (side, side))
+            image = ImageOps.exif_transpose(image)
+
+            if cropping:
+                width, height = image.size
+                crop_w = int(width * self.crop)
+                crop_h = int(height * self.crop)
+                left = (width - crop_w) // 2
+                top = (height - crop_h) // 2
+                image = image.crop((left, top, left + crop_w, top + crop_h))
+
+            if image.mode not in ("RGB", "L") or "transparency" in image.info:
+                image = flatten(image)
+
+            if self.max_side:
+                image.thumbnail((self.max_side, self.max_side),
+                                Image.Resampling.LANCZOS)
+
+            buffer = io.BytesIO()
+            image.save(buffer, self.output_format, quality=self.quality,
+                       optimize=True)
+            return buffer.getvalue()
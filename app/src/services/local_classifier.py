@@ -0,0 +1,311 @@
+import heapq
+import io
+import json
+import math
+import os
+import threading
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+from PIL import Image, ImageFilter, ImageStat
+from app.src.config.settings import settings
+
+
+MODEL_FORMAT = "smart-scale-knn"
+MODEL_VERSION = 1
+
+# Hue bins of the colourful pixels, then value bins of the grey ones
+HUE_BINS = 12
+GREY_BINS = 3
+# Pixels less saturated than this count as grey (background, tray, bags)
+MIN_SATURATION = 48
+THUMBNAIL_SIDE = 32
+
+FEATURE_NAMES = (
+    [f"hue_{i}" for i in range(HUE_BINS)]
+    + [f"grey_{i}" for i in range(GREY_BINS)]
+    + ["saturation", "value", "edges"]
+)
+
+
+def extract_features(image_bytes: bytes) -> Optional[List[float]]:
+    """
+    Describes an image by its colours and texture.
+
+    The image is reduced to a 32x32 thumbnail. The features are the share
+    of pixels in each hue bin (saturated pixels) or brightness bin (grey
+    pixels), the mean saturation and brightness, and the mean edge
+    strength, every value between 0 and 1.
+
+    Args:
+        image_bytes: The image data in bytes.
+
+    Returns:
+        The feature vector, or None if the image cannot be decoded.
+    """
+    try:
+        with Image.open(io.BytesIO(image_bytes)) as image:
+            image.draft("RGB", (THUMBNAIL_SIDE * 4, THUMBNAIL_SIDE * 4))
+            thumbnail = image.convert("RGB").resize(
+                (THUMBNAIL_SIDE, THUMBNAIL_SIDE), Image.Resampling.BILINEAR)
+    except Exception as e:
+        print(f"Error extracting image features: {e}")
+        return None
+
+    hue, saturation, value = thumbnail.convert("HSV").split()
+    colourful = saturation.point(
+        lambda s: 255 if s >= MIN_SATURATION else 0)
+    grey = saturation.point(lambda s: 0 if s >= MIN_SATURATION else 255)
+    pixels = THUMBNAIL_SIDE * THUMBNAIL_SIDE
+
+    # Pillow histograms run in C; the 256 levels are folded into bins
+    hues = hue.histogram(colourful)
+    features = [sum(hues[i * 256 // HUE_BINS:(i + 1) * 256 // HUE_BINS])
+                / pixels for i in range(HUE_BINS)]
+    values = value.histogram(grey)
+    features += [sum(values[i * 256 // GREY_BINS:(i + 1) * 256 // GREY_BINS])
+                 / pixels for i in range(GREY_BINS)]
+
+    edges = thumbnail.convert("L").filter(ImageFilter.FIND_EDGES)
+    features += [ImageStat.Stat(saturation).mean[0] / 255,
+                 ImageStat.Stat(value).mean[0] / 255,
+                 ImageStat.Stat(edges).mean[0] / 255]
+    return features
+
+
+@dataclass
+class LocalPrediction:
+    """
+    Answer of the local classifier for one image.
+    """
+    plu: int
+    confidence: float
+    distance: float
+
+
+class LocalClassifier:
+    """
+    k-nearest-neighbours classifier over colour and texture features,
+    trained from confirmed classifications.
+
+    The k stored examples closest to an image vote for their PLU, weighted
+    by the inverse of their distance. The share of the vote won by the
+    best PLU is the confidence. Scans are answered locally only when it
+    reaches the threshold and the nearest example is no farther than
+    max_distance, which rejects products the model was never trained on.
+    """
+
+    def __init__(self,
+                 samples: Sequence[Tuple[int, Sequence[float]]],
+                 k: int = 5,
+                 max_distance: float = math.inf,
+                 threshold: float = settings.LOCAL_CLASSIFIER_THRESHOLD):
+        """
+        Initializes the classifier.
+
+        Args:
+            samples: (PLU, feature vector) of every training example.
+            k: Number of neighbours voting.
+            max_distance: Farthest nearest neighbour still trusted.
+            threshold: Minimum confidence to answer without the model.
+        """
+        self.labels = [plu for plu, _ in samples]
+        self.vectors = [tuple(vector) for _, vector in samples]
+        self.k = k
+        self.max_distance = max_distance
+        self.threshold = threshold
+        self.offloaded = 0
+        self.deferred = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def train(cls, examples: Iterable[Tuple[int, bytes]], k: int = 5,
+              distance_percentile: float = 0.95,
+              **kwargs) -> "LocalClassifier":
+        """
+        Builds a classifier from labelled images.
+
+        Args:
+            examples: (PLU, image bytes) of confirmed classifications.
+            k: Number of neighbours voting.
+            distance_percentile: Share of the training examples whose
+                nearest other example must stay within max_distance.
+            **kwargs: Passed to the constructor.
+
+        Returns:
+            The trained classifier. Images that cannot be decoded are
+            skipped.
+        """
+        samples = []
+        for plu, image_bytes in examples:
+            features = extract_features(image_bytes)
+            if features is not None:
+                samples.append((plu, features))
+
+        classifier = cls(samples, k=k, **kwargs)
+        if len(samples) > 1:
+            nearest = sorted(classifier._neighbours(vector, exclude=i)[0][0]
+                             for i, vector in enumerate(classifier.vectors))
+            index = min(len(nearest) - 1,
+                        int(distance_percentile * len(nearest)))
+            classifier.max_distance = nearest[index]
+        return classifier
+
+    @classmethod
+    def from_file(cls, path: str = settings.LOCAL_CLASSIFIER_PATH,
+                  **kwargs) -> Optional["LocalClassifier"]:
+        """
+        Loads a classifier saved with save().
+
+        Returns:
+            The classifier, or None if the file is missing or invalid.
+        """
+        if not path or not os.path.exists(path):
+            return None
+        try:
+            with open(path, 'r') as f:
+                data = json.load(f)
+            if (data.get("format") != MODEL_FORMAT
+                    or data.get("version") != MODEL_VERSION
+                    or data.get("features") != FEATURE_NAMES):
+                raise ValueError("unsupported model format")
+            samples = [(int(s["PLU"]), [float(x) for x in s["features"]])
+                       for s in data["samples"]]
+            return cls(samples, k=int(data["k"]),
+                       max_distance=float(data["max_distance"]), **kwargs)
+        except Exception as e:
+            print(f"Error loading local classifier from {path}: {e}")
+            return None
+
+    def save(self, path: str) -> None:
+        """
+        Writes the classifier as JSON: the format name and version, the
+        feature names, k, max_distance and every (PLU, features) example.
+        """
+        data = {
+            "format": MODEL_FORMAT,
+            "version": MODEL_VERSION,
+            "features": FEATURE_NAMES,
+            "k": self.k,
+            "max_distance": round(self.max_distance, 6),
+            "samples": [{"PLU": plu, "features": [round(x, 6) for x in v]}
+                        for plu, v in zip(self.labels, self.vectors)],
+        }
+        temporary = f"{path}.{os.getpid()}.tmp"
+        with open(temporary, 'w') as f:
+            json.dump(data, f)
+        os.replace(temporary, path)
+
+    def __len__(self) -> int:
+        return len(self.labels)
+
+    def _neighbours(self, vector: Sequence[float],
+                    exclude: int = -1) -> List[Tuple[float, int]]:
+        """
+        Returns the (distance, index) of the k nearest examples.
+        """
+        # math.dist runs in C, which keeps a brute-force search over a
+        # few thousand examples to a couple of milliseconds
+        distances = map(math.dist, self.vectors,
+                        [vector] * len(self.vectors))
+        return heapq.nsmallest(
+            self.k, ((d, i) for i, d in enumerate(distances) if i != exclude))
+
+    def predict(self, features: Sequence[float],
+                exclude: int = -1) -> Optional[LocalPrediction]:
+        """
+        Returns the most likely PLU of a feature vector, however unsure.
+
+        Args:
+            features: Output of extract_features().
+            exclude: Index of a training example to leave out.
+
+        Returns:
+            The prediction, or None without training examples.
+        """
+        neighbours = self._neighbours(features, exclude)
+        if not neighbours:
+            return None
+
+        votes: Dict[int, float] = {}
+        for distance, index in neighbours:
+            plu = self.labels[index]
+            votes[plu] = votes.get(plu, 0.0) + 1 / (distance + 1e-6)
+        plu = max(votes, key=votes.get)
+        return LocalPrediction(plu, votes[plu] / sum(votes.values()),
+                               neighbours[0][0])
+
+    def is_confident(self, prediction: LocalPrediction,
+                     threshold: Optional[float] = None) -> bool:
+        if threshold is None:
+            threshold = self.threshold
+        return (prediction.confidence >= threshold
+                and prediction.distance <= self.max_distance)
+
+    def classify(self, image_bytes: bytes) -> Optional[LocalPrediction]:
+        """
+        Classifies an image if the classifier is confident enough.
+
+        Args:
+            image_bytes: The image data in bytes.
+
+        Returns:
+            The prediction, or None when the model should decide.
+        """
+        features = extract_features(image_bytes)
+        prediction = (self.predict(features)
+                      if features is not None else None)
+        confident = (prediction is not None
+                     and self.is_confident(prediction))
+        with self._lock:
+            if confident:
+                self.offloaded += 1
+            else:
+                self.deferred += 1
+        return prediction if confident else None
+
+    def evaluate(self, examples: Iterable[Tuple[int, bytes]],
+                 thresholds: Iterable[float]) -> List[Dict[str, float]]:
+        """
+        Measures offload rate against accuracy on labelled images kept
+        out of training, e.g. the most recent ones: near-identical frames
+        of the same scan on both sides would overstate the accuracy.
+
+        Args:
+            examples: (PLU, image bytes) of the held-out images.
+            thresholds: The confidence thresholds to report.
+
+        Returns:
+            For each threshold, the share of scans answered locally
+            (offload_rate) and the share of those answered right
+            (accuracy).
+        """
+        predictions = []
+        for plu, image_bytes in examples:
+            features = extract_features(image_bytes)
+            predictions.append((plu, self.predict(features)
+                                if features is not None else None))
+        report = []
+        for threshold in thresholds:
+            answered = [(plu, p) for plu, p in predictions
+                        if p is not None and self.is_confident(p, threshold)]
+            correct = sum(1 for plu, p in answered if p.plu == plu)
+            report.append({
+                "threshold": threshold,
+                "offload_rate": (len(answered) / len(predictions)
+                                 if predictions else 0.0),
+                "accuracy": correct / len(answered) if answered else 0.0,
+            })
+        return report
+
+    def stats(self) -> Dict[str, float]:
+        """
+        Returns how many scans were answered without the model.
+        """
+        with self._lock:
+            total = self.offloaded + self.deferred
+            return {
+                "examples": len(self.labels),
+                "offloaded": self.offloaded,
+                "deferred": self.deferred,
+                "offload_rate": self.offloaded / total if total else 0.0,
+            }
@@ -1,7 +1,12 @@
-import json
-from typing import List, Dict, Any
+from typing import Callable, List, Dict, Any, Optional, Sequence, Union
+from app.src.models.analysis_result import AnalysisResult
+from app.src.models.inference_session import InferenceSession
 from app.src.models.product import Product
+from app.src.repositories.picklist_store import PicklistStore
+from app.src.repositories.sqlite_picklist_repository import SqlitePicklist
 from app.src.services.ai_service import AIService
+from app.src.services.output_parser import ParseError, parse_answer
+from app.src.services.product_index import ProductIndex
 
 
 class MatchingService:
@@ -9,65 +14,144 @@ class MatchingService:
     Service for matching AI output with the product picklist.
     """
 
-    def __init__(self, picklist: List[Product]):
+    def __init__(self, picklist: Sequence[Product]):
         """
-        Initializes the service with a product list.
+        Initializes the service with a product list and indexes it.
 
         Args:
-            picklist: List of available products.
+            picklist: List of available products, a PicklistStore, or
+                the live SqlitePicklist.
         """
         self.picklist = picklist
+        # Stores are searched directly: the snapshot carries its n-gram
+        # index, the SQLite picklist its FTS index
+        self.index: Union[ProductIndex, PicklistStore, SqlitePicklist] = (
+            picklist if isinstance(picklist, (PicklistStore, SqlitePicklist))
+            else ProductIndex(picklist))
+        # Stores already carry a PLU index
+        self._get_by_plu: Callable[[int], Optional[Product]] = (
+            picklist.get_by_plu
+            if isinstance(picklist, (PicklistStore, SqlitePicklist))
+            else {p.plu: p for p in picklist}.get)
 
-    def find_matches(self, agent_output: str) -> List[Product]:
+    @staticmethod
+    def parse_agent_output(agent_output: str) -> Dict[str, Any]:
         """
-        Parses agent output and finds matching products in the picklist.
+        Parses the agent output.
 
         Args:
             agent_output: JSON string returned by the agent.
 
         Returns:
-            A list of matching Product objects.
+            The parsed object, or an empty dict if the output is invalid.
         """
         try:
-            agent_json: Dict[str, Any] = json.loads(agent_output)
-        except json.JSONDecodeError as e:
+            return parse_answer(agent_output)
+        except ParseError as e:
             print(f"Error parsing agent output: {e}\n"
                   f"Output was: {agent_output}")
-            return []
-        except Exception as e:
-            print(f"Unexpected error: {e}")
-            return []
+            return {}
+
+    @classmethod
+    def extract_fruit(cls, agent_output: str) -> str:
+        """
+        Extracts the fruit name from the agent output.
+
+        Args:
+            agent_output: JSON string returned by the agent.
+
+        Returns:
+            The fruit name, or an empty string if the output is invalid.
+        """
+        return str(cls.parse_agent_output(agent_output).get("fruit", ""))
+
+    def get_by_plu(self, plu: int) -> Optional[Product]:
+        """
+        Returns the picklist product with a PLU code, or None.
+        """
+        return self._get_by_plu(plu)
+
+    def find_by_plu(self, agent_output: str) -> Optional[Product]:
+        """
+        Returns the picklist product whose PLU the agent answered with.
+
+        Args:
+            agent_output: JSON string returned by the agent.
+
+        Returns:
+            The product, or None if the output has no known PLU.
+        """
+        try:
+            plu = int(self.parse_agent_output(agent_output).get("PLU"))
+        except (TypeError, ValueError):
+            return None
+        return self._get_by_plu(plu)
+
+    def find_matches(self, agent_output: str) -> List[Product]:
+        """
+        Parses agent output and finds matching products in the picklist.
 
-        target_fruit = str(agent_json.get("fruit", "")).lower()
+        Args:
+            agent_output: JSON string returned by the agent.
+
+        Returns:
+            A list of matching Product objects, best match first. Case and
+            accents are ignored, so "Maca" matches "Maçã".
+        """
+        target_fruit = self.extract_fruit(agent_output)
         if not target_fruit:
             return []
 
-        matches = []
-        for product in self.picklist:
-            if target_fruit in product.fruit.lower():
-                matches.append(product)
-
-        return matches
+        return self.index.search(target_fruit)
 
     def refine_match(self, ai_service: AIService,
-                     matches: List[Product]) -> str:
+                     session: InferenceSession) -> AnalysisResult:
         """
         Asks the AI to pick the best match from a list of candidates.
 
         Args:
             ai_service: The AI service instance.
+            session: The scan's session, holding the image and the
+                candidate products.
+
+        Returns:
+            The refined JSON answer from the AI.
+        """
+        return ai_service.refine_analysis(
+            session, self.refinement_prompt(session.matches))
+
+    async def refine_match_async(self, ai_service: AIService,
+                                 session: InferenceSession) -> AnalysisResult:
+        """
+        Asks the AI to pick the best match without blocking the event loop.
+
+        Args:
+            ai_service: The AI service instance.
+            session: The scan's session, holding the image and the
+                candidate products.
+
+        Returns:
+            The refined JSON answer from the AI.
+        """
+        return await ai_service.refine_analysis_async(
+            session, self.refinement_prompt(session.matches))
+
+    @staticmethod
+    def refinement_prompt(matches: List[Product]) -> str:
+        """
+        Builds the prompt asking the AI to choose between candidates.
+
+        Args:
             matches: List of candidate products.
 
         Returns:
-            The refined JSON string from the AI.
+            The refinement prompt.
         """
         matches_json = [p.to_dict() for p in matches]
 
-        new_prompt = (
+        return (
             f"Re-examine the image. Select the best matching JSON from the "
             f"provided list (confidence threshold: 0.95). "
             f"Return ONLY the JSON object.\n\n"
             f"List: {matches_json}"
         )
-
-        return ai_service.refine_analysis(new_prompt)
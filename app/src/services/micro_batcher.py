@@ -0,0 +1,190 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Dict, List
+from app.src.models.analysis_result import AnalysisResult
+from app.src.models.inference_session import InferenceSession
+from app.src.services.ai_service import AIService
+from app.src.config.settings import settings
+
+
+@dataclass
+class PendingImage:
+    """
+    A scan waiting in the batcher for the analysis of its image.
+    """
+    session: InferenceSession
+    future: Future = field(default_factory=Future)
+
+
+class MicroBatcher:
+    """
+    Groups the analyze calls of concurrent scans into multi-image calls.
+
+    The first image to arrive opens a batch. The batch is sent when the
+    window has elapsed or max_size images joined it, as one prompt asking
+    for an indexed JSON array, and each caller receives its own answer.
+    Images the answer does not cover are analysed one by one, all at the
+    same time.
+
+    A collector thread owns the queue, so synchronous scans (threads of
+    the batch mode) and asynchronous ones (the classify view) share the
+    same batches. It exposes the analyze methods of AIService and stands
+    in for it in ScanService.
+    """
+
+    def __init__(self, ai_service: AIService,
+                 window: float = settings.MICRO_BATCH_WINDOW_MS / 1000,
+                 max_size: int = settings.MICRO_BATCH_MAX_SIZE,
+                 workers: int = settings.MICRO_BATCH_WORKERS):
+        """
+        Initializes the batcher.
+
+        Args:
+            ai_service: The service making the model calls.
+            window: Seconds a batch waits for more images after the
+                first one.
+            max_size: Images per call; a full batch is sent at once.
+            workers: Batches in flight at the same time.
+        """
+        self.ai_service = ai_service
+        self.window = window
+        self.max_size = max_size
+        self.batches = 0
+        self.images = 0
+        self.fallbacks = 0
+        self._queue: List[PendingImage] = []
+        self._condition = threading.Condition()
+        self._executor = ThreadPoolExecutor(workers,
+                                            thread_name_prefix="micro-batch")
+        # Enough for every image of every batch in flight to fall back
+        self._fallback_executor = ThreadPoolExecutor(
+            workers * max_size, thread_name_prefix="micro-batch-fallback")
+        self._collector = None
+        self._closed = False
+
+    def submit(self, session: InferenceSession) -> Future:
+        """
+        Queues the image of a session for the next batch.
+
+        Returns:
+            A future resolved with the AnalysisResult of the image.
+        """
+        pending = PendingImage(session)
+        with self._condition:
+            if self._closed:
+                raise RuntimeError("MicroBatcher is closed")
+            if self._collector is None:
+                self._collector = threading.Thread(
+                    target=self._collect, name="micro-batch-collector",
+                    daemon=True)
+                self._collector.start()
+            self._queue.append(pending)
+            self._condition.notify()
+        return pending.future
+
+    def analyze_image(self, session: InferenceSession) -> AnalysisResult:
+        """
+        Analyzes the image of a session as part of the next batch.
+        """
+        return self.submit(session).result()
+
+    async def analyze_image_async(self, session: InferenceSession
+                                  ) -> AnalysisResult:
+        """
+        Analyzes the image of a session as part of the next batch, without
+        blocking the event loop.
+        """
+        return await asyncio.wrap_future(self.submit(session))
+
+    def _collect(self) -> None:
+        """
+        Cuts the queue into batches until the batcher is closed.
+        """
+        while True:
+            with self._condition:
+                while not self._queue and not self._closed:
+                    self._condition.wait()
+                if not self._queue:
+                    return
+                closes_at = time.monotonic() + self.window
+                while len(self._queue) < self.max_size and not self._closed:
+                    remaining = closes_at - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._condition.wait(remaining)
+                batch = self._queue[:self.max_size]
+                del self._queue[:self.max_size]
+            self._executor.submit(self._send, batch)
+
+    def _send(self, batch: List[PendingImage]) -> None:
+        """
+        Analyzes a batch and resolves the future of each image.
+        """
+        # Callers that gave up (deadline, disconnect) are left out
+        batch = [p for p in batch if p.future.set_running_or_notify_cancel()]
+        if not batch:
+            return
+        try:
+            if len(batch) == 1:
+                results = [None]
+            else:
+                results = self.ai_service.analyze_images(
+                    [p.session for p in batch])
+            fallbacks = 0
+            for pending, result in zip(batch, results):
+                if result is None:
+                    if len(batch) > 1:
+                        fallbacks += 1
+                    # Not one after another: the last image would wait
+                    # for every call before its own
+                    self._fallback_executor.submit(self._fallback, pending)
+                else:
+                    pending.future.set_result(result)
+        except Exception as e:
+            for pending in batch:
+                if not pending.future.done():
+                    pending.future.set_exception(e)
+            return
+        with self._condition:
+            self.batches += 1
+            self.images += len(batch)
+            self.fallbacks += fallbacks
+
+    def _fallback(self, pending: PendingImage) -> None:
+        """
+        Analyzes an image on its own and resolves its future.
+        """
+        try:
+            pending.future.set_result(
+                self.ai_service.analyze_image(pending.session))
+        except Exception as e:
+            pending.future.set_exception(e)
+
+    def close(self) -> None:
+        """
+        Sends the images still queued and stops the threads.
+        """
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+            collector = self._collector
+        if collector is not None:
+            collector.join()
+        self._executor.shutdown()
+        self._fallback_executor.shutdown()
+
+    def stats(self) -> Dict[str, float]:
+        """
+        Returns how many images were sent per call.
+        """
+        with self._condition:
+            return {
+                "batches": self.batches,
+                "images": self.images,
+                "mean_batch_size": (self.images / self.batches
+                                    if self.batches else 0.0),
+                "fallbacks": self.fallbacks,
+            }
@@ -0,0 +1,147 @@
+import ast
+import json
+from typing import Any, Dict, Iterable, List, Tuple
+
+
+# Attempts at cutting a truncated answer back to its last complete value
+MAX_REPAIRS = 4
+# How a JSON text can end right after a complete value
+COMPLETE_ENDINGS = ('"', "}", "]", "true", "false", "null")
+
+_decoder = json.JSONDecoder()
+
+
+class ParseError(ValueError):
+    """
+    Raised when a model answer is not the JSON that was asked for.
+    """
+
+
+def _strip_fence(text: str) -> str:
+    """
+    Removes a Markdown code fence around the answer, closed or not.
+    """
+    text = text.strip()
+    if text.startswith("```"):
+        text = text[3:]
+        # Language tag of the fence, e.g. ```json
+        newline = text.find("\n")
+        if newline != -1 and text[:newline].strip().isalnum():
+            text = text[newline + 1:]
+        closing = text.rfind("```")
+        if closing != -1:
+            text = text[:closing]
+    return text.strip()
+
+
+def _closers(text: str) -> Tuple[bool, str, List[int]]:
+    """
+    Scans JSON text and returns whether it ends inside a string, the
+    brackets still open and the offsets of the commas between values.
+    """
+    stack: List[str] = []
+    commas: List[int] = []
+    in_string = escaped = False
+    for offset, char in enumerate(text):
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == "\\":
+                escaped = True
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = True
+        elif char in "{[":
+            stack.append("}" if char == "{" else "]")
+        elif char in "}]" and stack:
+            stack.pop()
+        elif char == ",":
+            commas.append(offset)
+    return in_string, "".join(reversed(stack)), commas
+
+
+def _repair(text: str) -> Any:
+    """
+    Completes an answer cut short (e.g. by the output token limit) by
+    closing its open brackets. A value cut in the middle (a string or a
+    number) is dropped with its member rather than kept truncated.
+    """
+    in_string, closers, commas = _closers(text)
+    candidates = []
+    if not in_string and text.rstrip().endswith(COMPLETE_ENDINGS):
+        candidates.append(text + closers)
+    for comma in reversed(commas[-MAX_REPAIRS:]):
+        prefix = text[:comma]
+        in_string, closers, _ = _closers(prefix)
+        if not in_string:
+            candidates.append(prefix + closers)
+    for candidate in candidates:
+        try:
+            return json.loads(candidate)
+        except json.JSONDecodeError:
+            continue
+    raise ParseError("Truncated JSON answer")
+
+
+def parse_model_output(text: str) -> Any:
+    """
+    Parses the JSON answer of the model.
+
+    Tolerates what models actually send: a code fence, text around the
+    JSON value, Python-style quotes and an answer cut short, of which the
+    complete members are kept. Apostrophes inside names are preserved.
+
+    Args:
+        text: The model's answer.
+
+    Returns:
+        The JSON object or array.
+
+    Raises:
+        ParseError: If no JSON object or array can be recovered.
+    """
+    if not text:
+        raise ParseError("Empty answer")
+    text = _strip_fence(text)
+    starts = [i for i in (text.find("{"), text.find("[")) if i != -1]
+    if not starts:
+        raise ParseError(f"No JSON in answer: {text[:80]!r}")
+    text = text[min(starts):]
+
+    try:
+        # raw_decode ignores whatever follows the value
+        return _decoder.raw_decode(text)[0]
+    except json.JSONDecodeError:
+        pass
+    try:
+        value = ast.literal_eval(text)
+        if isinstance(value, (dict, list)):
+            return value
+    except (ValueError, SyntaxError, MemoryError, RecursionError):
+        pass
+    return _repair(text)
+
+
+def parse_answer(text: str,
+                 required: Iterable[str] = ()) -> Dict[str, Any]:
+    """
+    Parses an answer that must be a JSON object.
+
+    Args:
+        text: The model's answer.
+        required: Fields the object must have.
+
+    Returns:
+        The object.
+
+    Raises:
+        ParseError: If the answer is not an object with those fields.
+    """
+    value = parse_model_output(text)
+    if not isinstance(value, dict):
+        raise ParseError(f"Expected a JSON object, got {type(value).__name__}")
+    missing = [name for name in required if name not in value]
+    if missing:
+        raise ParseError(f"Missing fields: {', '.join(missing)}")
+    return value
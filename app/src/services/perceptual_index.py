@@ -0,0 +1,280 @@
+import io
+import math
+import random
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Set, Tuple
+from PIL import Image
+from app.src.config.settings import settings
+
+
+HASH_BITS = 64
+
+# Colour signature stored above the dHash bits: the mean hue in one of
+# HUE_BUCKETS sectors, or GREY for images with little colour
+HUE_BUCKETS = 12
+GREY = HUE_BUCKETS
+MIN_SATURATION = 0.1
+
+
+def colour_bucket(image: Image.Image) -> int:
+    """
+    Returns the coarse colour of an image: its mean hue sector, or GREY.
+
+    Hues are averaged on the colour wheel, each pixel weighted by its
+    saturation and brightness, so a grey tray around the product counts
+    for little and red hues either side of 0 degrees do not cancel out.
+    """
+    x = y = weight = 0.0
+    pixels = 0
+    for hue, saturation, value in image.convert("HSV").getdata():
+        pixel_weight = saturation / 255 * value / 255
+        angle = hue / 256 * 2 * math.pi
+        x += pixel_weight * math.cos(angle)
+        y += pixel_weight * math.sin(angle)
+        weight += pixel_weight
+        pixels += 1
+    if not pixels or weight / pixels < MIN_SATURATION:
+        return GREY
+    angle = math.atan2(y, x) % (2 * math.pi)
+    return int(angle / (2 * math.pi) * HUE_BUCKETS) % HUE_BUCKETS
+
+
+def dhash(image_bytes: bytes, hash_size: int = 8) -> Optional[int]:
+    """
+    Computes the difference hash (dHash) of an image, with its colour.
+
+    The image is reduced to a (hash_size + 1) x hash_size thumbnail and
+    each bit records whether a pixel is brighter than its right-hand
+    neighbour, so small changes in framing, lighting or noise flip only a
+    few bits. Brightness alone cannot tell a red apple from a yellow one
+    of the same shape, so the colour bucket of the thumbnail is put in
+    the bits above the hash; near-duplicates must share it.
+
+    Args:
+        image_bytes: The image data in bytes.
+        hash_size: Side of the hash grid; 8 gives a 64-bit hash.
+
+    Returns:
+        The hash as an integer, or None if the image cannot be decoded.
+    """
+    try:
+        with Image.open(io.BytesIO(image_bytes)) as image:
+            # Let the JPEG decoder downscale while decoding
+            image.draft("RGB", (hash_size * 8, hash_size * 8))
+            thumbnail = image.convert("RGB").resize(
+                (hash_size + 1, hash_size), Image.Resampling.BILINEAR)
+            pixels = list(thumbnail.convert("L").getdata())
+            colour = colour_bucket(thumbnail)
+    except Exception as e:
+        print(f"Error computing perceptual hash: {e}")
+        return None
+
+    value = 0
+    row_width = hash_size + 1
+    for row in range(hash_size):
+        offset = row * row_width
+        for col in range(hash_size):
+            value = (value << 1) | (
+                pixels[offset + col] > pixels[offset + col + 1])
+    return value | colour << (hash_size * hash_size)
+
+
+@dataclass
+class IndexedScan:
+    """
+    A past classification stored in the perceptual index.
+    """
+    image_hash: int
+    context: str
+    agent_output: str
+    refined_output: Optional[str]
+    created_at: float
+
+
+class PerceptualIndex:
+    """
+    Near-duplicate index of recent classifications keyed by dHash.
+
+    Uses multi-index hashing: the 64-bit hash is split into
+    max_distance + 1 bands, and by the pigeonhole principle any hash
+    within max_distance bits of the query matches it exactly on at least
+    one band. Only the entries sharing a band are compared bit by bit,
+    and only those of the same colour (the bits above the hash) match.
+    """
+
+    def __init__(self,
+                 max_distance: int = settings.PHASH_MAX_DISTANCE,
+                 ttl: float = settings.PHASH_TTL,
+                 max_entries: int = settings.PHASH_MAX_ENTRIES,
+                 audit_rate: float = settings.PHASH_AUDIT_RATE):
+        """
+        Initializes the index.
+
+        Args:
+            max_distance: Maximum Hamming distance for two images to be
+                considered the same scan.
+            ttl: Seconds an entry can be reused. 0 disables expiry.
+            max_entries: Maximum number of stored hashes.
+            audit_rate: Fraction of near-duplicate hits that are still sent
+                to the model to measure the false-reuse rate.
+        """
+        self.max_distance = max_distance
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.audit_rate = audit_rate
+        self.hits = 0
+        self.misses = 0
+        self.audits = 0
+        self.false_reuses = 0
+
+        self._bands = self._make_bands(max_distance)
+        self._tables: List[Dict[int, Set[int]]] = [{} for _ in self._bands]
+        self._entries: "OrderedDict[int, IndexedScan]" = OrderedDict()
+        self._next_id = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _make_bands(max_distance: int) -> List[Tuple[int, int]]:
+        """
+        Splits the hash into max_distance + 1 (shift, mask) bands.
+        """
+        count = min(max(max_distance, 0) + 1, HASH_BITS)
+        bands = []
+        start = 0
+        for i in range(count):
+            width = HASH_BITS // count + (1 if i < HASH_BITS % count else 0)
+            bands.append((start, (1 << width) - 1))
+            start += width
+        return bands
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def add(self, image_hash: int, context: str, agent_output: str,
+            refined_output: Optional[str] = None) -> None:
+        """
+        Stores a classification.
+
+        Args:
+            image_hash: The dHash of the image.
+            context: Model, prompt and picklist the result is valid for.
+            agent_output: The agent output of the scan.
+            refined_output: The refined output, if a refine call was made.
+        """
+        now = time.time()
+        with self._lock:
+            self._evict(now)
+            entry_id = self._next_id
+            self._next_id += 1
+            self._entries[entry_id] = IndexedScan(
+                image_hash, context, agent_output, refined_output, now)
+            for table, (shift, mask) in zip(self._tables, self._bands):
+                table.setdefault((image_hash >> shift) & mask,
+                                 set()).add(entry_id)
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+
+    def lookup(self, image_hash: int, context: str) -> Optional[IndexedScan]:
+        """
+        Finds the closest recent classification of a near-identical image.
+
+        Args:
+            image_hash: The dHash of the image.
+            context: Model, prompt and picklist the result must be valid for.
+
+        Returns:
+            The closest entry within max_distance, or None.
+        """
+        now = time.time()
+        with self._lock:
+            self._evict(now)
+            best = None
+            best_distance = self.max_distance + 1
+            seen: Set[int] = set()
+            for table, (shift, mask) in zip(self._tables, self._bands):
+                for entry_id in table.get((image_hash >> shift) & mask, ()):
+                    if entry_id in seen:
+                        continue
+                    seen.add(entry_id)
+                    entry = self._entries[entry_id]
+                    difference = entry.image_hash ^ image_hash
+                    if difference >> HASH_BITS:
+                        # Same shape, another colour
+                        continue
+                    distance = difference.bit_count()
+                    if distance < best_distance and entry.context == context:
+                        best = entry
+                        best_distance = distance
+
+            if best is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return best
+
+    def should_audit(self) -> bool:
+        """
+        Returns whether the current hit should be checked against the model.
+        """
+        return self.audit_rate > 0 and random.random() < self.audit_rate
+
+    def record_audit(self, reused: IndexedScan, agent_output: str,
+                     refined_output: Optional[str]) -> None:
+        """
+        Compares a reused result with a fresh model answer.
+
+        Args:
+            reused: The entry that would have been reused.
+            agent_output: The fresh agent output.
+            refined_output: The fresh refined output.
+        """
+        with self._lock:
+            self.audits += 1
+            if (reused.agent_output != agent_output
+                    or reused.refined_output != refined_output):
+                self.false_reuses += 1
+
+    def stats(self) -> Dict[str, float]:
+        """
+        Returns the hit/miss counters and the measured false-reuse rate.
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "entries": len(self._entries),
+                "audits": self.audits,
+                "false_reuses": self.false_reuses,
+                "false_reuse_rate": (self.false_reuses / self.audits
+                                     if self.audits else 0.0),
+            }
+
+    def _evict(self, now: float) -> None:
+        """
+        Drops expired entries. Must be called with the lock held.
+        """
+        if self.ttl <= 0:
+            return
+        while self._entries:
+            entry_id, entry = next(iter(self._entries.items()))
+            if now - entry.created_at <= self.ttl:
+                break
+            self._remove(entry_id)
+
+    def _remove(self, entry_id: int) -> None:
+        """
+        Removes an entry from every band. Must be called with the lock held.
+        """
+        entry = self._entries.pop(entry_id)
+        for table, (shift, mask) in zip(self._tables, self._bands):
+            key = (entry.image_hash >> shift) & mask
+            bucket = table.get(key)
+            if bucket is not None:
+                bucket.discard(entry_id)
+                if not bucket:
+                    del table[key]
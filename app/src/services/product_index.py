@@ -0,0 +1,186 @@
+import unicodedata
+from typing import (
+    Callable,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+)
+from app.src.models.product import Product
+
+
+NGRAM_SIZE = 3
+MEMO_SIZE = 4096
+
+
+def normalize(text: str) -> str:
+    """
+    Folds case and strips accents so "Maçã" and "MACA" compare equal.
+
+    Args:
+        text: The text to normalize.
+
+    Returns:
+        The normalized text with runs of whitespace collapsed.
+    """
+    decomposed = unicodedata.normalize("NFKD", text)
+    stripped = "".join(c for c in decomposed if not unicodedata.combining(c))
+    return " ".join(stripped.casefold().split())
+
+
+def ngrams(text: str, size: int = NGRAM_SIZE) -> Set[str]:
+    """
+    Returns the set of character n-grams of a normalized text.
+    """
+    return {text[i:i + size] for i in range(len(text) - size + 1)}
+
+
+def match_rank(query: str, padded_name: str) -> Optional[int]:
+    """
+    Ranks how well a normalized name contains a normalized query.
+
+    Args:
+        query: The normalized query.
+        padded_name: The normalized name with a space on each side.
+
+    Returns:
+        0 for the exact name, 1 for whole words, 2 for a word prefix, 3
+        for a plain substring, or None if the name does not contain it.
+    """
+    words = f" {query} "
+    if words in padded_name:
+        return 0 if len(padded_name) == len(words) else 1
+    if f" {query}" in padded_name:
+        return 2
+    if query in padded_name:
+        return 3
+    return None
+
+
+def intersect(postings: List[Sequence[int]]) -> Set[int]:
+    """
+    Returns the product ids present in every posting list.
+    """
+    postings = sorted(postings, key=len)
+    candidates = set(postings[0])
+    for posting in postings[1:]:
+        if not candidates:
+            break
+        candidates.intersection_update(posting)
+    return candidates
+
+
+def rank_candidates(query: str, candidates: Iterable[int],
+                    padded_name: Callable[[int], str],
+                    order: Callable[[int], int]) -> List[int]:
+    """
+    Verifies and ranks the products that may contain a query.
+
+    Args:
+        query: The normalized query.
+        candidates: Ids of the products to check.
+        padded_name: Returns the normalized name of a product with a
+            space on each side.
+        order: Returns the tie-break position of a product.
+
+    Returns:
+        The ids of the products containing the query: exact name, then
+        whole words, then word prefix, then plain substring.
+    """
+    buckets: Tuple[List[int], ...] = ([], [], [], [])
+    for i in candidates:
+        rank = match_rank(query, padded_name(i))
+        if rank is not None:
+            buckets[rank].append(i)
+    return [i for bucket in buckets for i in sorted(bucket, key=order)]
+
+
+def tie_break_order(names: List[str]) -> List[int]:
+    """
+    Returns the tie-break position of each normalized name: shorter names
+    first, then picklist order.
+    """
+    by_length = sorted(range(len(names)), key=lambda i: (len(names[i]), i))
+    order = [0] * len(names)
+    for position, product_id in enumerate(by_length):
+        order[product_id] = position
+    return order
+
+
+class ProductIndex:
+    """
+    Inverted index over the normalized names of the picklist.
+
+    Built once per picklist. A lookup intersects the posting lists of the
+    query's n-grams, which only touches the products that share every
+    n-gram with it, then verifies and ranks those candidates: exact name,
+    then whole words, then word prefix, then plain substring.
+    """
+
+    def __init__(self, products: List[Product], memo_size: int = MEMO_SIZE):
+        """
+        Builds the n-gram index.
+
+        Args:
+            products: The picklist to index.
+            memo_size: Number of distinct queries whose results are kept.
+        """
+        self.products = products
+        self.memo_size = memo_size
+        self._names: List[str] = []
+        self._padded: List[str] = []
+        self._ngram_index: Dict[str, Set[int]] = {}
+        # The picklist never changes under an index, so results of the
+        # handful of names the model keeps returning are memoized
+        self._memo: Dict[str, List[Product]] = {}
+
+        for product_id, product in enumerate(products):
+            name = normalize(product.fruit)
+            self._names.append(name)
+            self._padded.append(f" {name} ")
+            for gram in ngrams(name):
+                self._ngram_index.setdefault(gram, set()).add(product_id)
+
+        self._order = tie_break_order(self._names)
+
+    def _candidates(self, query: str) -> Set[int]:
+        """
+        Returns the ids of the products that may contain the query.
+        """
+        grams = ngrams(query)
+        if not grams:
+            # Too short for an n-gram lookup: every name is a candidate,
+            # so "ki" still finds "Kiwi" and "Abacaxi" like a plain
+            # substring search
+            return set(range(len(self._names)))
+
+        return intersect([self._ngram_index.get(g, set()) for g in grams])
+
+    def search(self, text: str) -> List[Product]:
+        """
+        Finds the products whose name contains the text, ignoring case and
+        accents.
+
+        Args:
+            text: The name returned by the model.
+
+        Returns:
+            The matching products, best match first.
+        """
+        query = normalize(text)
+        if not query:
+            return []
+
+        cached = self._memo.get(query)
+        if cached is not None:
+            return list(cached)
+
+        matches = [self.products[i] for i in rank_candidates(
+            query, self._candidates(query), self._padded.__getitem__,
+            self._order.__getitem__)]
+        if len(self._memo) < self.memo_size:
+            self._memo[query] = matches
+        return list(matches)
@@ -0,0 +1,332 @@
+import asyncio
+import sqlite3
+import threading
+import time
+from typing import Dict, Optional, Tuple
+from app.src.services.metrics import MetricsRegistry
+from app.src.config.settings import settings
+
+
+# Priority classes, admitted in this order
+INTERACTIVE = "interactive"
+BATCH = "batch"
+PRIORITIES = (INTERACTIVE, BATCH)
+
+# Bounds of the sleep between two attempts of a queued request, in seconds
+MIN_POLL_INTERVAL = 0.005
+MAX_POLL_INTERVAL = 0.25
+
+
+def rank(priority: str) -> int:
+    """
+    Returns the position of a priority class (0 is served first).
+    """
+    try:
+        return PRIORITIES.index(priority)
+    except ValueError:
+        raise ValueError(f"Unknown priority class: {priority}") from None
+
+
+class RateLimiter:
+    """
+    Token bucket shared by every process calling the model.
+
+    The bucket (rate tokens per second, at most burst) and the queue of
+    waiting requests live in a SQLite file, so Django workers, the
+    drop-folder daemon and batch runs draw on the same API quota. Each
+    attempt is one short write transaction: the bucket is refilled, and
+    a request takes a token only if fewer requests than whole tokens are
+    queued ahead of it. Requests of a higher priority class are always
+    ahead of those of a lower one, so interactive scans overtake a batch
+    backlog.
+
+    A request waits at most the maximum wait of its class, then is shed:
+    the call is refused instead of adding to a 429 storm. Queue rows of
+    crashed processes expire on their own.
+    """
+
+    def __init__(self, db_path: str = settings.RATE_LIMIT_DB_PATH,
+                 rate: float = settings.RATE_LIMIT_PER_MINUTE / 60,
+                 burst: int = settings.RATE_LIMIT_BURST,
+                 max_waits: Optional[Dict[str, float]] = None,
+                 max_queue: int = settings.RATE_LIMIT_MAX_QUEUE,
+                 metrics: Optional[MetricsRegistry] = None):
+        """
+        Initializes the limiter.
+
+        Args:
+            db_path: SQLite file shared by the processes.
+            rate: Tokens added per second.
+            burst: Capacity of the bucket.
+            max_waits: Maximum seconds a request of each priority class
+                waits for a token.
+            max_queue: Queued requests beyond which new ones are shed at
+                once.
+            metrics: Optional registry recording waits and shed requests.
+        """
+        self.db_path = db_path
+        self.rate = rate
+        self.burst = burst
+        self.max_waits = max_waits or {
+            INTERACTIVE: settings.RATE_LIMIT_INTERACTIVE_WAIT,
+            BATCH: settings.RATE_LIMIT_BATCH_WAIT,
+        }
+        self.max_queue = max_queue
+        self.metrics = metrics
+        self._admitted = {priority: 0 for priority in PRIORITIES}
+        self._shed = {priority: 0 for priority in PRIORITIES}
+        self._waited = {priority: 0.0 for priority in PRIORITIES}
+        self._max_waited = {priority: 0.0 for priority in PRIORITIES}
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(db_path, timeout=5,
+                                   isolation_level=None,
+                                   check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS rate_limit_bucket ("
+            "id INTEGER PRIMARY KEY CHECK (id = 0), "
+            "tokens REAL NOT NULL, updated REAL NOT NULL)")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS rate_limit_waiters ("
+            "ticket INTEGER PRIMARY KEY AUTOINCREMENT, "
+            "rank INTEGER NOT NULL, expires REAL NOT NULL)")
+        self._db.execute(
+            "INSERT OR IGNORE INTO rate_limit_bucket VALUES (0, ?, ?)",
+            (float(burst), time.time()))
+
+    def _attempt(self, priority: str, ticket: Optional[int],
+                 expires: float) -> Tuple[bool, Optional[int], float]:
+        """
+        Tries to take a token, joining the queue on the first failure.
+
+        Returns:
+            Whether a token was taken, the queue ticket of the request
+            (None once it left the queue, or if it was shed because the
+            queue is full), and the seconds to sleep before trying again.
+        """
+        position = rank(priority)
+        now = time.time()
+        with self._lock:
+            db = self._db
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                db.execute("DELETE FROM rate_limit_waiters WHERE expires < ?",
+                           (now,))
+                tokens, updated = db.execute(
+                    "SELECT tokens, updated FROM rate_limit_bucket"
+                ).fetchone()
+                tokens = min(self.burst,
+                             tokens + max(0.0, now - updated) * self.rate)
+                if ticket is None:
+                    ahead = db.execute(
+                        "SELECT COUNT(*) FROM rate_limit_waiters "
+                        "WHERE rank <= ?", (position,)).fetchone()[0]
+                else:
+                    ahead = db.execute(
+                        "SELECT COUNT(*) FROM rate_limit_waiters "
+                        "WHERE rank < ? OR (rank = ? AND ticket < ?)",
+                        (position, position, ticket)).fetchone()[0]
+
+                granted = ahead < int(tokens)
+                if granted:
+                    tokens -= 1
+                    if ticket is not None:
+                        db.execute("DELETE FROM rate_limit_waiters "
+                                   "WHERE ticket = ?", (ticket,))
+                        ticket = None
+                elif ticket is None:
+                    queued = db.execute(
+                        "SELECT COUNT(*) FROM rate_limit_waiters"
+                    ).fetchone()[0]
+                    if queued < self.max_queue:
+                        ticket = db.execute(
+                            "INSERT INTO rate_limit_waiters (rank, expires) "
+                            "VALUES (?, ?)", (position, expires)).lastrowid
+                db.execute("UPDATE rate_limit_bucket SET tokens = ?, "
+                           "updated = ?", (tokens, now))
+                db.execute("COMMIT")
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+
+        if granted:
+            return True, None, 0.0
+        if ticket is None:
+            # Queue full: shed without waiting
+            return False, None, float("inf")
+        # The requests ahead each need a token, then this one
+        delay = (ahead + 1 - tokens) / self.rate if self.rate else float(
+            "inf")
+        return False, ticket, min(MAX_POLL_INTERVAL,
+                                  max(MIN_POLL_INTERVAL, delay))
+
+    def _leave(self, ticket: Optional[int]) -> None:
+        """
+        Removes a request that gave up from the queue.
+        """
+        if ticket is None:
+            return
+        try:
+            with self._lock:
+                self._db.execute(
+                    "DELETE FROM rate_limit_waiters WHERE ticket = ?",
+                    (ticket,))
+        except sqlite3.Error as e:
+            print(f"Error leaving rate limit queue: {e}")
+
+    def _done(self, priority: str, waited: float, granted: bool) -> None:
+        """
+        Records the outcome of a request.
+        """
+        with self._lock:
+            if granted:
+                self._admitted[priority] += 1
+                self._waited[priority] += waited
+                self._max_waited[priority] = max(self._max_waited[priority],
+                                                 waited)
+            else:
+                self._shed[priority] += 1
+        if self.metrics is not None:
+            if granted:
+                self.metrics.observe("rate_limit_wait_seconds", waited,
+                                     priority=priority)
+            else:
+                self.metrics.inc("rate_limit_shed_total", priority=priority)
+
+    def acquire(self, priority: str = INTERACTIVE,
+                max_wait: Optional[float] = None) -> bool:
+        """
+        Waits for a token.
+
+        Args:
+            priority: The request's class, one of PRIORITIES.
+            max_wait: Seconds to wait at most; the class's maximum wait if
+                omitted.
+
+        Returns:
+            True once a token was taken, False if the request was shed.
+        """
+        rank(priority)
+        max_wait = self.max_waits[priority] if max_wait is None else max_wait
+        started = time.monotonic()
+        expires = time.time() + max_wait + 1
+        ticket = None
+        granted = False
+        try:
+            while True:
+                granted, ticket, delay = self._attempt(priority, ticket,
+                                                       expires)
+                if granted:
+                    break
+                remaining = max_wait - (time.monotonic() - started)
+                if remaining <= 0 or delay == float("inf"):
+                    break
+                time.sleep(min(delay, remaining))
+        except sqlite3.Error as e:
+            # The quota is enforced upstream anyway; better a 429 than no
+            # scan at all
+            print(f"Error in rate limiter, admitting call: {e}")
+            return True
+        finally:
+            if not granted:
+                self._leave(ticket)
+        self._done(priority, time.monotonic() - started, granted)
+        return granted
+
+    def try_acquire(self, priority: str = INTERACTIVE) -> bool:
+        """
+        Takes a token only if one is free right now, without queueing.
+
+        Used for optional calls (hedged backups), which are neither
+        counted as admitted nor as shed.
+        """
+        rank(priority)
+        try:
+            granted, ticket, _ = self._attempt(priority, None, time.time())
+        except sqlite3.Error as e:
+            print(f"Error in rate limiter: {e}")
+            return False
+        self._leave(ticket)
+        return granted
+
+    async def acquire_async(self, priority: str = INTERACTIVE,
+                            max_wait: Optional[float] = None) -> bool:
+        """
+        Waits for a token without blocking the event loop.
+
+        A cancelled wait (e.g. at the scan deadline) leaves the queue.
+
+        Args:
+            priority: The request's class, one of PRIORITIES.
+            max_wait: Seconds to wait at most; the class's maximum wait if
+                omitted.
+
+        Returns:
+            True once a token was taken, False if the request was shed.
+        """
+        rank(priority)
+        max_wait = self.max_waits[priority] if max_wait is None else max_wait
+        started = time.monotonic()
+        expires = time.time() + max_wait + 1
+        ticket = None
+        granted = False
+        try:
+            while True:
+                # The transaction may wait for another process's write
+                # lock: never on the event loop
+                granted, ticket, delay = await asyncio.to_thread(
+                    self._attempt, priority, ticket, expires)
+                if granted:
+                    break
+                remaining = max_wait - (time.monotonic() - started)
+                if remaining <= 0 or delay == float("inf"):
+                    break
+                await asyncio.sleep(min(delay, remaining))
+        except sqlite3.Error as e:
+            print(f"Error in rate limiter, admitting call: {e}")
+            return True
+        finally:
+            if not granted and ticket is not None:
+                # Not awaited: a cancelled wait must still leave the queue
+                asyncio.get_running_loop().run_in_executor(
+                    None, self._leave, ticket)
+        self._done(priority, time.monotonic() - started, granted)
+        return granted
+
+    def stats(self) -> Dict[str, object]:
+        """
+        Returns the queue depth of every process and the waits of this one.
+        """
+        depth = {priority: 0 for priority in PRIORITIES}
+        tokens = None
+        try:
+            with self._lock:
+                rows = self._db.execute(
+                    "SELECT rank, COUNT(*) FROM rate_limit_waiters "
+                    "WHERE expires >= ? GROUP BY rank",
+                    (time.time(),)).fetchall()
+                tokens, updated = self._db.execute(
+                    "SELECT tokens, updated FROM rate_limit_bucket"
+                ).fetchone()
+            for position, count in rows:
+                depth[PRIORITIES[position]] = count
+            tokens = min(self.burst, tokens + max(
+                0.0, time.time() - updated) * self.rate)
+        except sqlite3.Error as e:
+            print(f"Error reading rate limiter stats: {e}")
+
+        with self._lock:
+            return {
+                "rate_per_minute": self.rate * 60,
+                "burst": self.burst,
+                "tokens": tokens,
+                "queue_depth": depth,
+                "admitted": dict(self._admitted),
+                "shed": dict(self._shed),
+                "mean_wait": {
+                    priority: (self._waited[priority]
+                               / self._admitted[priority]
+                               if self._admitted[priority] else 0.0)
+                    for priority in PRIORITIES},
+                "max_wait": dict(self._max_waited),
+            }
@@ -0,0 +1,219 @@
+import math
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, Iterable, List, Optional, Tuple, Union
+from app.src.repositories.picklist_repository import PicklistRepository
+from app.src.repositories.picklist_store import PicklistStore
+from app.src.repositories.sqlite_picklist_repository import (
+    SqlitePicklist,
+    SqlitePicklistRepository,
+)
+from app.src.services.ai_service import AIService
+from app.src.services.call_recorder import (
+    UNRECORDED,
+    ReplayClient,
+    load_corpus,
+)
+from app.src.services.image_preprocessor import ImagePreprocessor
+from app.src.services.matching_service import MatchingService
+from app.src.services.retry_policy import RetryPolicy
+from app.src.services.scan_service import ScanService
+from app.src.config.settings import settings
+
+
+# A labelled image: the expected PLU and the image bytes
+Example = Tuple[int, bytes]
+
+# State of a replay worker process: a scan service per prompt
+_worker: Dict[str, Tuple[ScanService, ReplayClient]] = {}
+
+
+def load_picklist() -> Union[PicklistStore, SqlitePicklist]:
+    """
+    Loads the picklist from the configured backend, as the container does.
+    """
+    if settings.PICKLIST_BACKEND == "sqlite":
+        return SqlitePicklistRepository().load()
+    return PicklistRepository(settings.PICKLIST_PATH).load()
+
+
+def build_scan_service(prompt_path: str, client: Any,
+                       products: Union[PicklistStore, SqlitePicklist],
+                       retry_policy: Optional[RetryPolicy] = None
+                       ) -> ScanService:
+    """
+    Builds the scan pipeline used to record and replay a prompt.
+
+    Only the steps that decide which model calls are made are kept:
+    preprocessing, matching and refinement. Caches, the local classifier
+    and the learned disambiguation priors are left out, so a replay
+    makes the same calls as the recording, whatever order the scans run
+    in.
+
+    Args:
+        prompt_path: The prompt to evaluate.
+        client: The Gemini client, a recording or a replaying one.
+        products: The picklist.
+        retry_policy: Retries of the model calls; the default policy if
+            omitted.
+    """
+    ai_service = AIService(settings.AGENT_MODEL, prompt_path, client=client)
+    ai_service.bind_picklist(products, products.fingerprint)
+    preprocessor = (ImagePreprocessor()
+                    if settings.PREPROCESS_ENABLED else None)
+    return ScanService(ai_service, MatchingService(products),
+                       preprocessor=preprocessor,
+                       picklist_version=products.fingerprint,
+                       retry_policy=retry_policy)
+
+
+def _init_worker(corpus_path: str, prompt_paths: List[str]) -> None:
+    """
+    Loads the corpus and builds the pipeline of every prompt, once per
+    worker process.
+    """
+    corpus = load_corpus(corpus_path)
+    products = load_picklist()
+    _worker.clear()
+    for prompt_path in prompt_paths:
+        client = ReplayClient(corpus)
+        # A recorded answer is the same on every attempt
+        _worker[prompt_path] = (
+            build_scan_service(prompt_path, client, products,
+                               RetryPolicy(max_attempts=1)),
+            client)
+
+
+def _replay_scan(task: Tuple[str, int, bytes]) -> Dict[str, Any]:
+    """
+    Replays the scan of one labelled image with one prompt.
+
+    Returns:
+        The scan's row of the report.
+    """
+    prompt_path, expected, image_bytes = task
+    scan_service, client = _worker[prompt_path]
+    client.served.clear()
+    result = scan_service.scan(image_bytes)
+    served = list(client.served)
+
+    best_match = result.best_match() if not result.error else None
+    return {
+        "prompt": prompt_path,
+        "expected": expected,
+        "predicted": best_match["PLU"] if best_match else None,
+        "error": result.error,
+        "unrecorded": UNRECORDED in (result.error or ""),
+        "calls": len(served),
+        "refined": "refine" in result.timings,
+        "prompt_tokens": sum(r.prompt_tokens or 0 for r in served),
+        "response_tokens": sum(r.response_tokens or 0 for r in served),
+        # Local steps as replayed, model calls as recorded
+        "latency_ms": (result.timings.get("scan", 0.0)
+                       + sum(r.latency_ms for r in served)),
+    }
+
+
+def _percentile(values: List[float], percentile: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = math.ceil(percentile / 100 * len(ordered)) - 1
+    return ordered[max(0, index)]
+
+
+def summarize(rows: List[Dict[str, Any]]) -> Dict[str, Dict[str, float]]:
+    """
+    Aggregates the replayed scans of each prompt.
+
+    Args:
+        rows: The rows of _replay_scan.
+
+    Returns:
+        Per prompt: the number of scans, the accuracy (scans suggesting
+        the expected PLU, errors counting as wrong), errors and scans
+        needing an unrecorded call, the refine-call rate, model calls and
+        tokens per scan, and the p50/p95 latency.
+    """
+    by_prompt: Dict[str, List[Dict[str, Any]]] = {}
+    for row in rows:
+        by_prompt.setdefault(row["prompt"], []).append(row)
+
+    reports = {}
+    for prompt_path, scans in by_prompt.items():
+        count = len(scans)
+        latencies = [row["latency_ms"] for row in scans]
+        reports[prompt_path] = {
+            "scans": count,
+            "accuracy": sum(row["predicted"] == row["expected"]
+                            for row in scans) / count,
+            "errors": sum(bool(row["error"]) for row in scans),
+            "unrecorded": sum(row["unrecorded"] for row in scans),
+            "refine_rate": sum(row["refined"] for row in scans) / count,
+            "calls_per_scan": sum(row["calls"] for row in scans) / count,
+            "prompt_tokens": sum(row["prompt_tokens"]
+                                 for row in scans) / count,
+            "response_tokens": sum(row["response_tokens"]
+                                   for row in scans) / count,
+            "p50_ms": _percentile(latencies, 50),
+            "p95_ms": _percentile(latencies, 95),
+        }
+    return reports
+
+
+class ReplayService:
+    """
+    Replays the pipeline over a recorded corpus to compare prompts.
+
+    Every labelled image is scanned once per prompt, matching and
+    refinement included, with the model answers taken from the corpus
+    instead of the API. The scans are spread over worker processes, one
+    per CPU core by default. No call costs quota, so the same corpus can
+    be replayed after every change to the matching code. A change that
+    alters the requests themselves (another shortlist, other refine
+    candidates) shows up as unrecorded calls.
+    """
+
+    def __init__(self, corpus_path: str, prompt_paths: List[str],
+                 workers: Optional[int] = None):
+        """
+        Initializes the replay.
+
+        Args:
+            corpus_path: The JSONL corpus of recorded calls.
+            prompt_paths: The prompts to compare; each must have been
+                recorded over the same images.
+            workers: Worker processes; the number of CPU cores if
+                omitted, 1 to replay in this process.
+        """
+        self.corpus_path = corpus_path
+        self.prompt_paths = list(prompt_paths)
+        self.workers = workers or os.cpu_count() or 1
+
+    def run(self, examples: Iterable[Example]
+            ) -> Dict[str, Dict[str, float]]:
+        """
+        Replays every example with every prompt.
+
+        Args:
+            examples: The labelled images.
+
+        Returns:
+            The report of each prompt (see summarize).
+        """
+        examples = list(examples)
+        tasks = [(prompt_path, plu, image_bytes)
+                 for prompt_path in self.prompt_paths
+                 for plu, image_bytes in examples]
+        if self.workers == 1:
+            _init_worker(self.corpus_path, self.prompt_paths)
+            rows = [_replay_scan(task) for task in tasks]
+        else:
+            with ProcessPoolExecutor(
+                    self.workers, initializer=_init_worker,
+                    initargs=(self.corpus_path, self.prompt_paths)
+            ) as executor:
+                chunksize = max(1, len(tasks) // (self.workers * 4))
+                rows = list(executor.map(_replay_scan, tasks,
+                                         chunksize=chunksize))
+        return summarize(rows)
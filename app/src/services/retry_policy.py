@@ -0,0 +1,304 @@
+import asyncio
+import random
+import threading
+import time
+from typing import Awaitable, Callable, Dict, Optional
+from app.src.models.analysis_result import AnalysisResult
+from app.src.services.metrics import MetricsRegistry
+from app.src.config.settings import settings
+
+
+class Deadline:
+    """
+    Overall time budget of one scan, shared by all of its model calls.
+    """
+
+    def __init__(self, seconds: Optional[float]):
+        """
+        Args:
+            seconds: Budget in seconds, or None for no limit.
+        """
+        self.expires_at = (time.monotonic() + seconds
+                           if seconds is not None else None)
+
+    def remaining(self) -> float:
+        """
+        Returns the seconds left, or infinity without a limit.
+        """
+        if self.expires_at is None:
+            return float("inf")
+        return max(0.0, self.expires_at - time.monotonic())
+
+    @property
+    def expired(self) -> bool:
+        return self.remaining() <= 0
+
+
+class CircuitBreaker:
+    """
+    Fails fast while the model backend is down.
+
+    After failure_threshold consecutive retryable failures the circuit
+    opens and calls are refused for reset_timeout seconds. Then a single
+    trial call is let through: success closes the circuit again, failure
+    reopens it. A trial that never reports back (it raised, or its scan
+    was cancelled) reopens the circuit too, and at worst another trial is
+    let through after reset_timeout.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self,
+                 failure_threshold: int = settings.BREAKER_FAILURE_THRESHOLD,
+                 reset_timeout: float = settings.BREAKER_RESET_TIMEOUT):
+        """
+        Args:
+            failure_threshold: Consecutive failures that open the circuit.
+            reset_timeout: Seconds the circuit stays open.
+        """
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.rejected = 0
+        self._opened_at = 0.0
+        self._trial_at = 0.0
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        """
+        Returns whether a call may be attempted now.
+        """
+        with self._lock:
+            now = time.monotonic()
+            if self.state == self.OPEN:
+                if now - self._opened_at < self.reset_timeout:
+                    self.rejected += 1
+                    return False
+                self.state = self.HALF_OPEN
+                self._trial_at = now
+                return True
+            if self.state == self.HALF_OPEN:
+                if now - self._trial_at < self.reset_timeout:
+                    # Only the trial call goes through
+                    self.rejected += 1
+                    return False
+                # The trial is lost; try another one
+                self._trial_at = now
+            return True
+
+    def record(self, result: AnalysisResult) -> None:
+        """
+        Updates the circuit with the outcome of a call.
+
+        Calls that never reached the backend (no key, shed by the rate
+        limiter, session closed) say nothing about its health and leave
+        the circuit as it is; a trial among them frees its slot for the
+        next call. Any answer from the backend, even a bad request or an
+        unparsable one, shows it is up.
+        """
+        with self._lock:
+            if not result.sent:
+                if self.state == self.HALF_OPEN:
+                    self._trial_at = float("-inf")
+            elif result.ok:
+                self.state = self.CLOSED
+                self.failures = 0
+            elif result.retryable and not result.parse_error:
+                self.failures += 1
+                if (self.state == self.HALF_OPEN
+                        or self.failures >= self.failure_threshold):
+                    self.state = self.OPEN
+                    self._opened_at = time.monotonic()
+            elif self.state == self.HALF_OPEN:
+                self.state = self.CLOSED
+
+    def abandon(self) -> None:
+        """
+        Reopens the circuit after a call that ended without a result.
+        """
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                self.state = self.OPEN
+                self._opened_at = time.monotonic()
+
+    def stats(self) -> Dict[str, object]:
+        with self._lock:
+            return {
+                "state": self.state,
+                "consecutive_failures": self.failures,
+                "rejected": self.rejected,
+            }
+
+
+class RetryPolicy:
+    """
+    Retries model calls with exponential backoff and full jitter.
+
+    Only retryable failures are retried, never past the scan deadline,
+    and not at all while the circuit breaker is open.
+    """
+
+    def __init__(self,
+                 max_attempts: int = settings.RETRY_MAX_ATTEMPTS,
+                 base_delay: float = settings.RETRY_BASE_DELAY,
+                 max_delay: float = settings.RETRY_MAX_DELAY,
+                 deadline: Optional[float] = settings.RETRY_DEADLINE,
+                 breaker: Optional[CircuitBreaker] = None,
+                 metrics: Optional[MetricsRegistry] = None):
+        """
+        Args:
+            max_attempts: Maximum calls per operation.
+            base_delay: Backoff before the second attempt, in seconds.
+            max_delay: Cap of the backoff, in seconds.
+            deadline: Overall budget of a scan in seconds, or None.
+            breaker: Optional circuit breaker shared by every call.
+            metrics: Optional registry recording every attempt.
+        """
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline_seconds = deadline
+        self.breaker = breaker
+        self.metrics = metrics
+        self.retries = 0
+        self.parse_failures = 0
+
+    def new_deadline(self) -> Deadline:
+        """
+        Starts the time budget of a scan.
+        """
+        return Deadline(self.deadline_seconds)
+
+    def backoff(self, attempt: int) -> float:
+        """
+        Returns the delay before the given retry (1 for the first one).
+        """
+        ceiling = min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+        return random.uniform(0, ceiling)
+
+    def _before_attempt(self,
+                        deadline: Deadline) -> Optional[AnalysisResult]:
+        """
+        Returns a failure if the attempt must not be made.
+        """
+        if deadline.expired:
+            return AnalysisResult.failure("Scan deadline exceeded")
+        if self.breaker is not None and not self.breaker.allow():
+            return AnalysisResult.failure("Model backend unavailable "
+                                          "(circuit open)")
+        return None
+
+    def _abandon(self) -> None:
+        if self.breaker is not None:
+            self.breaker.abandon()
+
+    def _next_delay(self, result: AnalysisResult, attempt: int,
+                    deadline: Deadline, name: str,
+                    started: float) -> Optional[float]:
+        """
+        Records an attempt and returns the delay before retrying, or None
+        to stop.
+        """
+        if self.breaker is not None:
+            self.breaker.record(result)
+        if result.parse_error:
+            self.parse_failures += 1
+            if self.metrics is not None:
+                self.metrics.inc("model_parse_failures_total", call=name)
+        if self.metrics is not None:
+            self.metrics.observe("model_call_duration_seconds",
+                                 time.perf_counter() - started, call=name)
+            outcome = ("ok" if result.ok else
+                       "retryable_error" if result.retryable else "error")
+            self.metrics.inc("model_calls_total", call=name, outcome=outcome)
+        if result.ok or not result.retryable:
+            return None
+        if attempt >= self.max_attempts:
+            return None
+        delay = self.backoff(attempt)
+        if delay >= deadline.remaining():
+            return None
+        self.retries += 1
+        if self.metrics is not None:
+            self.metrics.inc("model_retries_total", call=name)
+        print(f"Retrying after error: {result.error} "
+              f"(attempt {attempt + 1}/{self.max_attempts})")
+        return delay
+
+    def call(self, func: Callable[[], AnalysisResult],
+             deadline: Optional[Deadline] = None,
+             name: str = "model") -> AnalysisResult:
+        """
+        Calls func until it succeeds or the policy gives up.
+
+        Args:
+            func: The model call.
+            deadline: The scan's deadline; a fresh one if omitted.
+            name: Label of the call in the metrics.
+
+        Returns:
+            The last result.
+        """
+        deadline = deadline or self.new_deadline()
+        attempt = 0
+        while True:
+            refused = self._before_attempt(deadline)
+            if refused is not None:
+                return refused
+            attempt += 1
+            started = time.perf_counter()
+            try:
+                # A hung call is ended by the client's own timeout
+                # (HttpOptions, RETRY_DEADLINE), not by another thread
+                result = func()
+            except BaseException:
+                self._abandon()
+                raise
+            delay = self._next_delay(result, attempt, deadline, name,
+                                     started)
+            if delay is None:
+                return result
+            time.sleep(delay)
+
+    async def call_async(self, func: Callable[[], Awaitable[AnalysisResult]],
+                         deadline: Optional[Deadline] = None,
+                         name: str = "model") -> AnalysisResult:
+        """
+        Awaits func until it succeeds or the policy gives up, without
+        blocking the event loop between attempts.
+
+        Args:
+            func: The model call.
+            deadline: The scan's deadline; a fresh one if omitted.
+            name: Label of the call in the metrics.
+
+        Returns:
+            The last result.
+        """
+        deadline = deadline or self.new_deadline()
+        attempt = 0
+        while True:
+            refused = self._before_attempt(deadline)
+            if refused is not None:
+                return refused
+            attempt += 1
+            remaining = deadline.remaining()
+            started = time.perf_counter()
+            try:
+                result = await asyncio.wait_for(
+                    func(), None if remaining == float("inf") else remaining)
+            except asyncio.TimeoutError:
+                result = AnalysisResult.failure("Model call timed out",
+                                                retryable=True)
+            except BaseException:
+                # Cancelled with the scan, e.g. when the client went away
+                self._abandon()
+                raise
+            delay = self._next_delay(result, attempt, deadline, name,
+                                     started)
+            if delay is None:
+                return result
+            await asyncio.sleep(delay)
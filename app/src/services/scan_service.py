@@ -0,0 +1,499 @@
+import asyncio
+import hashlib
+import json
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass, field, replace
+from typing import (
+    Callable, Dict, Iterator, List, Optional, Tuple, Union)
+from app.src.models.analysis_result import AnalysisResult
+from app.src.models.inference_session import InferenceSession
+from app.src.models.product import Product
+from app.src.models.scan_result import ScanResult
+from app.src.services.ai_service import AIService
+from app.src.services.matching_service import MatchingService
+from app.src.services.classification_cache import (
+    CacheEntry,
+    ClassificationCache,
+)
+from app.src.services.perceptual_index import (
+    IndexedScan,
+    PerceptualIndex,
+    dhash,
+)
+from app.src.services.disambiguation_service import DisambiguationService
+from app.src.services.image_preprocessor import (
+    ImagePreprocessor,
+    PreparedImage,
+)
+from app.src.services.local_classifier import LocalClassifier
+from app.src.services.metrics import MetricsRegistry
+from app.src.services.micro_batcher import MicroBatcher
+from app.src.services.rate_limiter import INTERACTIVE
+from app.src.services.retry_policy import Deadline, RetryPolicy
+from app.src.services.single_flight import SingleFlight
+
+
+# Called with the agent output and the candidates once the first model
+# call has answered, before any refine call
+AnalysisListener = Callable[[str, List[Product]], None]
+
+
+@contextmanager
+def timed(timings: Dict[str, float], stage: str) -> Iterator[None]:
+    """
+    Adds the duration of the block, in milliseconds, to timings[stage].
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = (time.perf_counter() - start) * 1000
+        timings[stage] = timings.get(stage, 0.0) + elapsed
+
+
+@dataclass
+class PendingScan:
+    """
+    State of a scan between the local steps and the model calls.
+    """
+    key: Optional[str]
+    session: InferenceSession
+    image_hash: Optional[int]
+    reused: Optional[IndexedScan]
+    deadline: Deadline
+    timings: Dict[str, float] = field(default_factory=dict)
+
+
+class ScanService:
+    """
+    Orchestrates the classification of one image: analysis, picklist
+    matching and, when needed, refinement.
+    """
+
+    def __init__(self,
+                 ai_service: AIService,
+                 matching_service: MatchingService,
+                 cache: Optional[ClassificationCache] = None,
+                 perceptual_index: Optional[PerceptualIndex] = None,
+                 disambiguation_service: Optional[
+                     DisambiguationService] = None,
+                 preprocessor: Optional[ImagePreprocessor] = None,
+                 picklist_version: str = "",
+                 retry_policy: Optional[RetryPolicy] = None,
+                 metrics: Optional[MetricsRegistry] = None,
+                 local_classifier: Optional[LocalClassifier] = None,
+                 single_flight: Optional[SingleFlight] = None,
+                 micro_batcher: Optional[MicroBatcher] = None,
+                 priority: str = INTERACTIVE):
+        """
+        Initializes the scan service.
+
+        Args:
+            ai_service: The AI service instance.
+            matching_service: The matching service instance.
+            cache: Optional cache consulted before calling the model.
+            perceptual_index: Optional index of recent scans reused for
+                near-identical images.
+            disambiguation_service: Optional local scorer that settles
+                clear-cut choices between candidates without a refine call.
+            preprocessor: Optional stage shrinking the image before it is
+                hashed and uploaded.
+            picklist_version: Fingerprint of the picklist used in cache keys.
+            retry_policy: Retries and deadline of the model calls. A
+                default policy without circuit breaker if omitted.
+            metrics: Optional registry receiving the stage timings and
+                the outcome of every scan.
+            local_classifier: Optional CPU classifier answering the
+                scans it is confident about without calling the model.
+            single_flight: Optional coalescer making concurrent scans of
+                the same image wait for one classification.
+            micro_batcher: Optional scheduler sending the analyze calls
+                of concurrent scans together in multi-image calls.
+            priority: Rate limiter class of the model calls of the scans
+                (see rate_limiter.PRIORITIES).
+        """
+        self.ai_service = ai_service
+        self.matching_service = matching_service
+        self.cache = cache
+        self.perceptual_index = perceptual_index
+        self.disambiguation_service = disambiguation_service
+        self.preprocessor = preprocessor
+        self.picklist_version = picklist_version
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.metrics = metrics
+        self.local_classifier = local_classifier
+        self.single_flight = single_flight
+        self.micro_batcher = micro_batcher
+        self.priority = priority
+
+    def scan(self, image_bytes: bytes) -> ScanResult:
+        """
+        Classifies an image.
+
+        Args:
+            image_bytes: The image data in bytes.
+
+        Returns:
+            The scan result. On a cache hit, when a near-identical image
+            was classified recently or when the local classifier is
+            confident, no model call is made.
+        """
+        start = time.perf_counter()
+        digest = ClassificationCache.digest(image_bytes)
+        if self.single_flight is None:
+            result = self._scan(image_bytes, digest)
+        else:
+            result, shared = self.single_flight.do(
+                self._flight_key(digest),
+                lambda: self._scan(image_bytes, digest))
+            result = self._shared(result) if shared else result
+        return self._record(result, start, digest)
+
+    async def scan_async(self, image_bytes: bytes,
+                         on_analysis: Optional[AnalysisListener] = None
+                         ) -> ScanResult:
+        """
+        Classifies an image without blocking the event loop.
+
+        Hashing and preprocessing run in a worker thread; the model calls
+        use the SDK's async client.
+
+        Args:
+            image_bytes: The image data in bytes.
+            on_analysis: Optional listener told the fruit and candidates
+                as soon as the model analysed the image, so they can be
+                shown while the refine call runs. Not called for scans
+                answered locally or shared from a concurrent scan.
+
+        Returns:
+            The scan result, as scan() would return it.
+        """
+        start = time.perf_counter()
+        digest = await asyncio.to_thread(ClassificationCache.digest,
+                                         image_bytes)
+        if self.single_flight is None:
+            result = await self._scan_async(image_bytes, digest,
+                                            on_analysis)
+        else:
+            result, shared = await self.single_flight.do_async(
+                self._flight_key(digest),
+                lambda: self._scan_async(image_bytes, digest, on_analysis))
+            result = self._shared(result) if shared else result
+        return self._record(result, start, digest)
+
+    def _flight_key(self, digest: str) -> str:
+        """
+        Identifies the scans that can share one classification.
+        """
+        return ClassificationCache.make_key(digest,
+                                            self.ai_service.model_name,
+                                            self.ai_service.prompt,
+                                            self.picklist_version)
+
+    @staticmethod
+    def _shared(result: ScanResult) -> ScanResult:
+        """
+        Copies the result of the scan this one waited for.
+        """
+        return replace(result, coalesced=True, timings=dict(result.timings))
+
+    def _scan(self, image_bytes: bytes, digest: str) -> ScanResult:
+        pending = self._begin(image_bytes, digest)
+        if isinstance(pending, ScanResult):
+            return pending
+        # The image is released as soon as the scan completes, whatever
+        # the outcome
+        with pending.session:
+            return self._infer(pending)
+
+    async def _scan_async(self, image_bytes: bytes, digest: str,
+                          on_analysis: Optional[AnalysisListener] = None
+                          ) -> ScanResult:
+        pending = await asyncio.to_thread(self._begin, image_bytes, digest)
+        if isinstance(pending, ScanResult):
+            return pending
+        with pending.session:
+            return await self._infer_async(pending, on_analysis)
+
+    def _infer(self, pending: PendingScan) -> ScanResult:
+        """
+        Runs the model calls of a scan the local steps did not answer.
+        """
+        session = pending.session
+        timings = pending.timings
+        analyzer = self.micro_batcher or self.ai_service
+        with timed(timings, "analyze"):
+            analysis = self.retry_policy.call(
+                lambda: analyzer.analyze_image(session),
+                pending.deadline, name="analyze")
+        if not analysis.ok:
+            return ScanResult(error=analysis.error, timings=timings)
+
+        agent_output = analysis.text
+        with timed(timings, "match"):
+            session.matches, refined_output = self._match_stage(agent_output)
+        resolved_locally = refined_output is not None
+        if len(session.matches) > 1 and not resolved_locally:
+            with timed(timings, "refine"):
+                refinement = self.retry_policy.call(
+                    lambda: self.matching_service.refine_match(
+                        self.ai_service, session),
+                    pending.deadline, name="refine")
+            return self._finish(pending, agent_output, session.matches,
+                                refinement)
+
+        return self._finish(pending, agent_output, session.matches,
+                            refined_output, resolved_locally)
+
+    async def _infer_async(self, pending: PendingScan,
+                           on_analysis: Optional[AnalysisListener] = None
+                           ) -> ScanResult:
+        """
+        Runs the model calls of a scan without blocking the event loop.
+        """
+        session = pending.session
+        timings = pending.timings
+        analyzer = self.micro_batcher or self.ai_service
+        with timed(timings, "analyze"):
+            analysis = await self.retry_policy.call_async(
+                lambda: analyzer.analyze_image_async(session),
+                pending.deadline, name="analyze")
+        if not analysis.ok:
+            return ScanResult(error=analysis.error, timings=timings)
+
+        agent_output = analysis.text
+        with timed(timings, "match"):
+            # Picklist lookups may query SQLite
+            session.matches, refined_output = await asyncio.to_thread(
+                self._match_stage, agent_output)
+        resolved_locally = refined_output is not None
+        if on_analysis is not None:
+            on_analysis(agent_output, session.matches)
+        if len(session.matches) > 1 and not resolved_locally:
+            with timed(timings, "refine"):
+                refinement = await self.retry_policy.call_async(
+                    lambda: self.matching_service.refine_match_async(
+                        self.ai_service, session),
+                    pending.deadline, name="refine")
+            return await asyncio.to_thread(
+                self._finish, pending, agent_output, session.matches,
+                refinement)
+
+        # Caching may write to the disk tier
+        return await asyncio.to_thread(
+            self._finish, pending, agent_output, session.matches,
+            refined_output, resolved_locally)
+
+    def _begin(self, image_bytes: bytes,
+               digest: str) -> Union[ScanResult, PendingScan]:
+        """
+        Runs every local step before the model call.
+
+        Args:
+            image_bytes: The uploaded image.
+            digest: Its SHA-256, hashed once per scan.
+
+        Returns:
+            A finished result when a cached or near-identical scan can be
+            reused or the local classifier is confident, otherwise the
+            state needed to call the model.
+        """
+        deadline = self.retry_policy.new_deadline()
+        timings: Dict[str, float] = {}
+        key = None
+        if self.cache is not None:
+            with timed(timings, "cache"):
+                key = self.cache.make_key(digest,
+                                          self.ai_service.model_name,
+                                          self.ai_service.prompt,
+                                          self.picklist_version)
+                entry = self.cache.get(key)
+            if entry is not None:
+                return ScanResult(
+                    agent_output=entry.agent_output,
+                    matches=self._match(entry.agent_output),
+                    refined_output=entry.refined_output,
+                    from_cache=True,
+                    timings=timings,
+                )
+
+        # The exact cache is keyed on the upload so a hit skips this too
+        with timed(timings, "preprocess"):
+            if self.preprocessor is not None:
+                image = self.preprocessor.prepare(image_bytes)
+            else:
+                image = PreparedImage(image_bytes, 'image/png',
+                                      len(image_bytes))
+
+        image_hash = None
+        reused = None
+        if self.perceptual_index is not None:
+            with timed(timings, "hash"):
+                image_hash = dhash(image.data)
+                if image_hash is not None:
+                    reused = self.perceptual_index.lookup(image_hash,
+                                                          self._context())
+            if reused is not None and not self.perceptual_index.should_audit():
+                return ScanResult(
+                    agent_output=reused.agent_output,
+                    matches=self._match(reused.agent_output),
+                    refined_output=reused.refined_output,
+                    from_cache=True,
+                    near_duplicate=True,
+                    timings=timings,
+                )
+
+        if self.local_classifier is not None:
+            with timed(timings, "local"):
+                product = self._classify_locally(image.data)
+            if product is not None:
+                return ScanResult(
+                    agent_output=json.dumps({"fruit": product.fruit},
+                                            ensure_ascii=False),
+                    matches=[product],
+                    classified_locally=True,
+                    timings=timings,
+                )
+
+        session = InferenceSession(image.data, image.mime_type,
+                                   self.priority)
+        return PendingScan(key, session, image_hash, reused, deadline,
+                           timings)
+
+    def _classify_locally(self, image_data: bytes) -> Optional[Product]:
+        """
+        Asks the local classifier for the product, if it is confident.
+
+        Returns:
+            The product, or None when the model should decide. PLUs no
+            longer in the picklist are left to the model too.
+        """
+        prediction = self.local_classifier.classify(image_data)
+        if prediction is None:
+            return None
+        return self.matching_service.get_by_plu(prediction.plu)
+
+    def _record(self, result: ScanResult, start: float,
+                digest: str) -> ScanResult:
+        """
+        Adds the image digest and the total time to the result and feeds
+        the metrics.
+        """
+        result.image_digest = digest
+        result.timings["scan"] = (time.perf_counter() - start) * 1000
+        if self.metrics is not None:
+            self.metrics.observe_timings(result.timings)
+            self.metrics.inc("scans_total", outcome=result.outcome)
+        return result
+
+    def _match_stage(self, agent_output: str
+                     ) -> Tuple[List[Product], Optional[str]]:
+        """
+        Finds the candidates of an agent output and, when the choice
+        between them is clear, settles it locally.
+
+        Returns:
+            The candidates and the locally chosen product as refined
+            output, or None.
+        """
+        matches = self._match(agent_output)
+        return matches, self._resolve_locally(agent_output, matches)
+
+    def _resolve_locally(self, agent_output: str,
+                         matches: List[Product]) -> Optional[str]:
+        """
+        Settles a choice between candidates without the model, if clear.
+
+        Returns:
+            The chosen product as refined output, or None.
+        """
+        if len(matches) < 2 or self.disambiguation_service is None:
+            return None
+        best = self.disambiguation_service.resolve(
+            self.matching_service.extract_fruit(agent_output), matches)
+        if best is None:
+            return None
+        return json.dumps(best.to_dict(), ensure_ascii=False)
+
+    def _finish(self, pending: PendingScan, agent_output: str,
+                matches: List[Product],
+                refined: Union[AnalysisResult, str, None],
+                resolved_locally: bool = False) -> ScanResult:
+        """
+        Records a scan answered by the model and builds its result.
+
+        Args:
+            refined: The refine call's result, the locally chosen product
+                as JSON, or None when no refinement was needed.
+        """
+        if isinstance(refined, AnalysisResult):
+            if not refined.ok:
+                # Callers fall back to the best ranked candidate; nothing
+                # is cached so the next scan asks the model again
+                print(f"Refinement failed: {refined.error}")
+                return ScanResult(agent_output=agent_output, matches=matches,
+                                  timings=pending.timings)
+            refined = refined.text
+        refined_output = refined
+
+        result = ScanResult(agent_output=agent_output, matches=matches,
+                            refined_output=refined_output,
+                            resolved_locally=resolved_locally,
+                            timings=pending.timings)
+
+        if not resolved_locally and matches:
+            self._observe(refined_output, matches)
+        if pending.key is not None:
+            self.cache.put(pending.key,
+                           CacheEntry(agent_output, refined_output))
+        if pending.reused is not None:
+            self.perceptual_index.record_audit(pending.reused, agent_output,
+                                               refined_output)
+        if pending.image_hash is not None:
+            self.perceptual_index.add(pending.image_hash, self._context(),
+                                      agent_output, refined_output)
+        return result
+
+    def _match(self, agent_output: str) -> List[Product]:
+        """
+        Finds the candidate products of an agent output.
+
+        In single-call mode the model answers with a PLU from the
+        shortlist, which settles the match without a refine call. Unknown
+        PLUs fall back to matching the fruit name.
+        """
+        if self.ai_service.single_call:
+            product = self.matching_service.find_by_plu(agent_output)
+            if product is not None:
+                return [product]
+        return self.matching_service.find_matches(agent_output)
+
+    def _observe(self, refined_output: Optional[str],
+                 matches: List[Product]) -> None:
+        """
+        Feeds the final answer of a scan to the disambiguation priors.
+        """
+        if self.disambiguation_service is None:
+            return
+        if refined_output is None:
+            self.disambiguation_service.observe(matches[0])
+            return
+        try:
+            plu = int(self.matching_service.parse_agent_output(
+                refined_output).get("PLU"))
+        except (TypeError, ValueError):
+            return
+        for product in matches:
+            if product.plu == plu:
+                self.disambiguation_service.observe(product)
+                return
+
+    def _context(self) -> str:
+        """
+        Identifies the model, prompt and picklist a result is valid for.
+        """
+        prompt_hash = hashlib.sha256(
+            self.ai_service.prompt.encode("utf-8")).hexdigest()[:16]
+        return (f"{self.ai_service.model_name}:{prompt_hash}:"
+                f"{self.picklist_version}")
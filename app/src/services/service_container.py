@@ -0,0 +1,232 @@
+import os
+import threading
+import time
+from typing import Optional, Tuple, Union
+from app.src.repositories.picklist_repository import PicklistRepository
+from app.src.repositories.picklist_store import PicklistStore
+from app.src.repositories.sqlite_picklist_repository import (
+    SqlitePicklist,
+    SqlitePicklistRepository,
+)
+from app.src.services.ai_service import AIService
+from app.src.services.matching_service import MatchingService
+from app.src.services.classification_cache import ClassificationCache
+from app.src.services.perceptual_index import PerceptualIndex
+from app.src.services.disambiguation_service import DisambiguationService
+from app.src.services.hedging import HedgingPolicy
+from app.src.services.history_writer import HistoryWriter
+from app.src.services.image_preprocessor import ImagePreprocessor
+from app.src.services.local_classifier import LocalClassifier
+from app.src.services.metrics import MetricsRegistry
+from app.src.services.micro_batcher import MicroBatcher
+from app.src.services.rate_limiter import INTERACTIVE, RateLimiter
+from app.src.services.retry_policy import CircuitBreaker, RetryPolicy
+from app.src.services.scan_service import ScanService
+from app.src.services.single_flight import SingleFlight
+from app.src.config.settings import settings
+
+
+FileStamp = Optional[Tuple[int, int]]
+
+
+class ServiceContainer:
+    """
+    Long-lived, thread-safe holder of the services shared by every scan
+    in a worker process.
+
+    The picklist is parsed and the prompt is read once. Both are reloaded
+    automatically when the modification time of their file changes. With
+    PICKLIST_BACKEND=sqlite the picklist is queried live from the database
+    instead, and only its version counter is polled.
+    """
+
+    def __init__(self,
+                 picklist_path: str = settings.PICKLIST_PATH,
+                 prompt_path: str = settings.PROMPT_PATH,
+                 model_name: str = settings.AGENT_MODEL,
+                 check_interval: float = settings.RELOAD_CHECK_INTERVAL):
+        """
+        Initializes the container and loads every service.
+
+        Args:
+            picklist_path: Path to the JSON picklist file.
+            prompt_path: Path to the text file containing the prompt.
+            model_name: The name of the Gemini model to use.
+            check_interval: Minimum seconds between two mtime checks.
+        """
+        self.check_interval = check_interval
+        self._lock = threading.RLock()
+        self._last_check = time.monotonic()
+
+        if settings.PICKLIST_BACKEND == "sqlite":
+            self._picklist_repo = SqlitePicklistRepository()
+            self._picklist_stamp = None
+        else:
+            self._picklist_repo = PicklistRepository(picklist_path)
+            self._picklist_stamp = self._stamp(picklist_path)
+        self._products = self._picklist_repo.load()
+        self._picklist_version = self._products.fingerprint
+        self._matching_service = MatchingService(self._products)
+
+        self.metrics = MetricsRegistry() if settings.METRICS_ENABLED else None
+        self.rate_limiter = (RateLimiter(metrics=self.metrics)
+                             if settings.RATE_LIMIT_PER_MINUTE > 0 else None)
+        self._prompt_stamp = self._stamp(prompt_path)
+        self.hedging = (HedgingPolicy(metrics=self.metrics)
+                        if settings.HEDGE_ENABLED else None)
+        self._ai_service = AIService(model_name, prompt_path,
+                                     rate_limiter=self.rate_limiter,
+                                     hedging=self.hedging)
+
+        self.cache = ClassificationCache() if settings.CACHE_ENABLED else None
+        self.perceptual_index = (PerceptualIndex()
+                                 if settings.PHASH_ENABLED else None)
+        self.disambiguation_service = (
+            DisambiguationService.from_file()
+            if settings.LOCAL_RESOLVE_ENABLED else None)
+        self.preprocessor = (ImagePreprocessor()
+                             if settings.PREPROCESS_ENABLED else None)
+        self.local_classifier = LocalClassifier.from_file()
+        self.single_flight = (SingleFlight()
+                              if settings.SINGLE_FLIGHT_ENABLED else None)
+        self.micro_batcher = (MicroBatcher(self._ai_service)
+                              if settings.MICRO_BATCH_ENABLED else None)
+        self.history = HistoryWriter() if settings.HISTORY_ENABLED else None
+        self.circuit_breaker = CircuitBreaker()
+        self.retry_policy = RetryPolicy(breaker=self.circuit_breaker,
+                                        metrics=self.metrics)
+        self._bind_picklist()
+
+    @staticmethod
+    def _stamp(path: str) -> FileStamp:
+        """
+        Returns the (mtime, size) pair of a file, or None if it is missing.
+        """
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def _bind_picklist(self) -> None:
+        """
+        Compiles the current picklist into single-call prompts.
+        """
+        priority = (self.disambiguation_service.prior
+                    if self.disambiguation_service else None)
+        self._ai_service.bind_picklist(self._products,
+                                       self._picklist_version, priority)
+
+    def refresh(self, force: bool = False) -> None:
+        """
+        Reloads the picklist and the prompt if their files changed.
+
+        Args:
+            force: Check the files even if the check interval has not
+                elapsed yet.
+        """
+        now = time.monotonic()
+        if not force and now - self._last_check < self.check_interval:
+            return
+
+        with self._lock:
+            if not force and now - self._last_check < self.check_interval:
+                return
+            self._last_check = now
+
+            if isinstance(self._products, SqlitePicklist):
+                # Lookups already see every change; only what was cached
+                # for the previous content needs a new version
+                version = self._products.fingerprint
+                if version != self._picklist_version:
+                    self._picklist_version = version
+                    self._bind_picklist()
+                    print(f"Picklist changed (version {version})")
+            else:
+                self._reload_picklist_file()
+
+            prompt_stamp = self._stamp(self._ai_service.prompt_path)
+            if prompt_stamp != self._prompt_stamp:
+                self._ai_service.reload_prompt()
+                self._prompt_stamp = prompt_stamp
+                print("Prompt reloaded")
+
+    def _reload_picklist_file(self) -> None:
+        """
+        Reloads the JSON picklist if its file changed.
+        """
+        picklist_stamp = self._stamp(self._picklist_repo.file_path)
+        if picklist_stamp != self._picklist_stamp:
+            products = self._picklist_repo.load()
+            if products:
+                self._products = products
+                self._picklist_version = products.fingerprint
+                self._matching_service = MatchingService(products)
+                self._bind_picklist()
+                print(f"Picklist reloaded ({len(products)} products)")
+            self._picklist_stamp = picklist_stamp
+
+    @property
+    def products(self) -> Union[PicklistStore, SqlitePicklist]:
+        """
+        Returns the current picklist.
+        """
+        self.refresh()
+        return self._products
+
+    @property
+    def matching_service(self) -> MatchingService:
+        """
+        Returns the matching service built from the current picklist.
+        """
+        self.refresh()
+        return self._matching_service
+
+    @property
+    def ai_service(self) -> AIService:
+        """
+        Returns the shared AI service and its pooled client.
+        """
+        self.refresh()
+        return self._ai_service
+
+    def build_scan_service(self, priority: str = INTERACTIVE) -> ScanService:
+        """
+        Builds a scan service over the current shared services.
+
+        Args:
+            priority: Rate limiter class of its model calls.
+
+        Returns:
+            A ScanService wired to the shared caches and to the retry
+            policy whose circuit breaker every scan of the process shares.
+        """
+        self.refresh()
+        return ScanService(self._ai_service, self._matching_service,
+                           cache=self.cache,
+                           perceptual_index=self.perceptual_index,
+                           disambiguation_service=self.disambiguation_service,
+                           preprocessor=self.preprocessor,
+                           picklist_version=self._picklist_version,
+                           retry_policy=self.retry_policy,
+                           metrics=self.metrics,
+                           local_classifier=self.local_classifier,
+                           single_flight=self.single_flight,
+                           micro_batcher=self.micro_batcher,
+                           priority=priority)
+
+
+_container: Optional[ServiceContainer] = None
+_container_lock = threading.Lock()
+
+
+def get_container() -> ServiceContainer:
+    """
+    Returns the process-wide service container, creating it on first use.
+    """
+    global _container
+    if _container is None:
+        with _container_lock:
+            if _container is None:
+                _container = ServiceContainer()
+    return _container
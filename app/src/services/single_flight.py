@@ -0,0 +1,210 @@
+import asyncio
+import os
+import threading
+import time
+from concurrent.futures import Future
+from typing import Awaitable, Callable, Dict, Optional, Tuple, TypeVar
+from app.src.config.settings import settings
+
+try:
+    import fcntl
+except ImportError:  # Windows: no cross-process coalescing
+    fcntl = None
+
+
+T = TypeVar("T")
+
+# Seconds between two attempts at a lock held by another process
+LOCK_POLL_INTERVAL = 0.02
+
+# Result of a flight whose leader was cancelled; its followers try again
+_ABANDONED = object()
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls for the same key into one execution.
+
+    The first caller of a key (the leader) runs the work; callers arriving
+    while it is in flight wait for it and share its result, or its
+    exception. If the leader is cancelled instead, e.g. because its client
+    went away, a waiting caller takes over and runs the work. Threads and
+    event loops of one process share the same flights, so a double-tapped
+    scan makes one set of model calls.
+
+    With a lock directory, the leader also takes an exclusive file lock
+    on the key, so leaders of the same key in other worker processes run
+    one after the other. Each then finds the answer of the previous one
+    in the persistent classification cache (CACHE_DB_PATH).
+    """
+
+    def __init__(self,
+                 lock_dir: str = settings.SINGLE_FLIGHT_LOCK_DIR,
+                 lock_timeout: float = settings.RETRY_DEADLINE):
+        """
+        Initializes the coalescer.
+
+        Args:
+            lock_dir: Directory of the cross-process lock files, or an
+                empty string to coalesce within the process only.
+            lock_timeout: Maximum seconds to wait for another process;
+                the work then runs anyway.
+        """
+        self.lock_dir = lock_dir if fcntl is not None else ""
+        self.lock_timeout = lock_timeout
+        self.leaders = 0
+        self.followers = 0
+        self._flights: Dict[str, Future] = {}
+        self._lock = threading.Lock()
+        if lock_dir and fcntl is None:
+            print("File locks unavailable, coalescing within the process")
+        elif lock_dir:
+            os.makedirs(lock_dir, exist_ok=True)
+
+    def _join(self, key: str) -> Tuple[Future, bool]:
+        """
+        Returns the flight of a key and whether the caller leads it.
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None:
+                self.followers += 1
+                return flight, False
+            flight = self._flights[key] = Future()
+            self.leaders += 1
+            return flight, True
+
+    def _land(self, key: str, flight: Future, result=None,
+              error: Optional[BaseException] = None) -> None:
+        with self._lock:
+            del self._flights[key]
+        if error is not None:
+            flight.set_exception(error)
+        else:
+            flight.set_result(result)
+
+    def do(self, key: str, fn: Callable[[], T]) -> Tuple[T, bool]:
+        """
+        Runs fn, unless a call with the same key is already in flight.
+
+        Args:
+            key: Identifies the work, e.g. a hash of the image.
+            fn: The work.
+
+        Returns:
+            The result and whether it was shared from another call.
+        """
+        while True:
+            flight, leader = self._join(key)
+            if leader:
+                break
+            result = flight.result()
+            if result is not _ABANDONED:
+                return result, True
+
+        try:
+            lock = self._acquire(key)
+            try:
+                result = fn()
+            finally:
+                self._release(key, lock)
+        except Exception as e:
+            self._land(key, flight, error=e)
+            raise
+        except BaseException:
+            self._land(key, flight, _ABANDONED)
+            raise
+        self._land(key, flight, result)
+        return result, False
+
+    async def do_async(self, key: str,
+                       fn: Callable[[], Awaitable[T]]) -> Tuple[T, bool]:
+        """
+        Awaits fn(), unless a call with the same key is already in flight.
+
+        Args:
+            key: Identifies the work, e.g. a hash of the image.
+            fn: Returns the awaitable doing the work.
+
+        Returns:
+            The result and whether it was shared from another call.
+        """
+        while True:
+            flight, leader = self._join(key)
+            if leader:
+                break
+            # Shielded: a follower going away must not cancel the flight
+            result = await asyncio.shield(asyncio.wrap_future(flight))
+            if result is not _ABANDONED:
+                return result, True
+
+        try:
+            lock = (await asyncio.to_thread(self._acquire, key)
+                    if self.lock_dir else None)
+            try:
+                result = await fn()
+            finally:
+                self._release(key, lock)
+        except Exception as e:
+            self._land(key, flight, error=e)
+            raise
+        except BaseException:
+            # Cancelled: not an outcome of the work, so not shared
+            self._land(key, flight, _ABANDONED)
+            raise
+        self._land(key, flight, result)
+        return result, False
+
+    def _acquire(self, key: str) -> Optional[int]:
+        """
+        Takes the cross-process lock of a key.
+
+        Returns:
+            The descriptor of the locked file, or None when there is no
+            lock directory or the wait timed out.
+        """
+        if not self.lock_dir:
+            return None
+        try:
+            fd = os.open(os.path.join(self.lock_dir, f"{key[:32]}.lock"),
+                         os.O_RDWR | os.O_CREAT, 0o644)
+        except OSError as e:
+            print(f"Error opening single-flight lock: {e}")
+            return None
+
+        deadline = time.monotonic() + self.lock_timeout
+        while True:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return fd
+            except BlockingIOError:
+                if time.monotonic() >= deadline:
+                    os.close(fd)
+                    return None
+                time.sleep(LOCK_POLL_INTERVAL)
+
+    def _release(self, key: str, fd: Optional[int]) -> None:
+        if fd is None:
+            return
+        # Unlinking while still locked: processes already waiting on the
+        # old file carry on, new ones start a fresh file. At worst two of
+        # them run at once, which only costs a duplicate call.
+        try:
+            os.unlink(os.path.join(self.lock_dir, f"{key[:32]}.lock"))
+        except OSError:
+            pass
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+
+    def stats(self) -> Dict[str, float]:
+        """
+        Returns how many calls were coalesced into another one.
+        """
+        with self._lock:
+            total = self.leaders + self.followers
+            return {
+                "in_flight": len(self._flights),
+                "leaders": self.leaders,
+                "followers": self.followers,
+                "coalesced_rate": self.followers / total if total else 0.0,
+            }
@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from app.src.config.settings import settings
+from app.src.repositories.picklist_repository import PicklistRepository
+from app.src.repositories.sqlite_picklist_repository import (
+    SqlitePicklistRepository,
+)
+
+
+class Command(BaseCommand):
+    help = ("Bulk-imports a JSON picklist into the SQLite picklist used "
+            "with PICKLIST_BACKEND=sqlite. Running workers see the changes "
+            "on their next scan.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', nargs='?', default=settings.PICKLIST_PATH,
+                            help='JSON picklist file')
+        parser.add_argument('--db', default=None,
+                            help='SQLite database (default: PICKLIST_DB_PATH)')
+        parser.add_argument('--replace', action='store_true',
+                            help='delete the products missing from the file')
+
+    def handle(self, *args, **options):
+        products = PicklistRepository(options['path'],
+                                      snapshot_path='').load_products()
+        if not products:
+            raise CommandError(f"No products read from {options['path']}")
+
+        db_path = options['db'] or settings.PICKLIST_DB_PATH
+
+        repository = SqlitePicklistRepository(db_path)
+        written, deleted = repository.upsert(products,
+                                             replace=options['replace'])
+        self.stdout.write(self.style.SUCCESS(
+            f"Imported {len(products)} products into {db_path}: "
+            f"{written} written, {deleted} deleted, "
+            f"{len(products) - written} unchanged."))
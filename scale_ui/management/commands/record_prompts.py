@@ -0,0 +1,56 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand, CommandError
+from google import genai
+
+from app.src.config.settings import settings
+from app.src.services.call_recorder import CallRecorder, RecordingClient
+from app.src.services.fake_genai_client import FakeGenAIClient
+from app.src.services.replay_service import build_scan_service, load_picklist
+from scale_ui.management.commands.train_classifier import read_examples
+
+
+class Command(BaseCommand):
+    help = ("Scans labelled images with each prompt and records the model "
+            "calls, for `replay_prompts` to compare the prompts offline.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('sources', nargs='+',
+                            help='JSONL results of app.main --batch, or '
+                                 'directories of images named by PLU')
+        parser.add_argument('--prompt', action='append', dest='prompts',
+                            help='prompt file to record, repeatable '
+                                 '(default: PROMPT)')
+        parser.add_argument('--output', default='calls.jsonl',
+                            help='JSONL corpus the calls are appended to')
+        parser.add_argument('--workers', type=int,
+                            default=settings.BATCH_WORKERS,
+                            help='concurrent scans')
+
+    def handle(self, *args, **options):
+        examples = [example for source in options['sources']
+                    for example in read_examples(source)]
+        if not examples:
+            raise CommandError("No labelled images found")
+
+        products = load_picklist()
+        recorder = CallRecorder(options['output'])
+        # The configured backend: Gemini, or the fake for a dry run
+        backend = (FakeGenAIClient() if settings.GEMINI_BACKEND == "fake"
+                   else genai.Client(api_key=settings.GEMINI_API_KEY))
+        client = RecordingClient(backend, recorder)
+        try:
+            for prompt_path in options['prompts'] or [settings.PROMPT_PATH]:
+                scan_service = build_scan_service(prompt_path, client,
+                                                  products)
+                with ThreadPoolExecutor(options['workers']) as executor:
+                    results = list(executor.map(
+                        scan_service.scan,
+                        (image_bytes for _, image_bytes in examples)))
+                errors = sum(bool(result.error) for result in results)
+                self.stdout.write(f"{prompt_path}: {len(results)} scans, "
+                                  f"{errors} errors")
+        finally:
+            recorder.close()
+        self.stdout.write(self.style.SUCCESS(
+            f"Recorded {recorder.recorded} calls to {options['output']}"))
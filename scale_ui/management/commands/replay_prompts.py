@@ -0,0 +1,60 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from app.src.config.settings import settings
+from app.src.services.replay_service import ReplayService
+from scale_ui.management.commands.train_classifier import read_examples
+
+
+class Command(BaseCommand):
+    help = ("Replays the pipeline against recorded model calls and reports "
+            "accuracy, tokens, refine-call rate and latency per prompt.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('corpus',
+                            help='JSONL corpus written by record_prompts or '
+                                 'RECORD_CALLS_PATH')
+        parser.add_argument('sources', nargs='+',
+                            help='the labelled images the corpus was '
+                                 'recorded over')
+        parser.add_argument('--prompt', action='append', dest='prompts',
+                            help='prompt file to replay, repeatable '
+                                 '(default: PROMPT)')
+        parser.add_argument('--workers', type=int, default=None,
+                            help='worker processes (default: one per CPU '
+                                 'core)')
+        parser.add_argument('--report', default=None,
+                            help='also write the report as JSON')
+
+    def handle(self, *args, **options):
+        examples = [example for source in options['sources']
+                    for example in read_examples(source)]
+        if not examples:
+            raise CommandError("No labelled images found")
+
+        prompts = options['prompts'] or [settings.PROMPT_PATH]
+        try:
+            reports = ReplayService(options['corpus'], prompts,
+                                    options['workers']).run(examples)
+        except OSError as e:
+            raise CommandError(f"Cannot read corpus: {e}")
+
+        self.stdout.write(f"{'prompt':<36} {'accuracy':>8} {'refine':>7} "
+                          f"{'in tok':>7} {'out tok':>7} {'p50 ms':>8} "
+                          f"{'p95 ms':>8} {'missing':>7}")
+        for prompt_path, report in reports.items():
+            self.stdout.write(
+                f"{prompt_path:<36} {report['accuracy']:>8.1%} "
+                f"{report['refine_rate']:>7.1%} "
+                f"{report['prompt_tokens']:>7.0f} "
+                f"{report['response_tokens']:>7.0f} "
+                f"{report['p50_ms']:>8.1f} {report['p95_ms']:>8.1f} "
+                f"{report['unrecorded']:>7}")
+        if any(report['unrecorded'] for report in reports.values()):
+            self.stdout.write(self.style.WARNING(
+                "Some scans needed calls missing from the corpus; record "
+                "them again with the current prompts and picklist."))
+        if options['report']:
+            with open(options['report'], 'w') as f:
+                json.dump(reports, f, indent=2)
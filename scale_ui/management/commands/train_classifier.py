@@ -0,0 +1,138 @@
+import json
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+
+from app.src.config.settings import settings
+from app.src.services.local_classifier import LocalClassifier
+
+THRESHOLDS = (0.5, 0.6, 0.7, 0.8, 0.9, 0.95, 1.0)
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp', '.bmp', '.gif')
+
+
+def list_examples(source):
+    """
+    Yields the (capture time, PLU, image path) of the confirmed
+    classifications in a source: a JSONL file with "path", "PLU" and
+    "confirmed" per line (the output of `app.main --batch`), or a
+    directory with one sub-directory per PLU. The capture time is the
+    image's mtime.
+    """
+    if os.path.isdir(source):
+        for entry in sorted(os.scandir(source), key=lambda e: e.name):
+            if not entry.is_dir() or not entry.name.isdigit():
+                continue
+            for name in sorted(os.listdir(entry.path)):
+                if name.lower().endswith(IMAGE_EXTENSIONS):
+                    path = os.path.join(entry.path, name)
+                    try:
+                        yield os.path.getmtime(path), int(entry.name), path
+                    except OSError as e:
+                        print(f"Skipping {path}: {e}")
+        return
+
+    with open(source) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+                plu = int(record['PLU'])
+                path = record['path']
+            except (ValueError, TypeError, KeyError):
+                continue
+            # Only answers the model gave itself: not a fallback after a
+            # failed refinement, nor a guess of the local disambiguation
+            # or of the classifier, which would only reinforce it
+            if not record.get('confirmed'):
+                continue
+            try:
+                yield os.path.getmtime(path), plu, path
+            except OSError as e:
+                print(f"Skipping {path}: {e}")
+
+
+def load_images(examples):
+    """
+    Yields the (PLU, image bytes) of (capture time, PLU, image path)
+    examples, skipping the images that cannot be read.
+    """
+    for _, plu, path in examples:
+        try:
+            with open(path, 'rb') as image:
+                yield plu, image.read()
+        except OSError as e:
+            print(f"Skipping {path}: {e}")
+
+
+def read_examples(source):
+    """
+    Yields the (PLU, image bytes) of the confirmed classifications in a
+    source (see list_examples).
+    """
+    return load_images(list_examples(source))
+
+
+class Command(BaseCommand):
+    help = ("Trains the local pre-classifier from confirmed classifications "
+            "and reports its offload rate against its accuracy.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('sources', nargs='+',
+                            help='JSONL results of app.main --batch, or '
+                                 'directories of images named by PLU')
+        parser.add_argument('--output', default=None,
+                            help='model file (default: LOCAL_CLASSIFIER_PATH '
+                                 'or local_classifier.json)')
+        parser.add_argument('--k', type=int, default=5,
+                            help='neighbours voting')
+        parser.add_argument('--distance-percentile', type=float,
+                            default=0.95,
+                            help='share of the training examples within '
+                                 'the trusted distance')
+        parser.add_argument('--holdout', type=float, default=0.2,
+                            help='share of the most recent images kept '
+                                 'out of training to evaluate on')
+        parser.add_argument('--report', default=None,
+                            help='also write the evaluation as JSON')
+
+    def handle(self, *args, **options):
+        # Consecutive frames of one scan are nearly identical, so the
+        # images are split by time rather than drawn at random: the
+        # evaluation only sees scans made after every training one
+        examples = sorted(example for source in options['sources']
+                          for example in list_examples(source))
+        held_out = int(len(examples) * options['holdout'])
+        training = examples[:len(examples) - held_out]
+        evaluation = examples[len(examples) - held_out:]
+
+        classifier = LocalClassifier.train(
+            load_images(training), k=options['k'],
+            distance_percentile=options['distance_percentile'])
+        if len(classifier) < 2:
+            raise CommandError("At least two labelled images are needed")
+
+        output = (options['output'] or settings.LOCAL_CLASSIFIER_PATH
+                  or 'local_classifier.json')
+        classifier.save(output)
+        self.stdout.write(self.style.SUCCESS(
+            f"Trained on {len(classifier)} images of "
+            f"{len(set(classifier.labels))} products, saved to {output} "
+            f"(max distance {classifier.max_distance:.3f})"))
+
+        if not evaluation:
+            self.stdout.write(self.style.WARNING(
+                "No images held out, skipping the evaluation"))
+            return
+        report = classifier.evaluate(load_images(evaluation), THRESHOLDS)
+        self.stdout.write(f"Evaluation on the {len(evaluation)} most "
+                          f"recent images:")
+        self.stdout.write(f"{'threshold':>9} {'offload':>8} {'accuracy':>9}")
+        for row in report:
+            self.stdout.write(f"{row['threshold']:>9.2f} "
+                              f"{row['offload_rate']:>8.1%} "
+                              f"{row['accuracy']:>9.1%}")
+        if options['report']:
+            with open(options['report'], 'w') as f:
+                json.dump({'examples': len(classifier),
+                           'held_out': len(evaluation),
+                           'max_distance': classifier.max_distance,
+                           'thresholds': report}, f, indent=2)
@@ -1,3 +1,2007 @@
-from django.test import TestCase
+import asyncio
+import hashlib
+import io
+import json
+import os
+import random
+import sqlite3
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+from unittest.mock import patch
 
-# Create your tests here.
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import SimpleTestCase
+from google.genai import errors
+from PIL import Image, ImageDraw
+
+from app.src.config.settings import settings as app_settings
+from app.src.models.analysis_result import AnalysisResult
+from app.src.models.inference_session import InferenceSession
+from app.src.models.product import Product
+from app.src.models.scan_result import ScanResult
+from app.src.repositories.picklist_repository import PicklistRepository
+from app.src.repositories.picklist_store import PicklistStore
+from app.src.repositories.sqlite_picklist_repository import (
+    SqlitePicklistRepository,
+)
+from app.src.services.ai_service import (
+    AIService,
+    is_retryable,
+    split_batch_answer,
+)
+from app.src.services.batch_service import BatchService
+from app.src.services.call_recorder import (
+    CallRecorder,
+    RecordingClient,
+    ReplayClient,
+    UnrecordedCall,
+    load_corpus,
+)
+from app.src.services.classification_cache import (
+    CacheEntry,
+    ClassificationCache,
+)
+from app.src.services.disambiguation_service import DisambiguationService
+from app.src.services.fake_genai_client import FakeGenAIClient, FakeModels
+from app.src.services.file_service import (
+    EVENT_HEADER,
+    IN_CLOSE_WRITE,
+    IN_Q_OVERFLOW,
+    FileService,
+)
+from app.src.services.hedging import HedgingPolicy
+from app.src.services.history_writer import HistoryWriter
+from app.src.services.image_preprocessor import ImagePreprocessor
+from app.src.services.local_classifier import LocalClassifier
+from app.src.services.matching_service import MatchingService
+from app.src.services.metrics import MetricsRegistry, server_timing
+from app.src.services.micro_batcher import MicroBatcher
+from app.src.services.output_parser import ParseError, parse_model_output
+from app.src.services.perceptual_index import (
+    HASH_BITS,
+    PerceptualIndex,
+    dhash,
+)
+from app.src.services.product_index import ProductIndex
+from app.src.services.rate_limiter import BATCH, INTERACTIVE, RateLimiter
+from app.src.services.replay_service import ReplayService, build_scan_service
+from app.src.services.retry_policy import CircuitBreaker, RetryPolicy
+from app.src.services.scan_service import ScanService
+from app.src.services.service_container import ServiceContainer
+from app.src.services.single_flight import SingleFlight
+from scale_ui.management.commands.train_classifier import list_examples
+
+
+def unavailable():
+    return errors.ServerError(503, {'error': {'message': 'overloaded',
+                                              'status': 'UNAVAILABLE'}})
+
+
+def bad_request():
+    return errors.ClientError(400, {'error': {'message': 'bad image',
+                                              'status': 'INVALID_ARGUMENT'}})
+
+
+class ScanRetryTests(SimpleTestCase):
+    """
+    Retry policy and circuit breaker against the local fake client.
+    """
+
+    def setUp(self):
+        self.client = FakeGenAIClient(latency=0)
+        self.models = self.client.models
+        self.breaker = CircuitBreaker(failure_threshold=3, reset_timeout=60)
+        self.policy = RetryPolicy(max_attempts=4, base_delay=0.001,
+                                  max_delay=0.002, deadline=5,
+                                  breaker=self.breaker)
+        products = PicklistRepository().load()
+        self.scan_service = ScanService(
+            AIService(client=self.client), MatchingService(products),
+            retry_policy=self.policy)
+
+    def test_retryable_errors_are_retried_until_success(self):
+        self.models.script = [unavailable(), unavailable(),
+                              '{"fruit": "Kiwi"}']
+
+        result = self.scan_service.scan(b'image')
+
+        self.assertIsNone(result.error)
+        self.assertEqual([p.plu for p in result.matches], [50719])
+        self.assertEqual(self.models.calls, 3)
+
+    def test_non_retryable_errors_fail_immediately(self):
+        self.models.script = [bad_request()]
+
+        result = self.scan_service.scan(b'image')
+
+        self.assertIn('400', result.error)
+        self.assertEqual(self.models.calls, 1)
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+
+    def test_gives_up_after_max_attempts(self):
+        self.breaker.failure_threshold = 100
+        self.models.script = [unavailable()] * 10
+
+        result = self.scan_service.scan(b'image')
+
+        self.assertIsNotNone(result.error)
+        self.assertEqual(self.models.calls, 4)
+
+    def test_deadline_stops_retries(self):
+        self.policy.deadline_seconds = 0.01
+        # No jitter: any backoff would outlast the deadline
+        self.policy.backoff = lambda attempt: 1.0
+        self.models.script = [unavailable()] * 10
+
+        result = self.scan_service.scan(b'image')
+
+        self.assertIsNotNone(result.error)
+        self.assertEqual(self.models.calls, 1)
+
+    def test_sync_calls_run_in_the_calling_thread(self):
+        threads = threading.active_count()
+
+        result = self.policy.call(
+            lambda: AnalysisResult(text=str(threading.get_ident())))
+
+        self.assertEqual(result.text, str(threading.get_ident()))
+        self.assertEqual(threading.active_count(), threads)
+
+    def test_calls_that_never_reached_the_backend_leave_the_circuit(self):
+        self.breaker.reset_timeout = 0.05
+        for _ in range(3):
+            self.breaker.record(AnalysisResult.failure('503',
+                                                       retryable=True))
+        time.sleep(0.06)
+        self.assertTrue(self.breaker.allow())
+
+        # The trial is shed by the rate limiter
+        self.breaker.record(AnalysisResult.failure('Rate limited',
+                                                   sent=False))
+
+        self.assertEqual(self.breaker.state, CircuitBreaker.HALF_OPEN)
+        self.assertTrue(self.breaker.allow())
+        # A bad request still shows the backend answers
+        self.breaker.record(AnalysisResult.failure('400 INVALID_ARGUMENT'))
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+
+    def test_open_circuit_fails_fast(self):
+        self.models.script = [unavailable()] * 10
+
+        self.scan_service.scan(b'image')
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+        calls = self.models.calls
+
+        result = self.scan_service.scan(b'other image')
+
+        self.assertIn('circuit open', result.error)
+        self.assertEqual(self.models.calls, calls)
+
+    def test_half_open_trial_closes_circuit(self):
+        self.models.script = [unavailable()] * 3
+        self.scan_service.scan(b'image')
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+
+        self.breaker.reset_timeout = 0
+        self.models.script = ['{"fruit": "Kiwi"}']
+        result = self.scan_service.scan(b'other image')
+
+        self.assertIsNone(result.error)
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+
+    async def test_cancelled_trial_reopens_circuit(self):
+        self.breaker.reset_timeout = 0.05
+        for _ in range(3):
+            self.breaker.record(AnalysisResult.failure('503',
+                                                       retryable=True))
+        await asyncio.sleep(0.06)
+        started = asyncio.Event()
+
+        async def hanging():
+            started.set()
+            await asyncio.sleep(60)
+
+        trial = asyncio.ensure_future(self.policy.call_async(hanging))
+        await started.wait()
+        self.assertEqual(self.breaker.state, CircuitBreaker.HALF_OPEN)
+        trial.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await trial
+
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+        self.assertFalse(self.breaker.allow())
+        await asyncio.sleep(0.06)
+        self.assertTrue(self.breaker.allow())
+
+    def test_lost_trial_is_replaced_after_reset_timeout(self):
+        self.breaker.reset_timeout = 0.05
+        for _ in range(3):
+            self.breaker.record(AnalysisResult.failure('503',
+                                                       retryable=True))
+        time.sleep(0.06)
+        # A trial that never reports back
+        self.assertTrue(self.breaker.allow())
+        self.assertFalse(self.breaker.allow())
+
+        time.sleep(0.06)
+        self.assertTrue(self.breaker.allow())
+
+    def test_raising_trial_reopens_circuit(self):
+        self.breaker.reset_timeout = 0
+        for _ in range(3):
+            self.breaker.record(AnalysisResult.failure('503',
+                                                       retryable=True))
+
+        def broken():
+            raise RuntimeError('bug')
+
+        with self.assertRaises(RuntimeError):
+            self.policy.call(broken)
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+
+    async def test_async_refine_sees_the_analysed_image(self):
+        self.models = self.client.aio.models
+
+        result = await self.scan_service.scan_async(b'image')
+
+        self.assertIsNone(result.error)
+        self.assertIn('51146', result.refined_output)
+        self.assertEqual(self.models.calls, 2)
+
+    def test_failed_refinement_is_not_cached(self):
+        self.policy.max_attempts = 1
+        self.scan_service.disambiguation_service = None
+        self.scan_service.cache = None
+        self.models.script = ['{"fruit": "Maca"}', bad_request()]
+
+        result = self.scan_service.scan(b'image')
+
+        self.assertIsNone(result.error)
+        self.assertIsNone(result.refined_output)
+        self.assertEqual(len(result.matches), 3)
+
+
+class FakeBackendTests(SimpleTestCase):
+    """
+    Configurable behaviour of the local Gemini stand-in.
+    """
+
+    def test_error_rate_raises_retryable_errors(self):
+        models = FakeModels(latency=0, error_rate=1.0)
+
+        with self.assertRaises(errors.ServerError) as raised:
+            models.generate_content('model', ['prompt'])
+
+        self.assertTrue(is_retryable(raised.exception))
+        self.assertEqual(models.errors, 1)
+
+    def test_lognormal_latency_is_centred_on_the_median(self):
+        models = FakeModels(latency=0.1, distribution='lognormal',
+                            sigma=1.0, seed=7)
+
+        delays = sorted(models.delay() for _ in range(2001))
+
+        self.assertAlmostEqual(delays[1000], 0.1, delta=0.01)
+        self.assertGreater(delays[-20], 0.5)
+
+    def test_unknown_distribution_is_rejected(self):
+        with self.assertRaises(ValueError):
+            FakeModels(distribution='pareto')
+
+    def test_configured_responses_are_returned(self):
+        models = FakeModels(latency=0, responses={
+            'analyze': ['{"fruit": "Kiwi"}'],
+            'refine': ['{"fruit": "Kiwi", "PLU": 50719, "Price": 2.0}'],
+            'single_call': []})
+
+        first = models.generate_content('model', [b'image', 'Identify'])
+        refined = models.generate_content('model', ['Re-examine this'])
+
+        self.assertEqual(first.text, '{"fruit": "Kiwi"}')
+        self.assertIn('50719', refined.text)
+
+
+class MetricsTests(SimpleTestCase):
+    """
+    Stage histograms and their Prometheus rendering.
+    """
+
+    def test_histogram_buckets_are_cumulative(self):
+        registry = MetricsRegistry(buckets=(0.1, 1.0))
+        for seconds in (0.05, 0.5, 0.7, 3.0):
+            registry.observe('model_call_duration_seconds', seconds,
+                             call='analyze')
+
+        text = registry.render()
+
+        for line in (
+                'model_call_duration_seconds_bucket'
+                '{call="analyze",le="0.1"} 1',
+                'model_call_duration_seconds_bucket'
+                '{call="analyze",le="1.0"} 3',
+                'model_call_duration_seconds_bucket'
+                '{call="analyze",le="+Inf"} 4',
+                'model_call_duration_seconds_count{call="analyze"} 4'):
+            self.assertIn(line, text)
+
+    def test_scans_record_stages_retries_and_outcome(self):
+        registry = MetricsRegistry()
+        client = FakeGenAIClient(latency=0)
+        client.models.script = [unavailable(), '{"fruit": "Kiwi"}']
+        scan_service = ScanService(
+            AIService(client=client),
+            MatchingService(PicklistRepository().load()),
+            retry_policy=RetryPolicy(base_delay=0.001, metrics=registry),
+            metrics=registry)
+
+        result = scan_service.scan(b'image')
+        text = registry.render()
+
+        self.assertIn('scan', result.timings)
+        self.assertIn('model_retries_total{call="analyze"} 1', text)
+        self.assertIn('model_calls_total{call="analyze",'
+                      'outcome="retryable_error"} 1', text)
+        self.assertIn('scans_total{outcome="model"} 1', text)
+        self.assertIn('scan_stage_duration_seconds_count{stage="analyze"} 1',
+                      text)
+
+    def test_server_timing_header(self):
+        self.assertEqual(server_timing({'analyze': 812.345, 'match': 0.2}),
+                         'analyze;dur=812.3, match;dur=0.2')
+
+
+class PicklistStoreTests(SimpleTestCase):
+    """
+    Columnar picklist store and its snapshot file.
+    """
+
+    products = [
+        Product('Maçã Gala', 51146, 0.85),
+        Product('Banana', 15982, 1.2),
+        Product('Maçã Fuji', 51147, 1.1),
+    ]
+
+    def test_store_round_trips_products(self):
+        store = PicklistStore.from_products(self.products)
+
+        self.assertEqual(list(store), self.products)
+        self.assertEqual(store[-1], self.products[-1])
+        self.assertEqual(len(store), 3)
+
+    def test_lookups_by_plu_and_name(self):
+        store = PicklistStore.from_products(self.products)
+
+        self.assertEqual(store.get_by_plu(15982).fruit, 'Banana')
+        self.assertIsNone(store.get_by_plu(99999))
+        self.assertEqual(store.search('MACA gala'), [self.products[0]])
+        self.assertEqual(store.search('Kiwi'), [])
+
+    def test_search_ranks_like_the_json_index(self):
+        products = PicklistRepository().load_products() + self.products
+        store = PicklistStore.from_products(products)
+        index = ProductIndex(products)
+
+        for query in ('maca', 'Maçã', 'banana', 'Toranja Vermelha', 'ma',
+                      'a', 'vermelh', 'xyz', ''):
+            self.assertEqual(store.search(query), index.search(query),
+                             query)
+        # Matching uses the snapshot's index rather than building one
+        self.assertIs(MatchingService(store).index, store)
+
+    def test_snapshot_is_reused_until_the_json_changes(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'picklist.json')
+            with open(path, 'w') as f:
+                json.dump([p.to_dict() for p in self.products], f)
+            repository = PicklistRepository(path)
+
+            first = repository.load()
+            second = repository.load()
+            self.assertTrue(second.memory_mapped)
+            self.assertEqual(first.fingerprint, second.fingerprint)
+
+            with open(path, 'w') as f:
+                json.dump([self.products[1].to_dict()], f)
+            reloaded = repository.load()
+
+            self.assertEqual(list(reloaded), [self.products[1]])
+            self.assertNotEqual(reloaded.fingerprint, first.fingerprint)
+
+
+class ProductIndexTests(SimpleTestCase):
+    """
+    Picklist search by the name the model returned.
+    """
+
+    products = [
+        Product('Maçã Gala', 51146, 0.85),
+        Product('Kiwi', 4030, 3.99),
+        Product('Abacaxi', 4430, 2.5),
+        Product('Maçã', 4017, 0.8),
+        Product('Banana Madeira', 23175, 1.9),
+    ]
+
+    def setUp(self):
+        self.index = ProductIndex(self.products)
+
+    def test_case_and_accents_are_ignored(self):
+        self.assertEqual(self.index.search('MACA'),
+                         [self.products[3], self.products[0]])
+        self.assertEqual(self.index.search('  maçã   gala '),
+                         [self.products[0]])
+        self.assertEqual(self.index.search('ABACAXÍ'), [self.products[2]])
+
+    def test_matches_are_ranked(self):
+        # Exact name, whole word, word prefix, then plain substring
+        products = [Product('Uvas Pretas', 1, 1.0), Product('Uva', 2, 1.0),
+                    Product('Cacho de Uva', 3, 1.0),
+                    Product('Pasta de Duva', 4, 1.0)]
+
+        self.assertEqual([p.plu for p in ProductIndex(products).search('uva')],
+                         [2, 3, 1, 4])
+
+    def test_short_queries_match_substrings(self):
+        # Too short for a trigram lookup, but still found inside words
+        self.assertEqual(self.index.search('ki'), [self.products[1]])
+        self.assertEqual(self.index.search('xi'), [self.products[2]])
+        self.assertEqual(self.index.search('a'),
+                         [self.products[2], self.products[3],
+                          self.products[0], self.products[4]])
+        self.assertEqual(self.index.search('q'), [])
+
+
+class SqlitePicklistTests(SimpleTestCase):
+    """
+    SQLite picklist with its FTS5 index.
+    """
+
+    products = [
+        Product('Banana Madeira', 23175, 1.9),
+        Product('Banana', 15982, 1.2),
+        Product('Maçã Gala', 51146, 0.85),
+    ]
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.repository = SqlitePicklistRepository(
+            os.path.join(directory.name, 'picklist.sqlite3'))
+        self.repository.upsert(self.products)
+        self.picklist = self.repository.load()
+
+    def test_search_ranks_like_the_json_index(self):
+        self.assertEqual([p.plu for p in self.picklist.search('banana')],
+                         [15982, 23175])
+        self.assertEqual(self.picklist.search('MACA'), [self.products[2]])
+        self.assertEqual(self.picklist.search('ba'), self.products[1::-1])
+        self.assertEqual(self.picklist.search('Kiwi'), [])
+        # Short queries too, inside words
+        self.assertEqual(self.picklist.search('la'), [self.products[2]])
+
+    def test_reimport_only_writes_changed_rows(self):
+        changed = [Product('Banana', 15982, 1.3)] + self.products[2:]
+
+        self.assertEqual(self.repository.upsert(self.products), (0, 0))
+        self.assertEqual(self.repository.upsert(changed, replace=True),
+                         (1, 1))
+        self.assertEqual(len(self.picklist), 2)
+
+    def test_changes_are_visible_live(self):
+        fingerprint = self.picklist.fingerprint
+
+        self.assertTrue(self.repository.set_price(51146, 0.99))
+        self.assertEqual(self.picklist.get_by_plu(51146).price, 0.99)
+        self.assertNotEqual(self.picklist.fingerprint, fingerprint)
+
+        self.assertTrue(self.repository.delete(51146))
+        self.assertIsNone(self.picklist.get_by_plu(51146))
+        self.assertFalse(self.repository.delete(51146))
+
+
+def fruit_photo(colour, rng):
+    """
+    A JPEG of a fruit-coloured blob on a grey tray.
+    """
+    image = Image.new('RGB', (160, 120), (200, 200, 200))
+    x, y = rng.randint(10, 80), rng.randint(10, 50)
+    tint = tuple(max(0, min(255, c + rng.randint(-20, 20))) for c in colour)
+    ImageDraw.Draw(image).ellipse((x, y, x + 60, y + 50), fill=tint)
+    buffer = io.BytesIO()
+    image.save(buffer, 'JPEG')
+    return buffer.getvalue()
+
+
+def disc_photo(colour, offset=0):
+    """
+    A JPEG of a disc on a white tray, always the same shape.
+    """
+    image = Image.new('RGB', (160, 120), (250, 250, 250))
+    ImageDraw.Draw(image).ellipse((40 + offset, 30, 110 + offset, 95),
+                                  fill=colour)
+    buffer = io.BytesIO()
+    image.save(buffer, 'JPEG')
+    return buffer.getvalue()
+
+
+class PerceptualIndexTests(SimpleTestCase):
+    """
+    Near-duplicate reuse keyed by shape and colour.
+    """
+
+    gala = (200, 30, 40)
+    golden = (230, 200, 40)
+
+    def setUp(self):
+        self.index = PerceptualIndex(max_distance=4, ttl=0)
+
+    def test_same_shape_of_another_colour_is_not_reused(self):
+        red, yellow = dhash(disc_photo(self.gala)), dhash(disc_photo(
+            self.golden))
+        # Brightness alone cannot tell them apart
+        self.assertLessEqual(((red ^ yellow) & (2 ** HASH_BITS - 1))
+                             .bit_count(), 4)
+
+        self.index.add(red, 'ctx', '{"fruit": "Maca Gala"}')
+
+        self.assertIsNone(self.index.lookup(yellow, 'ctx'))
+
+    def test_near_identical_photo_is_reused(self):
+        self.index.add(dhash(disc_photo(self.gala)), 'ctx',
+                       '{"fruit": "Maca Gala"}')
+
+        reused = self.index.lookup(dhash(disc_photo((205, 35, 45), 1)),
+                                   'ctx')
+
+        self.assertEqual(reused.agent_output, '{"fruit": "Maca Gala"}')
+
+
+class ImagePreprocessorTests(SimpleTestCase):
+    """
+    Uploads shrunk and re-encoded before they are sent to the model.
+    """
+
+    @staticmethod
+    def decode(prepared):
+        return Image.open(io.BytesIO(prepared.data))
+
+    def test_cropped_image_still_fills_max_side(self):
+        rng = random.Random(3)
+        image = Image.new('RGB', (2000, 1500))
+        image.putdata([tuple(rng.randrange(256) for _ in range(3))
+                       for _ in range(2000 * 1500 // 100)] * 100)
+        buffer = io.BytesIO()
+        image.save(buffer, 'JPEG')
+
+        prepared = ImagePreprocessor(max_side=512, crop=0.5).prepare(
+            buffer.getvalue())
+
+        self.assertEqual(prepared.mime_type, 'image/jpeg')
+        self.assertEqual(self.decode(prepared).size, (512, 384))
+
+    def test_transparent_areas_become_white(self):
+        rng = random.Random(4)
+        image = Image.new('RGBA', (600, 600), (0, 0, 0, 0))
+        noise = Image.new('RGBA', (300, 300))
+        noise.putdata([(rng.randrange(256), 0, 0, 255)
+                       for _ in range(300 * 300)])
+        image.paste(noise, (150, 150))
+        for mode in ('RGBA', 'P'):
+            buffer = io.BytesIO()
+            image.convert(mode).save(buffer, 'PNG')
+
+            prepared = ImagePreprocessor(max_side=100).prepare(
+                buffer.getvalue())
+
+            self.assertEqual(prepared.mime_type, 'image/jpeg', mode)
+            decoded = self.decode(prepared)
+            self.assertEqual(decoded.size, (100, 100))
+            corner = decoded.getpixel((2, 2))
+            self.assertTrue(all(c > 245 for c in corner), (mode, corner))
+
+    def test_undecodable_images_are_passed_through(self):
+        prepared = ImagePreprocessor().prepare(b'GIF89a not really')
+
+        self.assertEqual(prepared.data, b'GIF89a not really')
+        self.assertEqual(prepared.mime_type, 'image/gif')
+
+
+class PollClock:
+    """
+    Stands in for the watcher's clock: each poll advances the time by the
+    poll interval and runs the next step of a script (None: no change).
+    """
+
+    def __init__(self, *steps):
+        self.now = 0.0
+        self.steps = list(steps)
+
+    def sleep(self, seconds):
+        if not self.steps:
+            raise AssertionError('The watcher emitted nothing')
+        self.now += seconds
+        step = self.steps.pop(0)
+        if step is not None:
+            step()
+
+    def monotonic(self):
+        return self.now
+
+
+class SingleCallTests(SimpleTestCase):
+    """
+    Shortlist prompts answered with a PLU in one model call.
+    """
+
+    shortlist = 'app/prompts/shortlist.txt'
+
+    def setUp(self):
+        self.products = PicklistRepository().load()
+        self.client = FakeGenAIClient(latency=0)
+
+    def test_bind_picklist_fills_in_the_candidates(self):
+        ai_service = AIService(prompt_path=self.shortlist,
+                               client=self.client)
+        self.assertTrue(ai_service.single_call)
+
+        ai_service.bind_picklist(self.products, 'v1')
+
+        self.assertNotIn('{candidates}', ai_service.prompt)
+        self.assertIn('Maca Golden | 50716', ai_service.prompt)
+        self.assertIn('Kiwi | 50719', ai_service.prompt)
+        self.assertNotIn('Other fruit', ai_service.prompt)
+
+        few_shot = AIService(client=self.client)
+        prompt = few_shot.prompt
+        few_shot.bind_picklist(self.products, 'v1')
+        self.assertEqual(few_shot.prompt, prompt)
+
+    def test_large_picklists_list_their_most_popular_entries(self):
+        ai_service = AIService(prompt_path=self.shortlist,
+                               client=self.client)
+        popular = {50716: 9, 50719: 5}
+
+        with patch.object(app_settings, 'SHORTLIST_MAX_ENTRIES', 2):
+            ai_service.bind_picklist(
+                self.products, 'v1', lambda p: popular.get(p.plu, 0))
+
+        self.assertIn('Maca Golden | 50716\nKiwi | 50719\n'
+                      'Other fruit (no PLU): Abacate, Banana, ',
+                      ai_service.prompt)
+        self.assertNotIn('Maca Gala | 51146', ai_service.prompt)
+
+    def test_plu_answer_skips_the_refine_call(self):
+        ai_service = AIService(prompt_path=self.shortlist,
+                               client=self.client)
+        ai_service.bind_picklist(self.products, 'v1')
+        scan_service = ScanService(ai_service,
+                                   MatchingService(self.products))
+        self.client.models.script = [
+            '{"fruit": "Maca Golden", "PLU": 50716}',
+            '{"fruit": "Maca", "PLU": "N/A"}']
+
+        result = scan_service.scan(b'golden apple')
+
+        self.assertEqual(self.client.models.calls, 1)
+        self.assertNotIn('refine', result.timings)
+        self.assertEqual(result.best_match()['PLU'], 50716)
+
+        # A general name is still matched and refined as usual
+        result = scan_service.scan(b'some apple')
+
+        self.assertEqual(self.client.models.calls, 3)
+        self.assertIn('refine', result.timings)
+
+
+class DisambiguationTests(SimpleTestCase):
+    """
+    Choices between candidates settled without a refine call when clear.
+    """
+
+    apples = [Product('Maca Gala', 51146, 0.85),
+              Product('Maca Golden', 50716, 0.9),
+              Product('Maca Pink Lady', 4128, 1.1)]
+
+    def test_full_variety_name_resolves_locally(self):
+        service = DisambiguationService(margin=1.0, prior_weight=0)
+        self.assertEqual(service.resolve('maca golden', self.apples),
+                         self.apples[1])
+        self.assertEqual(service.stats()['resolved_locally'], 1)
+
+    def test_generic_name_is_left_to_the_model(self):
+        # Default margin and weights on the shipped picklist
+        service = DisambiguationService()
+        matching_service = MatchingService(PicklistRepository().load())
+        bananas = matching_service.find_matches('{"fruit": "Banana"}')
+        self.assertEqual([p.fruit for p in bananas],
+                         ['Banana', 'Banana Madeira'])
+
+        for _ in range(40):
+            service.observe(bananas[0])
+
+        self.assertIsNone(service.resolve('Banana', bananas))
+        self.assertEqual(service.resolve('Banana Madeira', bananas),
+                         bananas[1])
+
+    def test_lead_of_at_least_the_margin_resolves_a_misspelling(self):
+        # Name similarity only, 0.95 for Gala against 0.67 for Golden,
+        # as "Maca Gaala" names no candidate
+        self.assertEqual(
+            DisambiguationService(margin=0.25, prior_weight=0)
+            .resolve('Maca Gaala', self.apples), self.apples[0])
+
+        service = DisambiguationService(margin=0.3, prior_weight=0)
+        self.assertIsNone(service.resolve('Maca Gaala', self.apples))
+        self.assertEqual(service.stats()['resolved_remotely'], 1)
+
+    def test_priors_alone_do_not_settle_a_choice(self):
+        service = DisambiguationService()
+        for _ in range(1000):
+            service.observe(self.apples[1])
+
+        self.assertIsNone(service.resolve('Macas', self.apples))
+
+    def test_generic_name_makes_the_refine_call_despite_priors(self):
+        # The fake answers "Maca" for every image unless scripted
+        client = FakeGenAIClient(latency=0)
+        scan_service = ScanService(AIService(client=client),
+                                   MatchingService(self.apples),
+                                   disambiguation_service=(
+                                       DisambiguationService()))
+
+        for _ in range(40):
+            scan_service.disambiguation_service.observe(self.apples[1])
+        result = scan_service.scan(b'apple')
+        self.assertFalse(result.resolved_locally)
+        self.assertEqual(client.models.calls, 2)
+
+        client.models.script = ['{"fruit": "Maca Golden"}']
+        result = scan_service.scan(b'another apple')
+
+        self.assertEqual(result.best_match()['PLU'], 50716)
+        self.assertEqual(client.models.calls, 3)
+
+
+class ClassificationCacheTests(SimpleTestCase):
+    """
+    Classifications cached in memory and, optionally, on disk.
+    """
+
+    def setUp(self):
+        self.now = 1000.0
+        patcher = patch('app.src.services.classification_cache.time',
+                        SimpleNamespace(time=lambda: self.now))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def cache(self, **kwargs):
+        cache = ClassificationCache(**{'max_entries': 8, 'ttl': 0,
+                                       'db_path': '', **kwargs})
+        if cache._db is not None:
+            self.addCleanup(cache._db.close)
+        return cache
+
+    def test_least_recently_used_entry_is_evicted(self):
+        cache = self.cache(max_entries=2)
+        cache.put('a', CacheEntry('{"fruit": "Kiwi"}'))
+        cache.put('b', CacheEntry('{"fruit": "Banana"}'))
+        cache.get('a')
+
+        cache.put('c', CacheEntry('{"fruit": "Maca"}'))
+
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a').agent_output, '{"fruit": "Kiwi"}')
+        self.assertIsNotNone(cache.get('c'))
+        self.assertEqual(cache.stats()['entries'], 2)
+
+    def test_entries_expire_after_the_ttl(self):
+        cache = self.cache(ttl=60)
+        cache.put('a', CacheEntry('{"fruit": "Kiwi"}'))
+
+        self.now += 60
+        self.assertIsNotNone(cache.get('a'))
+        self.now += 1
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.stats()['entries'], 0)
+
+    def test_disk_tier_survives_a_restart(self):
+        with tempfile.TemporaryDirectory() as directory:
+            db_path = os.path.join(directory, 'cache.sqlite3')
+            self.cache(ttl=60, db_path=db_path).put(
+                'a', CacheEntry('{"fruit": "Kiwi"}', '{"PLU": 4030}'))
+
+            restarted = self.cache(ttl=60, db_path=db_path)
+            entry = restarted.get('a')
+            self.assertEqual(entry.refined_output, '{"PLU": 4030}')
+            self.assertEqual(restarted.stats()['disk_hits'], 1)
+
+            # Expired on disk too
+            self.now += 61
+            self.assertIsNone(self.cache(ttl=60, db_path=db_path).get('a'))
+
+    def test_new_picklist_or_prompt_misses_the_cache(self):
+        client = FakeGenAIClient(latency=0)
+        cache = self.cache()
+        products = PicklistRepository().load()
+
+        def scan(prompt='Name the fruit.', version='v1'):
+            ai_service = AIService(client=client)
+            ai_service.prompt = prompt
+            return ScanService(ai_service, MatchingService(products),
+                               cache=cache,
+                               picklist_version=version).scan(b'apple')
+
+        self.assertFalse(scan().from_cache)
+        self.assertTrue(scan().from_cache)
+        self.assertFalse(scan(version='v2').from_cache)
+        self.assertFalse(scan(prompt='Name the fruit in Portuguese.')
+                         .from_cache)
+        self.assertTrue(scan(version='v2').from_cache)
+
+
+class ServiceContainerTests(SimpleTestCase):
+    """
+    Shared services reloaded when the picklist or the prompt file changes.
+    """
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.picklist_path = os.path.join(directory.name, 'picklist.json')
+        self.prompt_path = os.path.join(directory.name, 'prompt.txt')
+        self.write_picklist([Product('Kiwi', 4030, 3.99)])
+        self.write_prompt('Name the fruit.')
+
+        self.now = 0.0
+        for patcher in (
+                patch('app.src.services.service_container.time',
+                      SimpleNamespace(monotonic=lambda: self.now)),
+                patch.object(app_settings, 'HISTORY_ENABLED', False),
+                patch.object(app_settings, 'PICKLIST_BACKEND', 'json')):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.container = ServiceContainer(self.picklist_path,
+                                          self.prompt_path,
+                                          check_interval=1.0)
+
+    def write_picklist(self, products):
+        with open(self.picklist_path, 'w') as f:
+            json.dump([p.to_dict() for p in products], f)
+
+    def write_prompt(self, prompt):
+        with open(self.prompt_path, 'w') as f:
+            f.write(prompt)
+
+    def test_changed_files_are_reloaded_once_per_interval(self):
+        first = self.container.build_scan_service()
+        self.write_picklist([Product('Kiwi', 4030, 3.99),
+                             Product('Kiwi Gold', 4031, 4.99)])
+        self.write_prompt('Name the fruit, in Portuguese.')
+        load = patch.object(self.container._picklist_repo, 'load',
+                            wraps=self.container._picklist_repo.load)
+        stamp = patch.object(self.container, '_stamp',
+                             wraps=self.container._stamp)
+        with load as load, stamp as stamp:
+            # Within the interval the files are not even looked at
+            self.now = 0.9
+            throttled = [self.container.build_scan_service()
+                         for _ in range(3)]
+            self.assertEqual(stamp.call_count, 0)
+            # The AI service is shared: its prompt is replaced in place
+            self.assertEqual(throttled[0].ai_service.prompt_template,
+                             'Name the fruit.')
+
+            self.now = 1.0
+            reloaded = [self.container.build_scan_service()
+                        for _ in range(3)]
+
+        self.assertEqual(load.call_count, 1)
+        self.assertEqual(stamp.call_count, 2)
+        for scan_service in throttled:
+            self.assertIs(scan_service.matching_service,
+                          first.matching_service)
+        new_matching = reloaded[0].matching_service
+        self.assertIsNot(new_matching, first.matching_service)
+        self.assertEqual(len(new_matching.picklist), 2)
+        for scan_service in reloaded:
+            self.assertIs(scan_service.matching_service, new_matching)
+            self.assertEqual(scan_service.picklist_version,
+                             new_matching.picklist.fingerprint)
+            self.assertEqual(scan_service.ai_service.prompt_template,
+                             'Name the fruit, in Portuguese.')
+
+    def test_unchanged_files_keep_the_services(self):
+        first = self.container.build_scan_service()
+
+        self.now = 5.0
+        second = self.container.build_scan_service()
+
+        self.assertIs(second.matching_service, first.matching_service)
+        self.assertEqual(second.picklist_version, first.picklist_version)
+
+
+class BatchServiceTests(SimpleTestCase):
+    """
+    Backlogs classified into a JSONL file, resumable after a crash.
+    """
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.output_path = os.path.join(directory.name, 'results.jsonl')
+        for i in range(8):
+            with open(os.path.join(directory.name, f'{i}.jpg'), 'wb') as f:
+                f.write(str(i).encode())
+        self.paths = BatchService.collect(directory.name)
+        self.scanned = []
+        self.crash = True
+
+    def scan(self, image_bytes):
+        self.scanned.append(int(image_bytes))
+        if image_bytes == b'2':
+            return ScanResult(error='Scan deadline exceeded')
+        if image_bytes == b'5' and self.crash:
+            self.crash = False
+            raise KeyboardInterrupt
+        return ScanResult(agent_output='{"fruit": "Kiwi"}',
+                          matches=[Product('Kiwi', 4030, 3.99)])
+
+    def batch(self):
+        scan_service = SimpleNamespace(scan=self.scan)
+        return BatchService(lambda: scan_service, self.output_path,
+                            workers=1)
+
+    def test_interrupted_batch_resumes_where_it_stopped(self):
+        with self.assertRaises(KeyboardInterrupt):
+            self.batch().run(self.paths)
+        with open(self.output_path, 'a') as f:
+            # A record the crash cut short
+            f.write('{"path": "' + self.paths[6])
+        done = {int(os.path.basename(path)[0])
+                for path in self.batch().completed()}
+        self.assertTrue(done)
+        self.assertNotIn(2, done)
+
+        self.scanned.clear()
+        report = self.batch().run(self.paths)
+
+        # Only the failed image and those never written are scanned again
+        self.assertEqual(sorted(self.scanned),
+                         sorted(set(range(8)) - done))
+        self.assertEqual(report.skipped, len(done))
+        self.assertEqual(report.failed, 1)
+        self.assertEqual(self.batch().completed(),
+                         set(self.paths) - {self.paths[2]})
+
+
+class FileServiceTests(SimpleTestCase):
+    """
+    Watched directory emitting every new image once fully written.
+    """
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        self.write('old.jpg', b'already here')
+
+    def write(self, name, data, mode='wb'):
+        with open(os.path.join(self.directory, name), mode) as f:
+            f.write(data)
+        return os.path.abspath(os.path.join(self.directory, name))
+
+    def watch(self, service, clock):
+        watcher = service.watch()
+        self.addCleanup(watcher.close)
+        patcher = patch('app.src.services.file_service.time', clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return watcher
+
+    def test_polled_files_are_emitted_once_settled(self):
+        service = FileService(self.directory, backend='poll',
+                              poll_interval=0.1, settle_time=0.25)
+        clock = PollClock(
+            lambda: self.write('apple.jpg', b'first half'),
+            lambda: (self.write('apple.jpg', b', second half', 'ab'),
+                     self.write('.upload.tmp', b'partial')),
+            None, None, None, None)
+        watcher = self.watch(service, clock)
+
+        self.assertEqual(next(watcher),
+                         os.path.join(os.path.abspath(self.directory),
+                                      'apple.jpg'))
+        # Last changed at 0.2 s, then unchanged for the settle time
+        self.assertAlmostEqual(clock.now, 0.5)
+
+    def test_falls_back_to_polling_without_inotify(self):
+        with patch('app.src.services.file_service._load_inotify',
+                   return_value=None):
+            service = FileService(self.directory, backend='inotify',
+                                  poll_interval=0.1, settle_time=0)
+        self.assertEqual(service.backend, 'poll')
+
+        clock = PollClock(lambda: self.write('kiwi.jpg', b'kiwi'))
+        self.assertTrue(next(self.watch(service, clock))
+                        .endswith('kiwi.jpg'))
+
+    def test_inotify_errors_fall_back_to_polling(self):
+        service = FileService(self.directory, backend='poll',
+                              poll_interval=0.1, settle_time=0)
+        service.backend = 'inotify'
+        clock = PollClock(lambda: self.write('pear.jpg', b'pear'))
+
+        with patch.object(service, '_watch_inotify',
+                          side_effect=OSError(24, 'Too many open files')):
+            self.assertTrue(next(self.watch(service, clock))
+                            .endswith('pear.jpg'))
+        self.assertEqual(service.backend, 'poll')
+
+    def test_overflow_rescans_the_directory(self):
+        read_fd, write_fd = os.pipe()
+        self.addCleanup(os.close, write_fd)
+
+        def event(mask, name=b''):
+            name = name.ljust(16, b'\0') if name else b''
+            return EVENT_HEADER.pack(1, mask, 0, len(name)) + name
+
+        def add_watch(fd, path, mask):
+            # Being written once the watch started, with its events lost
+            self.write('lost.jpg', b'first half')
+            return 1
+
+        libc = SimpleNamespace(inotify_init1=lambda flags: read_fd,
+                               inotify_add_watch=add_watch)
+        with patch('app.src.services.file_service._load_inotify',
+                   return_value=libc):
+            service = FileService(self.directory, backend='inotify',
+                                  poll_interval=0.1, settle_time=0.25)
+        clock = PollClock(
+            lambda: self.write('lost.jpg', b', second half', 'ab'),
+            None, None, None, None)
+        watcher = self.watch(service, clock)
+        # Ends a watcher that would otherwise wait forever
+        timeout = threading.Timer(5, os.write, (
+            write_fd, event(IN_CLOSE_WRITE, b'timed-out.jpg')))
+        timeout.start()
+        self.addCleanup(timeout.cancel)
+        os.write(write_fd, event(IN_Q_OVERFLOW))
+
+        path = next(watcher)
+        self.assertTrue(path.endswith('lost.jpg'))
+        # Last changed at 0.1 s, then unchanged for the settle time
+        self.assertAlmostEqual(clock.now, 0.4)
+        self.assertEqual(os.path.getsize(path),
+                         len(b'first half, second half'))
+
+        self.write('next.jpg', b'next')
+        os.write(write_fd, event(IN_CLOSE_WRITE, b'lost.jpg')
+                 + event(IN_CLOSE_WRITE, b'next.jpg'))
+        # The late event of the rescanned file is not emitted again
+        self.assertTrue(next(watcher).endswith('next.jpg'))
+
+
+class LocalClassifierTests(SimpleTestCase):
+    """
+    CPU pre-classifier answering confident scans without the model.
+    """
+
+    colours = {15982: (230, 200, 40), 51146: (200, 30, 40)}
+
+    def setUp(self):
+        rng = random.Random(7)
+        self.classifier = LocalClassifier.train(
+            [(plu, fruit_photo(colour, rng))
+             for plu, colour in self.colours.items() for _ in range(8)],
+            threshold=0.9)
+        self.banana = fruit_photo(self.colours[15982], rng)
+        self.client = FakeGenAIClient(latency=0)
+        self.scan_service = ScanService(
+            AIService(client=self.client),
+            MatchingService(PicklistRepository().load()),
+            local_classifier=self.classifier)
+
+    def test_confident_scans_skip_the_model(self):
+        result = self.scan_service.scan(self.banana)
+
+        self.assertTrue(result.classified_locally)
+        self.assertEqual(result.best_match()['PLU'], 15982)
+        self.assertIn('local', result.timings)
+        self.assertEqual(self.client.models.calls, 0)
+
+    def test_unfamiliar_images_go_to_the_model(self):
+        blue = fruit_photo((40, 60, 220), random.Random(1))
+        self.client.models.script = ['{"fruit": "Kiwi"}']
+
+        result = self.scan_service.scan(blue)
+
+        self.assertFalse(result.classified_locally)
+        self.assertEqual([p.plu for p in result.matches], [50719])
+        self.assertEqual(self.client.models.calls, 1)
+        self.assertEqual(self.classifier.stats()['deferred'], 1)
+
+    def test_model_file_round_trip_and_evaluation(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'classifier.json')
+            self.classifier.save(path)
+            loaded = LocalClassifier.from_file(path)
+
+        self.assertEqual(loaded.labels, self.classifier.labels)
+        self.assertAlmostEqual(loaded.max_distance,
+                               self.classifier.max_distance, places=5)
+        rng = random.Random(11)
+        held_out = [(plu, fruit_photo(colour, rng))
+                    for plu, colour in self.colours.items()
+                    for _ in range(3)]
+        report = loaded.evaluate(held_out, [0.5, 1.0])
+        self.assertEqual(report[0]['accuracy'], 1.0)
+        self.assertGreaterEqual(report[0]['offload_rate'],
+                                report[1]['offload_rate'])
+
+    def test_trains_on_confirmed_answers_only(self):
+        apples = MatchingService(PicklistRepository().load()).find_matches(
+            '{"fruit": "Maca"}')
+        gala = '{"fruit": "Maca Gala", "PLU": 51146}'
+        results = {
+            'refined': ScanResult(matches=apples, refined_output=gala),
+            'single': ScanResult(matches=apples[:1]),
+            'failed_refine': ScanResult(matches=apples),
+            'disambiguated': ScanResult(matches=apples, refined_output=gala,
+                                        resolved_locally=True),
+            'cached': ScanResult(matches=apples, refined_output=gala,
+                                 from_cache=True),
+        }
+        self.assertEqual([name for name, r in results.items()
+                          if r.confirmed], ['refined', 'single'])
+
+        with tempfile.TemporaryDirectory() as directory:
+            jsonl = os.path.join(directory, 'results.jsonl')
+            with open(jsonl, 'w') as f:
+                for name, result in results.items():
+                    path = os.path.join(directory, f'{name}.jpg')
+                    with open(path, 'wb') as image:
+                        image.write(self.banana)
+                    f.write(json.dumps({
+                        'path': path, 'PLU': result.best_match()['PLU'],
+                        'confirmed': result.confirmed}) + '\n')
+
+            examples = list(list_examples(jsonl))
+
+        self.assertEqual([os.path.basename(path)
+                          for _, _, path in examples],
+                         ['refined.jpg', 'single.jpg'])
+
+
+class SingleFlightTests(SimpleTestCase):
+    """
+    Concurrent scans of the same image share one classification.
+    """
+
+    concurrency = 8
+
+    def setUp(self):
+        self.client = FakeGenAIClient(latency=0.1)
+        self.products = PicklistRepository().load()
+
+    def scan_service(self, single_flight, cache=None):
+        return ScanService(
+            AIService(client=self.client), MatchingService(self.products),
+            cache=cache, single_flight=single_flight,
+            retry_policy=RetryPolicy(max_attempts=1))
+
+    def test_concurrent_scans_make_one_upstream_call(self):
+        scan_service = self.scan_service(SingleFlight(lock_dir=''))
+
+        with ThreadPoolExecutor(self.concurrency) as executor:
+            results = list(executor.map(scan_service.scan,
+                                        [b'image'] * self.concurrency))
+
+        # One analyze and one refine call for all the scans
+        self.assertEqual(self.client.models.calls, 2)
+        self.assertEqual(sum(r.coalesced for r in results),
+                         self.concurrency - 1)
+        self.assertEqual({r.refined_output for r in results},
+                         {results[0].refined_output})
+
+    async def test_concurrent_async_scans_make_one_upstream_call(self):
+        scan_service = self.scan_service(SingleFlight(lock_dir=''))
+
+        results = await asyncio.gather(*(
+            scan_service.scan_async(b'image')
+            for _ in range(self.concurrency)))
+
+        self.assertEqual(self.client.aio.models.calls, 2)
+        self.assertTrue(all(r.error is None for r in results))
+        self.assertEqual(scan_service.single_flight.stats()['followers'],
+                         self.concurrency - 1)
+
+    def test_failures_are_shared_and_not_remembered(self):
+        scan_service = self.scan_service(SingleFlight(lock_dir=''))
+        self.client.models.script = [bad_request()]
+
+        with ThreadPoolExecutor(self.concurrency) as executor:
+            results = list(executor.map(scan_service.scan,
+                                        [b'image'] * self.concurrency))
+
+        self.assertEqual(self.client.models.calls, 1)
+        self.assertTrue(all('400' in r.error for r in results))
+        self.assertIsNone(scan_service.scan(b'image').error)
+
+    async def test_cancelled_leader_hands_over_to_a_follower(self):
+        scan_service = self.scan_service(SingleFlight(lock_dir=''))
+        leader = asyncio.create_task(scan_service.scan_async(b'image'))
+        await asyncio.sleep(0.02)
+        follower = asyncio.create_task(scan_service.scan_async(b'image'))
+        await asyncio.sleep(0.02)
+        self.assertEqual(scan_service.single_flight.stats()['followers'], 1)
+
+        leader.cancel()
+        result = await follower
+
+        self.assertTrue(leader.cancelled())
+        self.assertIsNone(result.error)
+        self.assertFalse(result.coalesced)
+        self.assertEqual(scan_service.single_flight.stats()['in_flight'], 0)
+
+    def test_worker_processes_share_through_lock_and_cache(self):
+        with tempfile.TemporaryDirectory() as directory:
+            db_path = os.path.join(directory, 'cache.sqlite3')
+            # One coalescer and cache per simulated worker process
+            workers = [self.scan_service(SingleFlight(lock_dir=directory),
+                                         ClassificationCache(db_path=db_path))
+                       for _ in range(2)]
+
+            with ThreadPoolExecutor(2) as executor:
+                results = list(executor.map(
+                    lambda worker: worker.scan(b'image'), workers))
+
+        self.assertEqual(self.client.models.calls, 2)
+        self.assertEqual(sorted(r.from_cache for r in results),
+                         [False, True])
+
+
+class MicroBatchTests(SimpleTestCase):
+    """
+    Analyze calls of concurrent scans grouped into multi-image calls.
+    """
+
+    scans = 6
+
+    def setUp(self):
+        self.client = FakeGenAIClient(latency=0.02, responses={
+            'analyze': ['{"fruit": "Kiwi"}'],
+        })
+        ai_service = AIService(client=self.client)
+        self.batcher = MicroBatcher(ai_service, window=0.5,
+                                    max_size=self.scans)
+        self.addCleanup(self.batcher.close)
+        self.scan_service = ScanService(
+            ai_service, MatchingService(PicklistRepository().load()),
+            micro_batcher=self.batcher)
+
+    def scan_concurrently(self):
+        with ThreadPoolExecutor(self.scans) as executor:
+            return list(executor.map(
+                self.scan_service.scan,
+                [f'image {i}'.encode() for i in range(self.scans)]))
+
+    def test_concurrent_scans_share_one_call(self):
+        results = self.scan_concurrently()
+
+        self.assertEqual(self.client.models.calls, 1)
+        self.assertTrue(all(r.matches[0].plu == 50719 for r in results))
+        self.assertEqual(self.batcher.stats()['mean_batch_size'],
+                         self.scans)
+
+    async def test_async_scans_join_the_batch(self):
+        results = await asyncio.gather(*(
+            self.scan_service.scan_async(f'image {i}'.encode())
+            for i in range(self.scans)))
+
+        self.assertEqual(self.client.models.calls, 1)
+        self.assertTrue(all(r.error is None for r in results))
+
+    def test_unparsable_answer_falls_back_to_one_call_per_image(self):
+        self.client.models.script = ['I see fruit']
+
+        results = self.scan_concurrently()
+
+        self.assertEqual(self.client.models.calls, 1 + self.scans)
+        self.assertTrue(all(r.matches[0].plu == 50719 for r in results))
+        self.assertEqual(self.batcher.stats()['fallbacks'], self.scans)
+
+    def test_fallbacks_are_sent_together(self):
+        self.client.models.latency = 0.2
+        self.client.models.script = ['I see fruit']
+
+        start = time.monotonic()
+        results = self.scan_concurrently()
+        elapsed = time.monotonic() - start
+
+        self.assertTrue(all(r.error is None for r in results))
+        # The batch call, then one round of fallbacks: not one per image
+        self.assertLess(elapsed, 0.2 * 2 + 0.3)
+
+    def test_split_batch_answer(self):
+        answer = ('```json\n[{"index": 1, "fruit": "Kiwi"}, '
+                  '{"index": 0, "fruit": "Banana"}, '
+                  '{"index": 7, "fruit": "Uva"}]\n```')
+
+        self.assertEqual(split_batch_answer(answer, 3),
+                         ['{"fruit": "Banana"}', '{"fruit": "Kiwi"}', None])
+        self.assertEqual(split_batch_answer('{"fruit": "Kiwi"}', 2),
+                         [None, None])
+
+
+class EchoModels(FakeModels):
+    """
+    Fake backend whose refine answer is the PLU written in the image, so a
+    scan answered with another scan's image is detected.
+    """
+
+    def _answer(self, contents):
+        self.calls += 1
+        image = contents[0].inline_data.data.decode()
+        if "Re-examine" in contents[-1]:
+            return SimpleNamespace(text=json.dumps({"PLU": int(image)}))
+        return SimpleNamespace(text='{"fruit": "Maca"}')
+
+    def generate_content(self, model, contents, config=None):
+        time.sleep(random.uniform(0, 0.01))
+        return self._answer(contents)
+
+
+class AsyncEchoModels(EchoModels):
+
+    async def generate_content(self, model, contents, config=None):
+        await asyncio.sleep(random.uniform(0, 0.01))
+        return self._answer(contents)
+
+
+class RecordingAnalyzer:
+    """
+    Analyzer keeping the sessions of the scans it saw.
+    """
+
+    def __init__(self, ai_service):
+        self.ai_service = ai_service
+        self.sessions = []
+
+    def analyze_image(self, session):
+        self.sessions.append(session)
+        return self.ai_service.analyze_image(session)
+
+    async def analyze_image_async(self, session):
+        self.sessions.append(session)
+        return await self.ai_service.analyze_image_async(session)
+
+
+class InferenceSessionTests(SimpleTestCase):
+    """
+    Concurrent scans sharing one AIService, each with its own session.
+    """
+
+    # The three apples matching "Maca"; every scan needs a refine call
+    plus = [51146, 50716, 51201]
+
+    def setUp(self):
+        client = SimpleNamespace(models=EchoModels(latency=0),
+                                 aio=SimpleNamespace(
+                                     models=AsyncEchoModels(latency=0)))
+        self.ai_service = AIService(client=client)
+        self.analyzer = RecordingAnalyzer(self.ai_service)
+        self.scan_service = ScanService(
+            self.ai_service, MatchingService(PicklistRepository().load()),
+            micro_batcher=self.analyzer)
+        self.images = [str(self.plus[i % 3]).encode() for i in range(60)]
+
+    def assert_own_answers(self, results):
+        for image, result in zip(self.images, results):
+            self.assertEqual(result.best_match()['PLU'], int(image))
+
+    def test_threaded_scans_refine_their_own_image(self):
+        with ThreadPoolExecutor(16) as executor:
+            results = list(executor.map(self.scan_service.scan, self.images))
+
+        self.assert_own_answers(results)
+
+    async def test_async_scans_refine_their_own_image(self):
+        results = await asyncio.gather(*(
+            self.scan_service.scan_async(image) for image in self.images))
+
+        self.assert_own_answers(results)
+
+    def test_image_released_when_scan_completes(self):
+        result = self.scan_service.scan(b'50716')
+
+        session, = self.analyzer.sessions
+        self.assertTrue(session.closed)
+        self.assertEqual(session.refined_output, result.refined_output)
+        refine = self.ai_service.refine_analysis(session, 'Re-examine')
+        self.assertIn('closed', refine.error)
+
+    def test_image_released_when_scan_fails(self):
+        def reject(model, contents, config=None):
+            raise bad_request()
+        self.ai_service.client.models.generate_content = reject
+
+        result = self.scan_service.scan(b'51146')
+
+        self.assertIsNotNone(result.error)
+        session, = self.analyzer.sessions
+        self.assertTrue(session.closed)
+        self.assertIsNone(session.agent_output)
+
+    def test_session_context_manager(self):
+        with InferenceSession(b'51146') as session:
+            self.assertFalse(session.closed)
+
+        self.assertTrue(session.closed)
+
+
+class RateLimiterTests(SimpleTestCase):
+    """
+    Token bucket shared through SQLite, with priority classes.
+    """
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.db_path = os.path.join(directory.name, 'rate_limit.sqlite3')
+
+    def limiter(self, rate, burst, **options):
+        return RateLimiter(self.db_path, rate=rate, burst=burst,
+                           max_waits={INTERACTIVE: 2, BATCH: 2}, **options)
+
+    def test_burst_then_rate(self):
+        limiter = self.limiter(rate=20, burst=2)
+
+        start = time.monotonic()
+        for _ in range(4):
+            self.assertTrue(limiter.acquire())
+
+        # Two tokens of burst, then one every 50 ms
+        self.assertGreaterEqual(time.monotonic() - start, 0.09)
+
+    async def test_async_wait_does_not_block_the_event_loop(self):
+        limiter = self.limiter(rate=10, burst=5)
+        # Another process holding the write lock
+        other_process = sqlite3.connect(self.db_path, isolation_level=None)
+        other_process.execute("BEGIN IMMEDIATE")
+        start = time.monotonic()
+
+        async def tick():
+            for _ in range(20):
+                await asyncio.sleep(0.01)
+            other_process.execute("COMMIT")
+            return time.monotonic() - start
+
+        granted, ticked = await asyncio.gather(limiter.acquire_async(),
+                                               tick())
+        other_process.close()
+
+        self.assertTrue(granted)
+        # The loop ran on while the limiter waited for the lock
+        self.assertLess(ticked, 1)
+
+    def test_processes_share_the_bucket(self):
+        first = self.limiter(rate=0.01, burst=2)
+        other_process = self.limiter(rate=0.01, burst=2)
+
+        self.assertTrue(first.acquire())
+        self.assertTrue(other_process.acquire())
+        self.assertFalse(first.acquire(max_wait=0.05))
+
+    def test_interactive_overtakes_queued_batch_work(self):
+        limiter = self.limiter(rate=10, burst=1)
+        limiter.acquire()
+        order = []
+
+        def scan(priority, delay):
+            time.sleep(delay)
+            limiter.acquire(priority)
+            order.append(priority)
+
+        with ThreadPoolExecutor(4) as executor:
+            list(executor.map(scan, [BATCH, BATCH, BATCH, INTERACTIVE],
+                              [0, 0, 0, 0.02]))
+
+        # The token freed 100 ms later goes to the last one to arrive
+        self.assertEqual(order, [INTERACTIVE, BATCH, BATCH, BATCH])
+
+    def test_sheds_after_the_maximum_wait(self):
+        limiter = self.limiter(rate=0.01, burst=1)
+        limiter.acquire()
+
+        self.assertFalse(limiter.acquire(max_wait=0.05))
+
+        stats = limiter.stats()
+        self.assertEqual(stats['shed'][INTERACTIVE], 1)
+        self.assertEqual(stats['queue_depth'][INTERACTIVE], 0)
+
+    def test_sheds_at_once_when_the_queue_is_full(self):
+        limiter = self.limiter(rate=0.01, burst=1, max_queue=0)
+        limiter.acquire()
+
+        start = time.monotonic()
+        self.assertFalse(limiter.acquire(max_wait=1))
+        self.assertLess(time.monotonic() - start, 0.5)
+
+    def test_queue_depth_is_exposed(self):
+        limiter = self.limiter(rate=0.01, burst=1)
+        limiter.acquire()
+
+        async def wait_then_look():
+            waiting = asyncio.ensure_future(limiter.acquire_async(BATCH, 1))
+            await asyncio.sleep(0.05)
+            depth = limiter.stats()['queue_depth']
+            waiting.cancel()
+            return depth
+
+        depth = asyncio.run(wait_then_look())
+        self.assertEqual(depth, {INTERACTIVE: 0, BATCH: 1})
+        self.assertEqual(limiter.stats()['queue_depth'][BATCH], 0)
+
+    def test_shed_call_does_not_reach_the_model(self):
+        limiter = self.limiter(rate=0.01, burst=1,
+                               metrics=MetricsRegistry())
+        limiter.acquire()
+        limiter.max_waits = {INTERACTIVE: 0.05, BATCH: 0.05}
+        client = FakeGenAIClient(latency=0)
+        ai_service = AIService(client=client, rate_limiter=limiter)
+
+        result = ai_service.analyze_image(InferenceSession(b'kiwi'))
+
+        self.assertIn('Rate limited', result.error)
+        self.assertFalse(result.retryable)
+        self.assertEqual(client.models.calls, 0)
+        self.assertIn('rate_limit_shed_total{priority="interactive"} 1',
+                      limiter.metrics.render())
+
+
+class ScriptedLatencyModels(FakeModels):
+    """
+    Fake backend whose calls take the scripted durations, in order.
+    """
+
+    def __init__(self, delays):
+        super().__init__(latency=0)
+        self.delays = list(delays)
+        self._lock = threading.Lock()
+
+    def generate_content(self, model, contents, config=None):
+        with self._lock:
+            delay = self.delays.pop(0) if self.delays else 0
+        time.sleep(delay)
+        with self._lock:
+            return self._answer(contents)
+
+
+class HedgingTests(SimpleTestCase):
+    """
+    Backup analyze calls against a backend with a heavy latency tail.
+    """
+
+    @staticmethod
+    def heavy_tailed_client():
+        # Median 5 ms, but 1% of the calls take more than 160 ms
+        return FakeGenAIClient(latency=0.005, distribution='lognormal',
+                               sigma=1.5, seed=7)
+
+    @staticmethod
+    async def p99(ai_service, rounds=4, concurrency=100):
+        """
+        p99 latency in ms of analyze calls, after one warm-up round.
+        """
+        latencies = []
+
+        async def analyze():
+            start = time.perf_counter()
+            result = await ai_service.analyze_image_async(
+                InferenceSession(b'kiwi'))
+            latencies.append((time.perf_counter() - start) * 1000)
+            return result
+
+        for _ in range(rounds + 1):
+            results = await asyncio.gather(*(analyze()
+                                             for _ in range(concurrency)))
+            assert all(r.ok for r in results)
+        measured = sorted(latencies[concurrency:])
+        return measured[int(len(measured) * 0.99) - 1]
+
+    async def test_hedging_cuts_the_p99(self):
+        hedging = HedgingPolicy(percentile=90, budget=0.15, min_samples=50,
+                                initial_delay=1.0, min_delay=0.001)
+        baseline = await self.p99(AIService(
+            client=self.heavy_tailed_client()))
+        hedged = await self.p99(AIService(
+            client=self.heavy_tailed_client(), hedging=hedging))
+
+        self.assertLess(hedged, baseline * 0.6)
+        stats = hedging.stats()
+        self.assertLessEqual(stats['hedge_rate'], 0.15)
+        self.assertGreater(stats['backup_wins'], 0)
+
+    def test_slow_call_loses_to_its_backup(self):
+        client = SimpleNamespace(models=ScriptedLatencyModels([1.0, 0.01]))
+        hedging = HedgingPolicy(budget=1.0, initial_delay=0.05,
+                                metrics=MetricsRegistry())
+        self.addCleanup(hedging.close)
+        ai_service = AIService(client=client, hedging=hedging)
+
+        start = time.monotonic()
+        result = ai_service.analyze_image(InferenceSession(b'kiwi'))
+
+        self.assertTrue(result.ok)
+        self.assertLess(time.monotonic() - start, 0.5)
+        self.assertEqual(hedging.backup_wins, 1)
+        self.assertIn('model_hedges_total{winner="backup"} 1',
+                      hedging.metrics.render())
+
+    def test_budget_caps_the_backups(self):
+        client = SimpleNamespace(models=ScriptedLatencyModels([0.01] * 40))
+        hedging = HedgingPolicy(budget=0.1, initial_delay=0.001,
+                                min_delay=0.001)
+        self.addCleanup(hedging.close)
+        ai_service = AIService(client=client, hedging=hedging)
+
+        for _ in range(20):
+            ai_service.analyze_image(InferenceSession(b'kiwi'))
+
+        # One backup per ten calls
+        self.assertEqual(hedging.hedges, 2)
+
+    def test_delay_follows_the_recent_latencies(self):
+        hedging = HedgingPolicy(percentile=90, window=10, min_samples=10,
+                                initial_delay=2.0, min_delay=0.001)
+        self.assertEqual(hedging.delay(), 2.0)
+
+        for latency in [0.01] * 15 + [1.0]:
+            hedging._record(latency)
+        self.assertEqual(hedging.delay(), 0.01)
+        for latency in [0.5] * 16:
+            hedging._record(latency)
+        self.assertEqual(hedging.delay(), 0.5)
+
+    def test_saturated_pool_gets_no_backup(self):
+        hedging = HedgingPolicy(budget=1.0, initial_delay=0.01, workers=1)
+        self.addCleanup(hedging.close)
+        release = threading.Event()
+        self.addCleanup(release.set)
+        calls = []
+
+        def call():
+            calls.append(time.monotonic())
+            return 'kiwi'
+
+        with ThreadPoolExecutor(2) as scans:
+            busy = scans.submit(hedging.run, lambda: release.wait(5))
+            time.sleep(0.02)
+            queued = scans.submit(hedging.run, call)
+            # Far past the delay, but the call is still queued
+            time.sleep(0.1)
+            self.assertEqual(calls, [])
+            release.set()
+
+            self.assertTrue(busy.result())
+            self.assertEqual(queued.result(), 'kiwi')
+        self.assertEqual(len(calls), 1)
+        # The busy call had no free worker for a backup either
+        self.assertEqual(hedging.hedges, 0)
+
+
+class StreamedResultTests(SimpleTestCase):
+    """
+    The classify page streamed while the scan progresses.
+    """
+
+    def setUp(self):
+        # Default fake answers: "Maca" (three varieties), then Maca Gala
+        self.client_models = FakeGenAIClient(latency=0.05)
+        scan_service = ScanService(
+            AIService(client=self.client_models),
+            MatchingService(PicklistRepository().load()))
+        self.scan_service = scan_service
+        self.container = SimpleNamespace(
+            build_scan_service=lambda: scan_service,
+            metrics=MetricsRegistry(), history=None)
+        patcher = patch('scale_ui.views.get_container',
+                        return_value=self.container)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def upload(self):
+        return {'image': SimpleUploadedFile('apple.png', b'apple')}
+
+    async def test_candidates_arrive_before_the_refined_product(self):
+        response = await self.async_client.post('/classify/', self.upload())
+        self.assertTrue(response.streaming)
+
+        models = self.client_models.aio.models
+        chunks = []
+        async for chunk in response.streaming_content:
+            chunks.append((chunk.decode(), models.calls))
+
+        page, calls = chunks[0]
+        self.assertIn('Identifying product...', page)
+        self.assertEqual(calls, 0)
+        analysis, calls = chunks[1]
+        self.assertIn('scanEvent("analysis"', analysis)
+        self.assertIn('Maca Golden', analysis)
+        # Sent before the refine call was made
+        self.assertEqual(calls, 1)
+        result, calls = chunks[2]
+        self.assertIn('scanEvent("result"', result)
+        self.assertIn('"PLU": 51146', result)
+        self.assertEqual(calls, 2)
+        self.assertIn('</html>', chunks[-1][0])
+
+    async def test_scan_events_cannot_close_the_script(self):
+        self.client_models.aio.models.script = [
+            '{"fruit": "</script><b>Maca"}']
+
+        response = await self.async_client.post('/classify/', self.upload())
+        body = ''.join([chunk.decode() async for chunk
+                        in response.streaming_content])
+
+        self.assertNotIn('</script><b>', body)
+        self.assertIn('\\u003C/script\\u003E', body)
+
+    async def test_setup_and_matching_run_off_the_event_loop(self):
+        threads = []
+
+        def record(fn):
+            def recorded(*args, **kwargs):
+                threads.append(threading.get_ident())
+                return fn(*args, **kwargs)
+            return recorded
+
+        container = self.container
+        container.build_scan_service = record(container.build_scan_service)
+        matching_service = self.scan_service.matching_service
+        matching_service.find_matches = record(matching_service.find_matches)
+        with patch('scale_ui.views.get_container',
+                   record(lambda: container)):
+            response = await self.async_client.post('/classify/',
+                                                    self.upload())
+            body = ''.join([chunk.decode() async for chunk
+                            in response.streaming_content])
+
+        self.assertIn('"PLU": 51146', body)
+        self.assertEqual(len(threads), 3)
+        self.assertNotIn(threading.get_ident(), threads)
+
+    async def test_single_response_when_streaming_is_off(self):
+        with patch.object(app_settings, 'STREAM_RESULTS_ENABLED', False):
+            response = await self.async_client.post('/classify/',
+                                                    self.upload())
+
+        self.assertFalse(response.streaming)
+        self.assertContains(response, 'Maca Gala')
+        self.assertIn('Server-Timing', response)
+
+
+class HistoryWriterTests(SimpleTestCase):
+    """
+    Scan history written behind the response.
+    """
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.db_path = os.path.join(directory.name, 'db.sqlite3')
+
+    def rows(self, query):
+        connection = sqlite3.connect(self.db_path)
+        try:
+            return connection.execute(query).fetchall()
+        finally:
+            connection.close()
+
+    @staticmethod
+    def wait_until_taken(writer):
+        """
+        Waits for the writer thread to take what is queued.
+        """
+        deadline = time.monotonic() + 2
+        while writer.stats()['queued'] and time.monotonic() < deadline:
+            time.sleep(0.001)
+
+    def test_scans_are_written_in_batches(self):
+        writer = HistoryWriter(self.db_path, batch_size=50)
+        matches = [Product('Maca Gala', 51146, 0.85),
+                   Product('Maca Golden', 50716, 0.9)]
+        result = ScanResult(
+            agent_output='{"fruit": "Maca"}', matches=matches,
+            refined_output='{"PLU": 50716}', timings={'analyze': 812.5},
+            image_digest=ClassificationCache.digest(b'image'))
+
+        for i in range(120):
+            self.assertTrue(writer.record(result, 'web'))
+        writer.close()
+
+        self.assertEqual(self.rows('SELECT COUNT(*) FROM scan_history'),
+                         [(120,)])
+        row, = self.rows(
+            "SELECT source, outcome, fruit, plu, price, timings, image_hash "
+            "FROM scan_history WHERE id = 1")
+        self.assertEqual(row[:5], ('web', 'model', 'Maca Golden', 50716, 0.9))
+        self.assertEqual(json.loads(row[5]), {'analyze': 812.5})
+        self.assertEqual(row[6], hashlib.sha256(b'image').hexdigest())
+        stats = writer.stats()
+        self.assertEqual(stats['written'], 120)
+        self.assertGreaterEqual(stats['batches'], 3)
+        self.assertEqual(self.rows('PRAGMA journal_mode'), [('wal',)])
+
+    def test_full_queue_drops_live_scans(self):
+        writer = HistoryWriter(self.db_path, max_queue=2)
+        self.addCleanup(writer.close)
+        # Keep the writer from draining the queue
+        written = threading.Event()
+        writer._insert = lambda connection, batch: written.wait()
+        result = ScanResult(error='Scan deadline exceeded')
+
+        writer.record(result, 'web')
+        self.wait_until_taken(writer)
+
+        outcomes = [writer.record(result, 'web') for _ in range(5)]
+        written.set()
+
+        # The writer holds the first one, the queue two more
+        self.assertEqual(outcomes, [True, True, False, False, False])
+        self.assertEqual(writer.stats()['dropped'], 3)
+
+    def test_batch_runs_wait_for_room(self):
+        writer = HistoryWriter(self.db_path, max_queue=1)
+        self.addCleanup(writer.close)
+        written = threading.Event()
+        writer._insert = lambda connection, batch: written.wait()
+        result = ScanResult(error='Scan deadline exceeded')
+        writer.record(result, 'batch')
+        self.wait_until_taken(writer)
+        writer.record(result, 'batch')
+
+        threading.Timer(0.05, written.set).start()
+        start = time.monotonic()
+        self.assertTrue(writer.record(result, 'batch', timeout=2))
+
+        self.assertGreaterEqual(time.monotonic() - start, 0.04)
+        self.assertEqual(writer.stats()['dropped'], 0)
+
+    def test_scans_carry_the_digest_of_their_image(self):
+        scan_service = ScanService(
+            AIService(client=FakeGenAIClient(latency=0)),
+            MatchingService(PicklistRepository().load()),
+            cache=ClassificationCache(max_entries=8, ttl=0, db_path=''))
+        digest = hashlib.sha256(b'apple').hexdigest()
+
+        self.assertEqual(scan_service.scan(b'apple').image_digest, digest)
+        cached = asyncio.run(scan_service.scan_async(b'apple'))
+
+        self.assertTrue(cached.from_cache)
+        self.assertEqual(cached.image_digest, digest)
+
+
+class RecordReplayTests(SimpleTestCase):
+    """
+    Model calls recorded to a corpus and replayed offline.
+    """
+
+    few_shot = 'app/prompts/few_shot.txt'
+    shortlist = 'app/prompts/shortlist.txt'
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        self.corpus_path = os.path.join(directory.name, 'calls.jsonl')
+        self.products = PicklistRepository().load()
+        rng = random.Random(3)
+        self.examples = [(51146, fruit_photo((200, 30, 40), rng)),
+                         (15982, fruit_photo((230, 200, 40), rng))]
+
+    def record(self, *prompts):
+        recorder = CallRecorder(self.corpus_path)
+        client = RecordingClient(FakeGenAIClient(latency=0), recorder)
+        for prompt_path in prompts:
+            scan_service = build_scan_service(prompt_path, client,
+                                              self.products)
+            for _, image_bytes in self.examples:
+                scan_service.scan(image_bytes)
+        recorder.close()
+        return recorder
+
+    def test_replay_answers_like_the_recording(self):
+        recorder = self.record(self.few_shot)
+
+        # An analyze and a refine call per image
+        self.assertEqual(recorder.recorded, 4)
+        corpus = load_corpus(self.corpus_path)
+        self.assertEqual(len(corpus), 4)
+        record = next(iter(corpus.values()))
+        self.assertGreater(record.prompt_tokens, 0)
+        self.assertGreater(record.response_tokens, 0)
+
+        client = ReplayClient(corpus)
+        result = build_scan_service(
+            self.few_shot, client, self.products,
+            RetryPolicy(max_attempts=1)).scan(self.examples[0][1])
+        self.assertEqual(result.best_match()['PLU'], 51146)
+        self.assertEqual(len(client.served), 2)
+
+        with self.assertRaises(UnrecordedCall):
+            client.models.generate_content(model='gemini', contents=['?'])
+
+    def test_report_per_prompt(self):
+        self.record(self.few_shot, self.shortlist)
+        unrecorded = os.path.join(self.directory, 'new.txt')
+        with open(unrecorded, 'w') as f:
+            f.write('Name the fruit as JSON.')
+
+        reports = ReplayService(
+            self.corpus_path, [self.few_shot, self.shortlist, unrecorded],
+            workers=1).run(self.examples)
+
+        self.assertEqual(reports[self.few_shot]['scans'], 2)
+        # The fake always answers Maca Gala
+        self.assertEqual(reports[self.few_shot]['accuracy'], 0.5)
+        self.assertEqual(reports[self.few_shot]['refine_rate'], 1.0)
+        self.assertEqual(reports[self.few_shot]['calls_per_scan'], 2.0)
+        self.assertEqual(reports[self.shortlist]['refine_rate'], 0.0)
+        self.assertEqual(reports[self.shortlist]['calls_per_scan'], 1.0)
+        self.assertGreater(reports[self.shortlist]['prompt_tokens'], 0)
+        self.assertEqual(reports[unrecorded]['unrecorded'], 2)
+        self.assertEqual(reports[unrecorded]['accuracy'], 0.0)
+
+
+class OutputParserTests(SimpleTestCase):
+    """
+    Strict parsing of model answers and what happens when it fails.
+    """
+
+    def test_parses_what_models_send(self):
+        cases = {
+            '{"fruit": "Pêra d\'Água"}': {'fruit': "Pêra d'Água"},
+            '```json\n{"fruit": "Kiwi"}\n```': {'fruit': 'Kiwi'},
+            "{'fruit': 'Kiwi'}": {'fruit': 'Kiwi'},
+            'Here it is: {"fruit": "Kiwi"} Done.': {'fruit': 'Kiwi'},
+            '{"fruit": "Kiwi", "PLU": 507': {'fruit': 'Kiwi'},
+            '[{"index": 0, "fruit": "Kiwi"}, {"ind':
+                [{'index': 0, 'fruit': 'Kiwi'}],
+        }
+        for text, expected in cases.items():
+            self.assertEqual(parse_model_output(text), expected, text)
+
+        for text in ('', 'I cannot tell', '{"fruit": "Ki'):
+            with self.assertRaises(ParseError):
+                parse_model_output(text)
+
+    def test_unparsable_answers_are_retried_and_counted(self):
+        client = FakeGenAIClient(latency=0)
+        metrics = MetricsRegistry()
+        policy = RetryPolicy(base_delay=0.001, max_delay=0.001,
+                             breaker=CircuitBreaker(failure_threshold=1),
+                             metrics=metrics)
+        scan_service = ScanService(
+            AIService(client=client),
+            MatchingService(PicklistRepository().load()),
+            retry_policy=policy)
+        client.models.script = ['Kiwi, I think', '{"fruit": "Kiwi"}']
+
+        result = scan_service.scan(b'image')
+
+        self.assertEqual([p.plu for p in result.matches], [50719])
+        self.assertEqual(policy.parse_failures, 1)
+        self.assertEqual(policy.breaker.state, CircuitBreaker.CLOSED)
+        self.assertIn('model_parse_failures_total{call="analyze"} 1',
+                      metrics.render())
+
+    def test_best_match_takes_the_price_from_the_picklist(self):
+        matches = [Product('Maçã Gala', 51146, 0.85),
+                   Product('Maçã Fuji', 51147, 1.1)]
+        result = ScanResult(matches=matches, refined_output=(
+            '{"fruit": "Maca Fuji", "PLU": "51147", "Price": 0.01}'))
+
+        self.assertEqual(result.best_match(), matches[1].to_dict())
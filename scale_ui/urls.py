@@ -4,4 +4,6 @@ from . import views
 urlpatterns = [
     path('', views.home, name='home'),
     path('classify/', views.classify, name='classify'),
+    path('stats/', views.scan_stats, name='scan_stats'),
+    path('metrics/', views.metrics, name='metrics'),
 ]
@@ -1,21 +1,38 @@
-import time
+import asyncio
 import json
+import time
+from django.http import (
+    Http404,
+    HttpResponse,
+    JsonResponse,
+    StreamingHttpResponse,
+)
 from django.shortcuts import render, redirect
 from django.conf import settings
 from django.core.files.uploadedfile import InMemoryUploadedFile
+from django.template.loader import render_to_string
 
 # Import from existing app logic
-from app.src.services.ai_service import AIService
-from app.src.services.matching_service import MatchingService
-from app.src.repositories.picklist_repository import PicklistRepository
+from app.src.config.settings import settings as app_settings
+from app.src.services.metrics import server_timing
+from app.src.services.service_container import get_container
+
+# Where the streamed result page receives the scan events
+STREAM_MARKER = '<!-- scan events -->'
+# Candidates shown while the refine call runs
+MAX_STREAMED_CANDIDATES = 5
+# Keeps JSON from closing the <script> element it is embedded in
+JSON_SCRIPT_ESCAPES = {ord('<'): '\\u003C', ord('>'): '\\u003E',
+                       ord('&'): '\\u0026'}
 
 
 def home(request):
     return render(request, 'home.html')
 
 
-def classify(request):
+async def classify(request):
     if request.method == 'POST' and request.FILES.get('image'):
+        start = time.perf_counter()
         uploaded_file = request.FILES['image']
         
         # Read image bytes
@@ -23,50 +40,152 @@ def classify(request):
             image_bytes = uploaded_file.read()
         except Exception as e:
             return render(request, 'result.html', {'error': f"Error reading file: {e}"})
+        read_ms = (time.perf_counter() - start) * 1000
 
-        # Initialize services
-        # In a production app, we might load the repo once at startup/cache it
-        picklist_repo = PicklistRepository()
-        picklist_products = picklist_repo.load()
-        
-        ai_service = AIService()
-        matching_service = MatchingService(picklist_products)
-
-        # Call AI Service
-        # Simple retry logic similar to main.py but limited
-        agent_output = ""
-        for _ in range(3):
-            agent_output = ai_service.analyze_image(image_bytes)
-            if "Error" in agent_output and "Exception" in agent_output:
-                time.sleep(1)
-                continue
-            break
-        
-        if not agent_output or "Error" in agent_output:
-             return render(request, 'result.html', {'error': "Could not identify item. Please try again."})
-
-        # Match logic
-        matches = matching_service.find_matches(agent_output)
-
-        context = {}
-        if len(matches) > 1:
-            # Refine match
-            refined_output_str = matching_service.refine_match(ai_service, matches)
-            try:
-                best_match_data = json.loads(refined_output_str)
-                context['best_match'] = best_match_data
-                context['found'] = True
-            except json.JSONDecodeError:
-                # Fallback if refinement returns invalid JSON
-                context['best_match'] = matches[0].to_dict()
-                context['found'] = True
-            
-        elif matches:
-            context['best_match'] = matches[0].to_dict()
-            context['found'] = True
-        else:
-            context['found'] = False
-        
-        return render(request, 'result.html', context)
+        # Services are built once per worker process and shared; the
+        # worker serves other scans while this one waits on the model.
+        # Building them and checking the picklist for changes read files
+        # and SQLite, so that runs in a worker thread too
+        container = await asyncio.to_thread(get_container)
+        scan_service = await asyncio.to_thread(container.build_scan_service)
+        if app_settings.STREAM_RESULTS_ENABLED:
+            response = StreamingHttpResponse(
+                _stream_result(request, container, scan_service, image_bytes,
+                               start, read_ms),
+                content_type='text/html; charset=utf-8')
+            # Proxies must pass each chunk on as soon as it is written
+            response['Cache-Control'] = 'no-cache'
+            response['X-Accel-Buffering'] = 'no'
+            return response
+
+        result = await scan_service.scan_async(image_bytes)
+        if container.history is not None:
+            container.history.record(result, 'web')
+        context = _result_context(result)
+
+        render_start = time.perf_counter()
+        response = render(request, 'result.html', context)
+        end = time.perf_counter()
+
+        timings = {'read': read_ms, **result.timings,
+                   'render': (end - render_start) * 1000,
+                   'total': (end - start) * 1000}
+        if container.metrics is not None:
+            container.metrics.observe_timings(
+                {stage: timings[stage]
+                 for stage in ('read', 'render', 'total')})
+        response['Server-Timing'] = server_timing(timings)
+        return response
 
     return redirect('home')
+
+
+def _result_context(result):
+    """
+    Builds the context of result.html from a scan result.
+    """
+    if result.error:
+        return {'error': "Could not identify item. Please try again."}
+    # Refined locally or by the model (or served from the cache); a
+    # single match, or a failed refinement, gives the best candidate
+    best_match = result.best_match()
+    if best_match is None:
+        return {'found': False}
+    return {'best_match': best_match, 'found': True}
+
+
+def _event_script(name, data):
+    """
+    Renders a scan event as a script applying it to the result page.
+    """
+    payload = json.dumps(data, ensure_ascii=False).translate(
+        JSON_SCRIPT_ESCAPES)
+    return f'<script>scanEvent("{name}", {payload});</script>\n'
+
+
+async def _stream_result(request, container, scan_service, image_bytes,
+                         start, read_ms):
+    """
+    Yields the result page at once, then a script per scan event.
+
+    The fruit and the candidates arrive after the first model call, so
+    the customer sees them while the refine call runs; the product and
+    its price follow when the scan is done.
+    """
+    analyses = asyncio.Queue()
+
+    def on_analysis(agent_output, matches):
+        analyses.put_nowait({
+            'fruit': scan_service.matching_service.extract_fruit(
+                agent_output),
+            'candidates': [product.to_dict() for product
+                           in matches[:MAX_STREAMED_CANDIDATES]],
+        })
+
+    scan = asyncio.ensure_future(
+        scan_service.scan_async(image_bytes, on_analysis))
+    analysis = asyncio.ensure_future(analyses.get())
+    try:
+        render_start = time.perf_counter()
+        head, tail = render_to_string(
+            'result.html', {'streaming': True}, request).split(STREAM_MARKER)
+        render_ms = (time.perf_counter() - render_start) * 1000
+        yield head
+
+        await asyncio.wait({scan, analysis},
+                           return_when=asyncio.FIRST_COMPLETED)
+        if analysis.done():
+            yield _event_script('analysis', analysis.result())
+        result = await scan
+        if container.history is not None:
+            container.history.record(result, 'web')
+        yield _event_script('result', _result_context(result))
+        yield tail
+    finally:
+        # Also reached when the customer leaves before the scan is done
+        analysis.cancel()
+        scan.cancel()
+
+    if container.metrics is not None:
+        container.metrics.observe_timings({
+            'read': read_ms, 'render': render_ms,
+            'total': (time.perf_counter() - start) * 1000})
+
+
+def metrics(request):
+    registry = get_container().metrics
+    if registry is None:
+        raise Http404("Metrics are disabled (METRICS_ENABLED=0)")
+    return HttpResponse(
+        registry.render(),
+        content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+def scan_stats(request):
+    container = get_container()
+    cache = container.cache
+    index = container.perceptual_index
+    disambiguation = container.disambiguation_service
+    classifier = container.local_classifier
+    single_flight = container.single_flight
+    batcher = container.micro_batcher
+    limiter = container.rate_limiter
+    hedging = container.hedging
+    history = container.history
+    return JsonResponse({
+        'exact': cache.stats() if cache else {'enabled': False},
+        'near_duplicate': index.stats() if index else {'enabled': False},
+        'disambiguation': (disambiguation.stats() if disambiguation
+                           else {'enabled': False}),
+        'local_classifier': (classifier.stats() if classifier
+                             else {'enabled': False}),
+        'single_flight': (single_flight.stats() if single_flight
+                          else {'enabled': False}),
+        'micro_batch': batcher.stats() if batcher else {'enabled': False},
+        'rate_limit': limiter.stats() if limiter else {'enabled': False},
+        'hedging': hedging.stats() if hedging else {'enabled': False},
+        'history': history.stats() if history else {'enabled': False},
+        'circuit_breaker': container.circuit_breaker.stats(),
+        'retries': container.retry_policy.retries,
+        'parse_failures': container.retry_policy.parse_failures,
+    })